@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Decode latency of the NCO pointer networks and of MatchingNoDecoder,
+i.e. one forward pass under no_grad, for each decode type over a grid
+of problem sizes N.
+
+Before timing, a check loads a pointer network and a matching network
+from checkpoints in the layout saved before the decoders used
+nn.LSTMCell, with the LSTM cell as two nn.Linear layers input_weights and
+hidden_weights. Both forms are checked: a state dict, which
+Decoder._load_from_state_dict renames through LEGACY_LSTM_KEYS, and a
+whole pickled model, as train_nco.py saves it, which Decoder.__setstate__
+upgrades with upgrade_legacy_lstm. The loaded model must have the
+parameter names and order of a new model and decode exactly as the model
+the checkpoint was made from.
+
+Usage:
+    python -m benchmarks.bench_decode
+    python -m benchmarks.bench_decode --n_nodes 50 --beam_sizes 1 8 128
+"""
+import io
+import argparse
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+from neural_combinatorial_rl.neural_combinatorial_rl import NeuralCombOptRL, LEGACY_LSTM_KEYS
+from neural_combinatorial_rl.matching_nco import MatchingNeuralCombOptRL, MatchingNoDecoder
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="NCO decode latency benchmark")
+parser.add_argument('--batch_size', type=int, default=128)
+parser.add_argument('--n_nodes', type=int, nargs='+', default=[10, 20, 50])
+parser.add_argument('--beam_sizes', type=int, nargs='+', default=[8])
+parser.add_argument('--embedding_dim', type=int, default=128)
+parser.add_argument('--hidden_dim', type=int, default=128)
+parser.add_argument('--n_glimpses', type=int, default=1)
+parser.add_argument('--repeats', type=int, default=10)
+parser.add_argument('--warmup', type=int, default=2)
+parser.add_argument('--use_cuda', action='store_true')
+common.add_common_args(parser, 'decode')
+
+def pointer_network(args, N, beam_size=1):
+    model = NeuralCombOptRL(2, args['embedding_dim'], args['hidden_dim'], N, '<0>',
+        args['n_glimpses'], 3, 10., True, beam_size, False, args['use_cuda'])
+    return model.cuda() if args['use_cuda'] else model
+
+def matching_network(args, N):
+    model = MatchingNeuralCombOptRL(N, 2, args['embedding_dim'], args['hidden_dim'], N, '<0>',
+        args['n_glimpses'], 3, 10., True, 1, False, args['use_cuda'])
+    return model.cuda() if args['use_cuda'] else model
+
+def matching_no_decoder(args, N):
+    model = MatchingNoDecoder(N, 2, args['embedding_dim'], args['hidden_dim'], args['use_cuda'])
+    return model.cuda() if args['use_cuda'] else model
+
+def to_legacy_decoder(decoder):
+    """Put the LSTM cell of decoder back into the input_weights/hidden_weights layout from before nn.LSTMCell"""
+    lstm = decoder.lstm
+    input_weights = nn.Linear(lstm.input_size, 4 * lstm.hidden_size)
+    hidden_weights = nn.Linear(lstm.hidden_size, 4 * lstm.hidden_size)
+    input_weights = input_weights.to(lstm.weight_ih.device)
+    hidden_weights = hidden_weights.to(lstm.weight_hh.device)
+    with torch.no_grad():
+        input_weights.weight.copy_(lstm.weight_ih)
+        input_weights.bias.copy_(lstm.bias_ih)
+        hidden_weights.weight.copy_(lstm.weight_hh)
+        hidden_weights.bias.copy_(lstm.bias_hh)
+    modules = OrderedDict()
+    for name, module in decoder._modules.items():
+        if name == 'lstm':
+            modules['input_weights'] = input_weights
+            modules['hidden_weights'] = hidden_weights
+        else:
+            modules[name] = module
+    decoder._modules = modules
+
+def legacy_state_dict(model):
+    """The state dict of model with the decoder LSTM keys from before nn.LSTMCell"""
+    prefix = 'actor_net.decoder.'
+    state_dict = model.state_dict()
+    for old, new in LEGACY_LSTM_KEYS:
+        state_dict[prefix + old] = state_dict.pop(prefix + new)
+    return state_dict
+
+def decode(model, x):
+    """selections and probabilities of a greedy decode"""
+    model.eval()
+    model.decode_type('greedy')
+    with torch.no_grad():
+        probs, _, idxs, _ = model(x)
+    return torch.stack(idxs, 1), torch.stack(probs, 1)
+
+def legacy_check(name, make_model, x):
+    """Load model from a pre-nn.LSTMCell state dict and pickle, compare with the model it was saved from"""
+    model = make_model()
+    idxs, probs = decode(model, x)
+    names = [n for n, _ in model.named_parameters()]
+    from_state_dict = make_model()
+    from_state_dict.load_state_dict(legacy_state_dict(model))
+    to_legacy_decoder(model.actor_net.decoder)
+    buf = io.BytesIO()
+    torch.save(model, buf)
+    buf.seek(0)
+    from_pickle = torch.load(buf, weights_only=False)
+    ok = True
+    r = OrderedDict()
+    for form, loaded in [('state_dict', from_state_dict), ('pickle', from_pickle)]:
+        loaded_idxs, loaded_probs = decode(loaded, x)
+        same_params = [n for n, _ in loaded.named_parameters()] == names
+        same_idxs = bool(torch.equal(loaded_idxs, idxs))
+        r[form + '_max_prob_diff'] = float((loaded_probs - probs).abs().max())
+        r[form + '_ok'] = same_params and same_idxs and r[form + '_max_prob_diff'] == 0.
+        ok = ok and r[form + '_ok']
+    return common.result('legacy_lstm_check', [('network', name), ('n_nodes', x.size(2) // (2 if name == 'matching' else 1))], {}, ok=ok, **r)
+
+def bench(args, name, model, x, decode_type, params, results):
+    model.eval()
+    model.decode_type(decode_type)
+    with torch.no_grad():
+        t = common.time_fn(lambda: model(x), args['repeats'], args['warmup'], args['use_cuda'])
+    t['instances_per_sec'] = 1000. * x.size(0) / t['p50_ms']
+    results.append(common.result(name, params, t))
+
+def main(args):
+    common.setup(args)
+    results = []
+    B = args['batch_size']
+    N = args['n_nodes'][0]
+    failed = False
+    for name, make_model, x in [
+            ('pointer', lambda: pointer_network(args, N), torch.rand(8, 2, N)),
+            ('matching', lambda: matching_network(args, N), torch.rand(8, 2, 2 * N))]:
+        r = legacy_check(name, make_model, x.cuda() if args['use_cuda'] else x)
+        print(' [*] pre-LSTMCell checkpoint, {}: state dict {}, pickle {}'.format(name,
+            'ok' if r['state_dict_ok'] else 'FAILED', 'ok' if r['pickle_ok'] else 'FAILED'))
+        failed = failed or not r['ok']
+        results.append(r)
+    for N in args['n_nodes']:
+        print(' [*] N: {}'.format(N))
+        x = torch.rand(B, 2, N)
+        x2 = torch.rand(B, 2, 2 * N)
+        if args['use_cuda']:
+            x, x2 = x.cuda(), x2.cuda()
+        params = [('batch_size', B), ('n_nodes', N)]
+        model = pointer_network(args, N)
+        for decode_type in ['stochastic', 'greedy']:
+            bench(args, 'pointer_{}'.format(decode_type), model, x, decode_type, params, results)
+        for K in args['beam_sizes']:
+            model = pointer_network(args, N, K)
+            bench(args, 'pointer_beam_search', model, x, 'beam_search', params + [('beam_size', K)], results)
+        model = matching_network(args, N)
+        for decode_type in ['stochastic', 'greedy']:
+            bench(args, 'matching_{}'.format(decode_type), model, x2, decode_type, params, results)
+        model = matching_no_decoder(args, N)
+        for decode_type in ['stochastic', 'greedy']:
+            bench(args, 'matching_no_decoder_{}'.format(decode_type), model, x2, decode_type, params, results)
+    for r in results:
+        if r['name'] == 'legacy_lstm_check':
+            continue
+        print('{:<30} {:<50} p50: {:10.3f} ms, {:10.1f} instances/s'.format(
+            r['name'], str(dict(r['params'])), r['p50_ms'], r['instances_per_sec']))
+    code = common.finish(args, 'decode', results)
+    if failed:
+        print(' [!] a pre-LSTMCell checkpoint did not load as saved')
+        return 1
+    return code
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Scaling of data-parallel SPG training (train_spg.py --world_size) over
+local processes on the CPU. Each task trains for a fixed number of steps
+on synthetic data with the same global --parallel_envs and --batch_size
+for every world size, split evenly across the ranks (strong scaling). For
+each world size it reports
+
+    * steps/s and instances/s over all ranks, from rank 0's --profile JSON
+    * the time rank 0 spends in the gradient all-reduces
+    * the speedup over one process, and the scaling efficiency,
+      speedup / world size
+    * rank 0's eval reward after training, and its difference from the
+      1-process run, as a check that the ranks train the same model
+
+Each rank gets cpu_count / world_size threads, so the 1-process run uses
+all the cores too. World sizes above the number of cores oversubscribe
+the machine and are skipped, unless --oversubscribe is given; their runs
+then check that training completes and converges, but their timings
+measure contention, not scaling.
+
+Usage:
+    python -m benchmarks.bench_distributed
+    python -m benchmarks.bench_distributed --configs spg-tsp --world_sizes 1 2 4
+    python -m benchmarks.bench_distributed --oversubscribe --max_steps 300
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+from benchmarks import common
+from benchmarks.bench_train import CONFIGS
+
+TASKS = [name for name in CONFIGS if CONFIGS[name][0] == 'train_spg.py']
+
+parser = argparse.ArgumentParser(description="Data-parallel SPG training scaling benchmark")
+parser.add_argument('--configs', type=str, nargs='+', default=TASKS)
+parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+parser.add_argument('--max_steps', type=int, default=100)
+parser.add_argument('--parallel_envs', type=int, default=128, help='Global, split across the ranks')
+parser.add_argument('--batch_size', type=int, default=128, help='Global, split across the ranks')
+parser.add_argument('--test_size', type=int, default=128)
+parser.add_argument('--dist_port', type=int, default=29500)
+parser.add_argument('--oversubscribe', action='store_true', help='Also run the world sizes above the number of cores')
+parser.add_argument('--timeout', type=int, default=1800, help='Seconds before a run is killed')
+parser.add_argument('--verbose', action='store_true', help='Show the output of each run')
+common.add_common_args(parser, 'distributed')
+
+def command(args, name, world_size, run_id, base_dir):
+    _, task, extra = CONFIGS[name]
+    cmd = [sys.executable, os.path.join(common.REPO_DIR, 'train_spg.py'),
+           '--task', task,
+           '--synthetic', 'True',
+           '--world_size', str(world_size),
+           '--dist_port', str(args['dist_port']),
+           '--max_steps', str(args['max_steps']),
+           '--n_epochs', '1',
+           '--parallel_envs', str(args['parallel_envs']),
+           '--batch_size', str(args['batch_size']),
+           '--buffer_size', str(10 * args['max_steps'] * args['parallel_envs']),
+           '--train_size', str(args['max_steps'] * args['parallel_envs']),
+           '--test_size', str(args['test_size']),
+           '--random_seed', str(args['random_seed']),
+           '--actor_workers', '0',
+           '--replay_buffer_gpu', 'False',
+           '--use_cuda', 'False',
+           '--disable_tensorboard', 'True',
+           '--disable_progress_bar', 'True',
+           '--save_stats', 'True',
+           '--save_model', 'False',
+           '--profile', 'True',
+           '--profile_step', str(args['max_steps']),
+           '--log_step', str(args['max_steps'] + 1),
+           '--base_dir', base_dir,
+           '--_id', run_id]
+    return cmd + extra
+
+def run(args, name, world_size, base_dir):
+    cop = CONFIGS[name][1].split('_')[0]
+    run_id = '{}-{}'.format(name, world_size)
+    env = dict(os.environ)
+    env.pop('OMP_NUM_THREADS', None)
+    start = time.time()
+    out = None if args['verbose'] else subprocess.DEVNULL
+    subprocess.check_call(command(args, name, world_size, run_id, base_dir), cwd=common.REPO_DIR, env=env,
+            stdout=out, stderr=subprocess.STDOUT, timeout=args['timeout'])
+    wall = time.time() - start
+    with open(os.path.join(base_dir, 'results', 'profile', 'spg', cop, run_id, 'phases.json'), 'r') as f:
+        summary = json.load(f)['latest']
+    with open(os.path.join(base_dir, 'results', 'fglab', 'spg', cop, run_id, 'scores.json'), 'r') as f:
+        scores = json.load(f)['_scores']
+    evals = [v for _, v in sorted([(int(k.split('_')[-1]), v) for k, v in scores.items()
+        if k.startswith('eval_avg_reward_')])]
+    phases = summary['phases']
+    # the profile counts the instances of rank 0, a world_size-th of the step's
+    steps_per_sec = summary['instances_per_sec'] / (args['parallel_envs'] // world_size)
+    metrics = OrderedDict([
+        ('step_ms', 1000. / steps_per_sec if steps_per_sec > 0 else None),
+        ('steps_per_sec', steps_per_sec),
+        ('instances_per_sec', steps_per_sec * args['parallel_envs']),
+        ('all_reduce_ms', phases['all_reduce']['mean_ms'] if 'all_reduce' in phases else 0.),
+        ('final_eval_reward', evals[-1]),
+        ('oversubscribed', world_size > (os.cpu_count() or 1)),
+        ('wall_s', wall)])
+    params = [('task', CONFIGS[name][1]), ('world_size', world_size), ('max_steps', args['max_steps']),
+        ('parallel_envs', args['parallel_envs']), ('batch_size', args['batch_size'])]
+    return common.result(name, params, {}, **metrics)
+
+def main(args):
+    common.setup(args)
+    for name in args['configs']:
+        if name not in TASKS:
+            print(' [!] unknown config {}, choose from {}'.format(name, TASKS))
+            return 1
+    world_sizes = [n for n in args['world_sizes'] if n <= (os.cpu_count() or 1) or args['oversubscribe']]
+    if len(world_sizes) < len(args['world_sizes']):
+        print(' [!] skipping world sizes above the {} cores: {}'.format(os.cpu_count(),
+            [n for n in args['world_sizes'] if n not in world_sizes]))
+    results = []
+    base_dir = tempfile.mkdtemp()
+    try:
+        for name in args['configs']:
+            single = None
+            for world_size in world_sizes:
+                print(' [*] running {}, world size {}'.format(name, world_size))
+                try:
+                    r = run(args, name, world_size, base_dir)
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                    print(' [!] {} failed, rerun with --verbose to see its output'.format(name))
+                    continue
+                if world_size == 1:
+                    single = r
+                if single is not None:
+                    r['speedup'] = r['steps_per_sec'] / single['steps_per_sec']
+                    r['efficiency'] = r['speedup'] / world_size
+                    r['eval_reward_delta'] = r['final_eval_reward'] - single['final_eval_reward']
+                results.append(r)
+    finally:
+        shutil.rmtree(base_dir)
+    print('{:<12} {:>6} {:>10} {:>14} {:>14} {:>9} {:>11} {:>11} {:>9}'.format('task', 'ranks', 'step ms',
+        'instances/s', 'all-reduce ms', 'speedup', 'efficiency', 'eval reward', 'delta'))
+    for r in results:
+        print('{:<12} {:>6d} {:>10.2f} {:>14.1f} {:>14.2f} {:>9.2f} {:>11.2f} {:>11.4f} {:>9.4f}{}'.format(r['name'],
+            r['params']['world_size'], r['step_ms'], r['instances_per_sec'], r['all_reduce_ms'],
+            r.get('speedup', float('nan')), r.get('efficiency', float('nan')), r['final_eval_reward'],
+            r.get('eval_reward_delta', float('nan')), ' (oversubscribed)' if r['oversubscribed'] else ''))
+    return common.finish(args, 'distributed', results, metric='step_ms')
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
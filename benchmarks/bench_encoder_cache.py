@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Ablation of train_spg.py --encoder_cache_staleness. Each task trains for
+a fixed number of steps on synthetic data, on the CPU, once with the
+actor re-encoding every replayed state (staleness -1) and once per
+staleness bound K, with the same seed. For each run it reports
+
+    * the step time and the actor and critic update time, from the --profile JSON
+    * the fraction of replayed states served from the encoder cache
+    * the final and best eval reward, from the FGLab scores
+
+Before training, a check encodes a batch with each actor, stores it in a
+replay buffer, samples it back with its encodings and compares them, and
+the psi computed from them, with a fresh encoding by the same weights,
+i.e. staleness 0. It fails if they differ by more than --check_tolerance.
+
+The cache only covers the entries of the last K learner steps, and
+minibatches are drawn uniformly from the whole buffer, so once the buffer
+is full the hit rate is at most the cached entries / --buffer_size. Each
+run is repeated for each of --buffer_sizes to show this, and the bound is
+reported next to the measured hit rate.
+
+Usage:
+    python -m benchmarks.bench_encoder_cache
+    python -m benchmarks.bench_encoder_cache --tasks spg-sort --staleness 1 4 --max_steps 500
+    python -m benchmarks.bench_encoder_cache --buffer_sizes 256 1024
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import tempfile
+import subprocess
+from collections import OrderedDict
+import torch
+
+from spg.models import SPGSequentialActor, SPGMatchingActor
+from spg.memory import Memory
+from benchmarks import common
+from benchmarks.bench_train import CONFIGS
+
+TASKS = [name for name in CONFIGS if CONFIGS[name][0] == 'train_spg.py']
+
+parser = argparse.ArgumentParser(description="Encoder cache ablation for SPG training")
+parser.add_argument('--tasks', type=str, nargs='+', default=TASKS)
+parser.add_argument('--staleness', type=int, nargs='+', default=[0, 1, 4, 16], help='Staleness bounds to compare against no cache')
+parser.add_argument('--max_steps', type=int, default=300)
+parser.add_argument('--parallel_envs', type=int, default=32)
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--buffer_sizes', type=int, nargs='+', default=[1024, 8192])
+parser.add_argument('--updates_per_step', type=int, default=4)
+parser.add_argument('--test_size', type=int, default=256)
+parser.add_argument('--check_tolerance', type=float, default=1e-4, help='Max abs. difference allowed in the staleness 0 check')
+parser.add_argument('--timeout', type=int, default=3600, help='Seconds before a run is killed')
+parser.add_argument('--verbose', action='store_true', help='Show the output of each run')
+common.add_common_args(parser, 'encoder_cache')
+
+def staleness_check(args, arch):
+    """Max abs. difference of cached and recomputed encodings, and of the psi computed from them"""
+    N, B = 10, 64
+    if arch == 'matching':
+        actor = SPGMatchingActor(2, N, 32, 32, num_workers=0, cuda=False)
+        obs = torch.rand(B, 2 * N, 2)
+    else:
+        actor = SPGSequentialActor(2, N, 32, 32, num_workers=0, cuda=False)
+        obs = torch.rand(B, N, 2)
+    encoding_shape = [N, actor.gru.hidden_size * (2 if actor.gru.bidirectional else 1)]
+    memory = Memory(4 * B, action_shape=[N, N], observation_shape=list(obs.size()[1:]), use_cuda=False,
+        encoding_shape=encoding_shape, encoding_limit=4 * B)
+    with torch.no_grad():
+        encoding = actor.encode(obs)
+        psi, _ = actor(obs, do_round=False)
+        memory.append(obs, torch.zeros(B, N, N).byte(), psi, torch.zeros(B), encoding, 0)
+        s_batch, _, _, _, enc_batch, enc_steps = memory.sample(B, with_encodings=True)
+        fresh = actor.encode(s_batch)
+        cached_psi, _ = actor(s_batch, do_round=False, encoding=enc_batch)
+        fresh_psi, _ = actor(s_batch, do_round=False)
+    encoding_err = float((enc_batch - fresh).abs().max())
+    psi_err = float((cached_psi - fresh_psi).abs().max())
+    ok = bool((enc_steps == 0).all()) and encoding_err <= args['check_tolerance'] and psi_err <= args['check_tolerance']
+    return common.result('staleness_check', [('arch', arch)], {}, encoding_abs_err=encoding_err,
+        psi_abs_err=psi_err, ok=ok)
+
+def command(args, name, staleness, buffer_size, run_id, base_dir):
+    _, task, extra = CONFIGS[name]
+    cmd = [sys.executable, os.path.join(common.REPO_DIR, 'train_spg.py'),
+           '--task', task,
+           '--synthetic', 'True',
+           '--max_steps', str(args['max_steps']),
+           '--n_epochs', '1',
+           '--parallel_envs', str(args['parallel_envs']),
+           '--batch_size', str(args['batch_size']),
+           '--buffer_size', str(buffer_size),
+           '--updates_per_step', str(args['updates_per_step']),
+           '--encoder_cache_staleness', str(staleness),
+           '--train_size', str(args['max_steps'] * args['parallel_envs']),
+           '--test_size', str(args['test_size']),
+           '--random_seed', str(args['random_seed']),
+           '--actor_workers', '0',
+           '--replay_buffer_gpu', 'False',
+           '--use_cuda', 'False',
+           '--disable_tensorboard', 'True',
+           '--disable_progress_bar', 'True',
+           '--save_stats', 'True',
+           '--save_model', 'False',
+           '--profile', 'True',
+           '--profile_step', str(args['max_steps']),
+           '--log_step', str(args['max_steps'] + 1),
+           '--base_dir', base_dir,
+           '--_id', run_id]
+    return cmd + extra
+
+def run(args, name, staleness, buffer_size, base_dir):
+    cop = CONFIGS[name][1].split('_')[0]
+    run_id = '{}-{}-{}'.format(name, staleness, buffer_size)
+    env = dict(os.environ)
+    if args['threads'] > 0:
+        env['OMP_NUM_THREADS'] = str(args['threads'])
+    start = time.time()
+    out = None if args['verbose'] else subprocess.DEVNULL
+    subprocess.check_call(command(args, name, staleness, buffer_size, run_id, base_dir), cwd=common.REPO_DIR, env=env,
+            stdout=out, stderr=subprocess.STDOUT, timeout=args['timeout'])
+    wall = time.time() - start
+    with open(os.path.join(base_dir, 'results', 'profile', 'spg', cop, run_id, 'phases.json'), 'r') as f:
+        summary = json.load(f)['latest']
+    phases = summary['phases']
+    with open(os.path.join(base_dir, 'results', 'fglab', 'spg', cop, run_id, 'scores.json'), 'r') as f:
+        scores = json.load(f)['_scores']
+    evals = sorted([(int(k.split('_')[-1]), v) for k, v in scores.items() if k.startswith('eval_avg_reward_')])
+    steps_per_sec = summary['instances_per_sec'] / args['parallel_envs']
+    metrics = OrderedDict([
+        ('step_ms', 1000. / steps_per_sec if steps_per_sec > 0 else None),
+        ('actor_update_ms', phases['actor_update']['mean_ms']),
+        ('critic_update_ms', phases['critic_update']['mean_ms']),
+        ('cache_hit_rate', scores.get('encoder_cache_hit_rate', 0.)),
+        ('max_hit_rate', scores.get('encoder_cache_max_hit_rate', 0.)),
+        ('final_eval_reward', evals[-1][1]),
+        ('best_eval_reward', max([v for _, v in evals])),
+        ('wall_s', wall)])
+    params = [('task', CONFIGS[name][1]), ('staleness', staleness), ('max_steps', args['max_steps']),
+        ('buffer_size', buffer_size), ('updates_per_step', args['updates_per_step'])]
+    return common.result(name, params, {}, **metrics)
+
+def main(args):
+    common.setup(args)
+    for name in args['tasks']:
+        if name not in TASKS:
+            print(' [!] unknown task {}, choose from {}'.format(name, TASKS))
+            return 1
+    results = []
+    failed = False
+    for arch in ['sequential', 'matching']:
+        r = staleness_check(args, arch)
+        print(' [*] staleness 0 check, {} arch: encoding abs. err {:.2e}, psi abs. err {:.2e}{}'.format(
+            arch, r['encoding_abs_err'], r['psi_abs_err'], '' if r['ok'] else ' <-- FAILED'))
+        failed = failed or not r['ok']
+        results.append(r)
+    base_dir = tempfile.mkdtemp()
+    try:
+        for name in args['tasks']:
+            for buffer_size in args['buffer_sizes']:
+                for staleness in [-1] + args['staleness']:
+                    print(' [*] running {}, buffer size {}, staleness {}'.format(name, buffer_size, staleness))
+                    try:
+                        results.append(run(args, name, staleness, buffer_size, base_dir))
+                    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                        print(' [!] {} failed, rerun with --verbose to see its output'.format(name))
+    finally:
+        shutil.rmtree(base_dir)
+    print('{:<12} {:>7} {:>9} {:>10} {:>10} {:>10} {:>14} {:>12} {:>12}'.format('task', 'buffer', 'staleness',
+        'hit rate', 'max hit', 'step ms', 'actor upd. ms', 'final eval', 'best eval'))
+    for r in results:
+        if r['name'] == 'staleness_check':
+            continue
+        print('{:<12} {:>7d} {:>9d} {:>10.3f} {:>10.3f} {:>10.2f} {:>14.2f} {:>12.4f} {:>12.4f}'.format(r['name'],
+            r['params']['buffer_size'], r['params']['staleness'], r['cache_hit_rate'], r['max_hit_rate'],
+            r['step_ms'], r['actor_update_ms'],
+            r['final_eval_reward'], r['best_eval_reward']))
+    code = common.finish(args, 'encoder_cache', results, metric='actor_update_ms')
+    if failed:
+        print(' [!] the staleness 0 check failed')
+        return 1
+    return code
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Quality/latency trade-off of best-of-K decoding for the NCO pointer
+network on TSP. For each K, every instance is decoded K times in one
+batched pass, either by sampling or with distinct forced first nodes
+(multi-start), and the best tour is kept. Reports the mean tour length
+and the latency of decoding + scoring a batch.
+
+The policy is randomly initialized unless --load_path points to a model
+saved by train_nco.py, so the absolute tour lengths are only meaningful
+for a trained model; the latencies are not affected.
+
+Usage:
+    python -m benchmarks.bench_inference
+    python -m benchmarks.bench_inference --load_path nco-COP-tsp-N-20-epoch-0.pt --n_instances 1000
+"""
+import argparse
+import torch
+
+from neural_combinatorial_rl.neural_combinatorial_rl import NeuralCombOptRL
+from neural_combinatorial_rl import inference
+from envs import tsp_task
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="NCO best-of-K inference benchmark")
+parser.add_argument('--n_nodes', type=int, default=20)
+parser.add_argument('--n_instances', type=int, default=256)
+parser.add_argument('--batch_size', type=int, default=64)
+parser.add_argument('--k', type=int, nargs='+', default=[1, 8, 32, 128])
+parser.add_argument('--embedding_dim', type=int, default=128)
+parser.add_argument('--hidden_dim', type=int, default=128)
+parser.add_argument('--n_glimpses', type=int, default=1)
+parser.add_argument('--load_path', type=str, default='')
+parser.add_argument('--repeats', type=int, default=3)
+parser.add_argument('--warmup', type=int, default=1)
+parser.add_argument('--use_cuda', action='store_true')
+common.add_common_args(parser, 'inference')
+
+def build_model(args):
+    if args['load_path'] != '':
+        print(' [*] Loading model from {}'.format(args['load_path']))
+        model = torch.load(args['load_path'], map_location='cpu', weights_only=False)
+    else:
+        model = NeuralCombOptRL(2, args['embedding_dim'], args['hidden_dim'], args['n_nodes'], '<0>',
+            args['n_glimpses'], 3, 10., True, 1, False, args['use_cuda'])
+    model.is_train = False
+    model.eval()
+    return model.cuda() if args['use_cuda'] else model
+
+def evaluate(model, batches, k, multistart, reward_fn):
+    if k == 1 and not multistart:
+        # the usual single greedy decode
+        model.decode_type("greedy")
+        Rs = []
+        with torch.no_grad():
+            for x in batches:
+                _, actions, _, _ = model(x)
+                Rs.append(reward_fn(x, actions))
+        return torch.cat(Rs)
+    return torch.cat([inference.best_of_k(model, x, k, reward_fn, multistart)[0] for x in batches])
+
+def main(args):
+    common.setup(args)
+    results = []
+    N = args['n_nodes']
+    model = build_model(args)
+    reward_fn = inference.make_reward_fn({'COP': 'tsp', 'use_cuda': args['use_cuda']}, tsp_task.reward_nco)
+    x = torch.rand(args['n_instances'], 2, N)
+    if args['use_cuda']:
+        x = x.cuda()
+    batches = x.split(args['batch_size'])
+    for k in args['k']:
+        for multistart in [False, True]:
+            if k == 1 and multistart:
+                continue
+            name = 'greedy' if k == 1 else ('multistart' if multistart else 'sampling')
+            print(' [*] {}, K: {}'.format(name, k))
+            # fixed seed so the sampled tours do not depend on which configs ran before
+            torch.manual_seed(args['random_seed'])
+            R = evaluate(model, batches, k, multistart, reward_fn)
+            # time a single batch
+            t = common.time_fn(lambda: evaluate(model, batches[:1], k, multistart, reward_fn),
+                    args['repeats'], args['warmup'], args['use_cuda'])
+            params = [('n_nodes', N), ('batch_size', batches[0].size(0)), ('k', k)]
+            results.append(common.result(name, params, t, mean_tour_length=float(R.mean()),
+                instances_per_sec=1000. * batches[0].size(0) / t['p50_ms']))
+    for r in results:
+        print('{:<12} {:<50} tour length: {:8.4f}, p50: {:10.3f} ms, {:10.1f} instances/s'.format(
+            r['name'], str(dict(r['params'])), r['mean_tour_length'], r['p50_ms'], r['instances_per_sec']))
+    extra = {'load_path': args['load_path'], 'n_instances': args['n_instances']}
+    return common.finish(args, 'inference', results, extra)
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the SPG hot paths, each timed in isolation
+over a grid of batch sizes and problem sizes N:
+
+    * Sinkhorn forward and forward + backward
+    * rounding psi to permutations, serial and with a worker pool
+    * replay buffer append and sample
+    * every reward function in envs/*_task.py
+    * dataset __getitem__ for each task
+
+Usage:
+    python -m benchmarks.bench_kernels
+    python -m benchmarks.bench_kernels --update_baseline
+"""
+import argparse
+import shutil
+import tempfile
+import numpy as np
+import torch
+from torch.autograd import Variable
+from pathos.multiprocessing import ProcessingPool as Pool
+
+from spg.layers import Sinkhorn
+from spg.memory import Memory
+from spg.util import round_to_permutations
+from envs import sorting_task, mwm2D_task, tsp_task
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="SPG kernel micro-benchmarks")
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 128])
+parser.add_argument('--n_nodes', type=int, nargs='+', default=[10, 20, 50])
+parser.add_argument('--sinkhorn_iters', type=int, default=10)
+parser.add_argument('--sinkhorn_tau', type=float, default=0.05)
+parser.add_argument('--workers', type=int, default=4, help='Pool size for pooled rounding')
+parser.add_argument('--repeats', type=int, default=20)
+parser.add_argument('--warmup', type=int, default=3)
+parser.add_argument('--use_cuda', action='store_true')
+parser.add_argument('--kernels', type=str, nargs='+', default=['sinkhorn', 'rounding', 'memory', 'reward', 'dataset'])
+common.add_common_args(parser, 'kernels')
+
+def bench_sinkhorn(args, B, N, results):
+    sinkhorn = Sinkhorn(N, args['sinkhorn_iters'], args['sinkhorn_tau'])
+    x = torch.randn(B, N, N)
+    if args['use_cuda']:
+        x = x.cuda()
+    with torch.no_grad():
+        t = common.time_fn(lambda: sinkhorn(x), args['repeats'], args['warmup'], args['use_cuda'])
+    results.append(common.result('sinkhorn_forward', [('batch_size', B), ('n_nodes', N)], t))
+
+    def fwd_bwd(x):
+        sinkhorn(x).sum().backward()
+    setup = lambda: x.clone().requires_grad_()
+    t = common.time_fn(fwd_bwd, args['repeats'], args['warmup'], args['use_cuda'], setup=setup)
+    results.append(common.result('sinkhorn_backward', [('batch_size', B), ('n_nodes', N)], t))
+
+def bench_rounding(args, B, N, results, pool):
+    sinkhorn = Sinkhorn(N, args['sinkhorn_iters'], args['sinkhorn_tau'])
+    with torch.no_grad():
+        psi = sinkhorn(torch.randn(B, N, N)).numpy()
+    t = common.time_fn(lambda: round_to_permutations(psi), args['repeats'], args['warmup'])
+    results.append(common.result('rounding_serial', [('batch_size', B), ('n_nodes', N)], t))
+    t = common.time_fn(lambda: round_to_permutations(psi, pool, args['workers']),
+            args['repeats'], args['warmup'])
+    results.append(common.result('rounding_pooled', [('batch_size', B), ('n_nodes', N),
+        ('workers', args['workers'])], t))
+
+def bench_memory(args, B, N, results):
+    limit = max(100 * B, 10000)
+    memory = Memory(limit, action_shape=[N, N], observation_shape=[N, 2], use_cuda=args['use_cuda'])
+    obs = torch.rand(B, N, 2)
+    actions = torch.zeros(B, N, N).byte()
+    psi = torch.rand(B, N, N)
+    R = torch.rand(B, 1)
+    if args['use_cuda']:
+        obs, actions, psi, R = obs.cuda(), actions.cuda(), psi.cuda(), R.cuda()
+    t = common.time_fn(lambda: memory.append(obs, actions, psi, R), args['repeats'], args['warmup'], args['use_cuda'])
+    results.append(common.result('memory_append', [('batch_size', B), ('n_nodes', N)], t))
+    while memory.nb_entries < 2 * B:
+        memory.append(obs, actions, psi, R)
+    t = common.time_fn(lambda: memory.sample(B), args['repeats'], args['warmup'], args['use_cuda'])
+    results.append(common.result('memory_sample', [('batch_size', B), ('n_nodes', N)], t))
+
+def reward_inputs(B, N):
+    """Random solutions in the layout each reward function expects"""
+    perm = torch.stack([torch.randperm(N).float() for _ in range(B)])
+    tour = torch.rand(B, N, 2)
+    matching = torch.rand(B, 2 * N, 2)
+    return [
+        # SPG sort rewards take the permuted inputs, [batch_size, 1, N]
+        ('sort.reward_ddpg_A', lambda: sorting_task.reward_ddpg_A(Variable(perm.unsqueeze(1)), False)),
+        ('sort.reward_ddpg_B', lambda: sorting_task.reward_ddpg_B(Variable(perm.unsqueeze(1)), False)),
+        ('sort.reward_ddpg_C', lambda: sorting_task.reward_ddpg_C(Variable(perm.unsqueeze(1)), False)),
+        ('sort.reward_ddpg_D', lambda: sorting_task.reward_ddpg_D(Variable(perm.unsqueeze(1)), False)),
+        # NCO rewards take a list of len N of [batch_size, n_features]
+        ('sort.reward_nco', lambda: sorting_task.reward_nco(list(perm.unsqueeze(2).unbind(1)), True, False)),
+        ('mwm2D.reward', lambda: mwm2D_task.reward(Variable(matching), False)),
+        ('mwm2D.reward_nco', lambda: mwm2D_task.reward_nco(Variable(matching), False)),
+        ('tsp.reward_spg', lambda: tsp_task.reward_spg(Variable(tour), False)),
+        ('tsp.reward_nco', lambda: tsp_task.reward_nco(list(tour.unbind(1)), False)),
+    ]
+
+def bench_reward(args, B, N, results):
+    for name, fn in reward_inputs(B, N):
+        params = [('batch_size', B), ('n_nodes', N)]
+        try:
+            t = common.time_fn(fn, args['repeats'], args['warmup'])
+        except Exception as e:
+            print(' [!] {} failed: {}'.format(name, e))
+            results.append(common.result(name, params, {}, error=str(e)))
+            continue
+        results.append(common.result(name, params, t))
+
+def bench_dataset(args, N, results, data_dir):
+    """__getitem__ does not depend on the batch size, so only N is varied"""
+    size = 256
+    sort_train, _ = sorting_task.create_dataset(size, 1, data_dir + '/sort', 0, low=0, high=N-1, train_only=True)
+    tsp_train, _ = tsp_task.create_dataset(size, 1, data_dir + '/tsp', N, 0, reset=True)
+    mwm_train, _, _ = mwm2D_task.create_dataset(size, 0, 0, data_dir + '/mwm2D', N, only=0)
+    datasets = [
+        ('sort.SortingDataset', sorting_task.SortingDataset(sort_train)),
+        ('tsp.TSPDataset', tsp_task.TSPDataset(tsp_train)),
+        ('mwm2D.MWM2DDataset', mwm2D_task.MWM2DDataset(mwm_train, size))]
+    for name, ds in datasets:
+        idxs = np.random.randint(0, len(ds), size=64)
+        def getitems():
+            for i in idxs:
+                ds[i]
+        t = common.time_fn(getitems, args['repeats'], args['warmup'])
+        # report the time per item
+        for k in ['mean_ms', 'p50_ms', 'min_ms', 'std_ms']:
+            t[k] /= len(idxs)
+        results.append(common.result(name + '.__getitem__', [('n_nodes', N)], t))
+
+def main(args):
+    common.setup(args)
+    results = []
+    pool = Pool(args['workers']) if 'rounding' in args['kernels'] else None
+    data_dir = tempfile.mkdtemp()
+    try:
+        for N in args['n_nodes']:
+            for B in args['batch_sizes']:
+                print(' [*] batch_size: {}, N: {}'.format(B, N))
+                if 'sinkhorn' in args['kernels']:
+                    bench_sinkhorn(args, B, N, results)
+                if 'rounding' in args['kernels']:
+                    bench_rounding(args, B, N, results, pool)
+                if 'memory' in args['kernels']:
+                    bench_memory(args, B, N, results)
+                if 'reward' in args['kernels']:
+                    bench_reward(args, B, N, results)
+            if 'dataset' in args['kernels']:
+                bench_dataset(args, N, results, data_dir)
+    finally:
+        shutil.rmtree(data_dir)
+    for r in results:
+        if 'p50_ms' in r:
+            print('{:<28} {:<40} p50: {:10.3f} ms'.format(r['name'], str(dict(r['params'])), r['p50_ms']))
+    return common.finish(args, 'kernels', results)
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Throughput of mixed-size SPG inference. A stream of TSP instances, or
+of mwm2D instances (two graphs of N nodes each), with N drawn uniformly
+from [--min_nodes, --max_nodes] is solved either
+
+    * padded: by one actor with n_nodes = max_nodes, in batches of
+      --batch_size instances of any size, in arrival order, zero-padded
+      to the largest instance of each batch,
+    * padded_sorted: the same, with the instances sorted by size first, so
+      each batch is padded only to the sizes near it, or
+    * bucketed: by one actor per size, each instance batched only with
+      instances of the same size, as before padding support
+
+All include the actor forward, rounding psi to permutations and scoring
+the solutions, and report instances/s and the number of batches. The
+mwm2D results are named with an mwm2D- prefix.
+
+Usage:
+    python -m benchmarks.bench_padding
+    python -m benchmarks.bench_padding --min_nodes 20 --max_nodes 100 --n_instances 4096
+    python -m benchmarks.bench_padding --tasks mwm2D
+"""
+import argparse
+from collections import defaultdict
+import torch
+
+from spg.models import SPGSequentialActor, SPGMatchingActor
+from spg import inference
+import solve
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="Mixed-size padded batching benchmark")
+parser.add_argument('--tasks', type=str, nargs='+', default=['tsp', 'mwm2D'], choices=['tsp', 'mwm2D'])
+parser.add_argument('--min_nodes', type=int, default=10)
+parser.add_argument('--max_nodes', type=int, default=50)
+parser.add_argument('--n_instances', type=int, default=1024)
+parser.add_argument('--batch_size', type=int, default=128)
+parser.add_argument('--embedding_dim', type=int, default=128)
+parser.add_argument('--rnn_dim', type=int, default=128)
+parser.add_argument('--repeats', type=int, default=3)
+parser.add_argument('--warmup', type=int, default=1)
+common.add_common_args(parser, 'padding')
+
+def solver(args, cop, n_nodes):
+    d = solve.task_config({'task': '{}_{}'.format(cop, n_nodes), 'model': 'spg', 'n_features': 0,
+        'use_cuda': False, 'workers': 0})
+    if cop == 'mwm2D':
+        actor = SPGMatchingActor(2, n_nodes, args['embedding_dim'], args['rnn_dim'], num_workers=0, cuda=False)
+    else:
+        actor = SPGSequentialActor(2, n_nodes, args['embedding_dim'], args['rnn_dim'], num_workers=0, cuda=False)
+    return d, solve.spg_solver(d, inference.inference_actor(actor))
+
+def run_task(args, cop):
+    sizes = torch.randint(args['min_nodes'], args['max_nodes'] + 1, (args['n_instances'],)).tolist()
+    # an mwm2D instance is its two graphs of n nodes, one after the other
+    instances = [torch.rand(2 * n if cop == 'mwm2D' else n, 2) for n in sizes]
+    B = args['batch_size']
+
+    d, padded_solve = solver(args, cop, args['max_nodes'])
+    padded = [solve.collate(d, instances[i:i + B]) for i in range(0, len(instances), B)]
+    def run_padded():
+        for obs, lengths in padded:
+            padded_solve(obs, lengths)
+
+    by_size = sorted(instances, key=lambda x: x.size(0))
+    padded_sorted = [solve.collate(d, by_size[i:i + B]) for i in range(0, len(by_size), B)]
+    def run_padded_sorted():
+        for obs, lengths in padded_sorted:
+            padded_solve(obs, lengths)
+
+    buckets = defaultdict(list)
+    for x in instances:
+        buckets[x.size(0)].append(x)
+    bucket_solvers = dict([(n, solver(args, cop, n // 2 if cop == 'mwm2D' else n)[1]) for n in buckets])
+    bucketed = [(n, torch.stack(xs[i:i + B])) for n, xs in sorted(buckets.items()) for i in range(0, len(xs), B)]
+    def run_bucketed():
+        for n, obs in bucketed:
+            bucket_solvers[n](obs)
+
+    results = []
+    params = [('min_nodes', args['min_nodes']), ('max_nodes', args['max_nodes']),
+              ('n_instances', args['n_instances']), ('batch_size', B)]
+    prefix = 'mwm2D-' if cop == 'mwm2D' else ''
+    for name, fn, n_batches in [('padded', run_padded, len(padded)),
+            ('padded_sorted', run_padded_sorted, len(padded_sorted)), ('bucketed', run_bucketed, len(bucketed))]:
+        print(' [*] {}{}'.format(prefix, name))
+        t = common.time_fn(fn, args['repeats'], args['warmup'])
+        results.append(common.result(prefix + name, params, t, batches=n_batches,
+            instances_per_sec=1000. * args['n_instances'] / t['p50_ms']))
+    return results
+
+def main(args):
+    common.setup(args)
+    results = []
+    for cop in args['tasks']:
+        results += run_task(args, cop)
+    for r in results:
+        print('{:<20} {:6d} batches, p50: {:10.1f} ms, {:8.1f} instances/s'.format(
+            r['name'], r['batches'], r['p50_ms'], r['instances_per_sec']))
+    return common.finish(args, 'padding', results)
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
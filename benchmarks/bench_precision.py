@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Step time and convergence of train_spg.py in float32 and with
+--precision bf16, on sort-20 and mwm2D-10. Each run trains on synthetic
+data on the CPU, in its own process, with the same seed for both
+precisions. For each run it reports
+
+    * the step time and the mean time of the actor forward, critic update
+      and actor update phases, from the --profile JSON
+    * the actor and critic loss curves, averaged over --loss_bins bins of
+      learner phases, from the raw training stats
+    * the eval reward after every epoch, and the final and best of them
+
+Before training, a regression check runs an embedding and
+spg.layers.run_rnn under bf16 autocast, as the actors do, on a GRU and a
+bidirectional GRU, with and without packed lengths. It compares the outputs and the gradients of every GRU
+parameter with float32 and fails if a gradient is missing or off by more
+than --rnn_tolerance (relative).
+
+bfloat16 only pays off on CPUs with native bf16 matmul (e.g. AVX512-BF16
+or AMX); elsewhere it is emulated and slower than float32.
+
+Usage:
+    python -m benchmarks.bench_precision
+    python -m benchmarks.bench_precision --configs sort-20 --epochs 10 --steps_per_epoch 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import tempfile
+import subprocess
+from collections import OrderedDict
+import numpy as np
+import h5py
+import torch
+
+from spg.layers import run_rnn
+from benchmarks import common
+
+# name -> (task, extra args), as in the README
+CONFIGS = OrderedDict([
+    ('sort-20', ('sort_0-19', ['--arch', 'sequential', '--n_nodes', '20', '--n_features', '1'])),
+    ('mwm2D-10', ('mwm2D_10', ['--arch', 'matching', '--n_nodes', '10', '--n_features', '2'])),
+])
+PHASES = ['actor_forward', 'critic_update', 'actor_update']
+
+parser = argparse.ArgumentParser(description="bfloat16 vs. float32 SPG training benchmark")
+parser.add_argument('--configs', type=str, nargs='+', default=list(CONFIGS.keys()))
+parser.add_argument('--precisions', type=str, nargs='+', default=['fp32', 'bf16'])
+parser.add_argument('--epochs', type=int, default=5)
+parser.add_argument('--steps_per_epoch', type=int, default=200)
+parser.add_argument('--parallel_envs', type=int, default=32)
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--test_size', type=int, default=256)
+parser.add_argument('--loss_bins', type=int, default=20, help='Points of each loss curve')
+parser.add_argument('--rnn_tolerance', type=float, default=0.05, help='Relative error allowed in the bf16 GRU check')
+parser.add_argument('--timeout', type=int, default=3600, help='Seconds before a run is killed')
+parser.add_argument('--verbose', action='store_true', help='Show the output of each run')
+common.add_common_args(parser, 'precision')
+
+def rel_err(a, b):
+    return float((a.float() - b.float()).abs().max() / b.float().abs().max().clamp(min=1e-12))
+
+def rnn_check(args, bidirectional, packed):
+    """run_rnn in bf16 autocast vs. float32: relative error of the output and of each parameter's gradient"""
+    T, B, F, D, H = 20, 16, 2, 32, 64
+    # under autocast the embedding hands the GRU a bfloat16 input, as in the actors
+    embedding = torch.nn.Linear(F, D)
+    gru = torch.nn.GRU(D, H, bidirectional=bidirectional)
+    x = torch.randn(T, B, F)
+    hx = torch.zeros(2 if bidirectional else 1, B, H)
+    lengths = torch.randint(1, T + 1, (B,)) if packed else None
+    w = torch.randn(T, B, (2 if bidirectional else 1) * H)
+    out = OrderedDict()
+    for precision in ['fp32', 'bf16']:
+        gru.zero_grad(set_to_none=True)
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+            h, _ = run_rnn(gru, embedding(x), hx, lengths)
+        (h.float() * w).sum().backward()
+        out[precision] = (h.detach(), dict([(n, None if p.grad is None else p.grad.clone())
+            for n, p in gru.named_parameters()]))
+    h32, g32 = out['fp32']
+    h16, g16 = out['bf16']
+    missing = [n for n in g32 if g16[n] is None]
+    grad_err = max([rel_err(g16[n], g32[n]) for n in g32 if g16[n] is not None] + [0.])
+    params = [('bidirectional', bidirectional), ('packed', packed)]
+    ok = len(missing) == 0 and grad_err <= args['rnn_tolerance'] and bool(torch.isfinite(h16.float()).all())
+    return common.result('rnn_check', params, {}, output_rel_err=rel_err(h16, h32), grad_rel_err=grad_err,
+        missing_grads=missing, ok=ok)
+
+def loss_curve(losses, bins):
+    """losses averaged over at most bins consecutive chunks"""
+    if len(losses) == 0:
+        return []
+    return [float(np.mean(c)) for c in np.array_split(np.array(losses), min(bins, len(losses)))]
+
+def command(args, name, precision, run_id, base_dir):
+    task, extra = CONFIGS[name]
+    cmd = [sys.executable, os.path.join(common.REPO_DIR, 'train_spg.py'),
+           '--task', task,
+           '--synthetic', 'True',
+           '--precision', precision,
+           '--n_epochs', str(args['epochs']),
+           '--parallel_envs', str(args['parallel_envs']),
+           '--batch_size', str(args['batch_size']),
+           '--buffer_size', str(10 * args['steps_per_epoch'] * args['parallel_envs']),
+           '--train_size', str(args['steps_per_epoch'] * args['parallel_envs']),
+           '--test_size', str(args['test_size']),
+           '--random_seed', str(args['random_seed']),
+           '--actor_workers', '0',
+           '--replay_buffer_gpu', 'False',
+           '--use_cuda', 'False',
+           '--disable_tensorboard', 'True',
+           '--disable_progress_bar', 'True',
+           '--save_stats', 'True',
+           '--save_model', 'False',
+           '--profile', 'True',
+           '--profile_step', str(args['epochs'] * args['steps_per_epoch'] + 1),
+           '--log_step', str(args['steps_per_epoch']),
+           '--base_dir', base_dir,
+           '--_id', run_id]
+    return cmd + extra
+
+def run(args, name, precision, base_dir):
+    cop = CONFIGS[name][0].split('_')[0]
+    run_id = '{}-{}'.format(name, precision)
+    env = dict(os.environ)
+    if args['threads'] > 0:
+        env['OMP_NUM_THREADS'] = str(args['threads'])
+    start = time.time()
+    out = None if args['verbose'] else subprocess.DEVNULL
+    subprocess.check_call(command(args, name, precision, run_id, base_dir), cwd=common.REPO_DIR, env=env,
+            stdout=out, stderr=subprocess.STDOUT, timeout=args['timeout'])
+    wall = time.time() - start
+    with open(os.path.join(base_dir, 'results', 'profile', 'spg', cop, run_id, 'phases.json'), 'r') as f:
+        summary = json.load(f)['latest']
+    with open(os.path.join(base_dir, 'results', 'fglab', 'spg', cop, run_id, 'scores.json'), 'r') as f:
+        scores = json.load(f)['_scores']
+    with h5py.File(os.path.join(base_dir, 'results', 'raw', 'spg', cop, run_id, 'raw.hdf5'), 'r') as f:
+        actor_loss = f['actor_loss'][()]
+        critic_loss = f['critic_loss'][()]
+    evals = [v for _, v in sorted([(int(k.split('_')[-1]), v) for k, v in scores.items()
+        if k.startswith('eval_avg_reward_')])]
+    steps_per_sec = summary['instances_per_sec'] / args['parallel_envs']
+    metrics = OrderedDict([
+        ('step_ms', 1000. / steps_per_sec if steps_per_sec > 0 else None),
+        ('phases', OrderedDict([(k, summary['phases'][k]['mean_ms']) for k in PHASES if k in summary['phases']])),
+        ('actor_loss_curve', loss_curve(actor_loss, args['loss_bins'])),
+        ('critic_loss_curve', loss_curve(critic_loss, args['loss_bins'])),
+        ('eval_rewards', evals),
+        ('final_eval_reward', evals[-1]),
+        ('best_eval_reward', max(evals)),
+        ('wall_s', wall)])
+    params = [('task', CONFIGS[name][0]), ('precision', precision), ('epochs', args['epochs']),
+        ('steps_per_epoch', args['steps_per_epoch'])]
+    return common.result(name, params, {}, **metrics)
+
+def main(args):
+    common.setup(args)
+    for name in args['configs']:
+        if name not in CONFIGS:
+            print(' [!] unknown config {}, choose from {}'.format(name, list(CONFIGS.keys())))
+            return 1
+    results = []
+    failed = False
+    for bidirectional in [False, True]:
+        for packed in [False, True]:
+            r = rnn_check(args, bidirectional, packed)
+            print(' [*] bf16 GRU check, bidirectional: {}, packed: {}: output rel. err {:.4f}, grad rel. err {:.4f}{}'.format(
+                bidirectional, packed, r['output_rel_err'], r['grad_rel_err'], '' if r['ok'] else ' <-- FAILED'))
+            failed = failed or not r['ok']
+            results.append(r)
+    base_dir = tempfile.mkdtemp()
+    try:
+        for name in args['configs']:
+            for precision in args['precisions']:
+                print(' [*] running {}, {}'.format(name, precision))
+                try:
+                    results.append(run(args, name, precision, base_dir))
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                    print(' [!] {} failed, rerun with --verbose to see its output'.format(name))
+    finally:
+        shutil.rmtree(base_dir)
+    print('{:<10} {:>9} {:>10} {:>12} {:>12}'.format('task', 'precision', 'step ms', 'final eval', 'best eval'))
+    for r in results:
+        if r['name'] == 'rnn_check':
+            continue
+        print('{:<10} {:>9} {:>10.2f} {:>12.4f} {:>12.4f}'.format(r['name'], r['params']['precision'],
+            r['step_ms'], r['final_eval_reward'], r['best_eval_reward']))
+    code = common.finish(args, 'precision', results, metric='step_ms')
+    if failed:
+        print(' [!] the bf16 GRU check failed')
+        return 1
+    return code
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Accuracy, latency and model size of dynamic int8 quantization for CPU
+inference. For each task, the float32 and the int8 model solve the same
+test set, and the task metric is reported for both: the Kendall-Tau
+correlation for sort, the ratio to the optimal matching weight for mwm2D,
+and the tour length for tsp. Also reports the fraction of instances where
+both models return the same permutation, the p50 latency of the model
+forward pass and of solving (forward, rounding and scoring) one batch,
+and the size of the serialized state dict.
+
+SPG actors quantize the Linear and GRU layers, NCO models the Linear,
+LSTM and LSTMCell layers. Sinkhorn stays in float.
+
+The models are randomly initialized unless --load_path points to a model
+saved by train_spg.py or train_nco.py (with a single --tasks and --models),
+so the metrics are only meaningful for trained models; the agreement,
+latencies and sizes are not affected.
+
+Usage:
+    python -m benchmarks.bench_quantize
+    python -m benchmarks.bench_quantize --tasks tsp_20 --models spg --load_path actor-epoch-1.pt
+"""
+import argparse
+import io
+import torch
+
+from spg.models import SPGSequentialActor, SPGMatchingActor
+from spg import inference as spg_inference
+from spg.util import str2bool
+from neural_combinatorial_rl.neural_combinatorial_rl import NeuralCombOptRL
+from neural_combinatorial_rl.matching_nco import MatchingNeuralCombOptRL
+from neural_combinatorial_rl import inference as nco_inference
+from envs import dataset
+import solve
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="Dynamic int8 quantization benchmark")
+parser.add_argument('--tasks', type=str, nargs='+', default=['sort_0-19', 'mwm2D_10', 'tsp_20'])
+parser.add_argument('--models', type=str, nargs='+', default=['spg', 'nco'], choices=['spg', 'nco'])
+parser.add_argument('--test_size', type=int, default=512)
+parser.add_argument('--batch_size', type=int, default=128)
+parser.add_argument('--embedding_dim', type=int, default=128)
+parser.add_argument('--hidden_dim', type=int, default=128, help='rnn_dim of the SPG actors, hidden_dim of the NCO models')
+parser.add_argument('--load_path', type=str, default='')
+parser.add_argument('--synthetic', type=str2bool, default=True, help='Generate the test sets in memory, as train_*.py --synthetic True')
+parser.add_argument('--repeats', type=int, default=10)
+parser.add_argument('--warmup', type=int, default=2)
+common.add_common_args(parser, 'quantize')
+
+def test_set(args, task, model):
+    """The test set the training scripts would use for the task"""
+    d = {'task': task, 'COP': task.split('_')[0], 'model': model, 'arch': 'sequential',
+         'random_seed': args['random_seed'], 'synthetic': args['synthetic'],
+         'train_size': 1, 'test_size': args['test_size'], 'val_size': 0,
+         'parallel_envs': args['batch_size'], 'num_workers': 0, 'sl': False, 'make_only': 3}
+    _, _, _, test_dataloader = dataset.build(d, 0)
+    x = torch.stack([test_dataloader.dataset[i] for i in range(len(test_dataloader.dataset))])
+    opt = None
+    if d['COP'] == 'mwm2D':
+        opt = float(test_dataloader.dataset.get_average_optimal_weight())
+    return x.float(), opt
+
+def build(args, d):
+    if args['load_path'] != '':
+        print(' [*] Loading model from {}'.format(args['load_path']))
+        return torch.load(args['load_path'], map_location='cpu', weights_only=False)
+    E, H = args['embedding_dim'], args['hidden_dim']
+    if d['model'] == 'spg':
+        if d['COP'] == 'mwm2D':
+            return SPGMatchingActor(d['n_features'], d['n_nodes'], E, H, cuda=False)
+        return SPGSequentialActor(d['n_features'], d['n_nodes'], E, H, cuda=False)
+    if d['COP'] == 'mwm2D':
+        return MatchingNeuralCombOptRL(d['n_nodes'], d['n_features'], E, H, d['n_nodes'], '<0>',
+                1, 3, 10., True, 1, False, False)
+    return NeuralCombOptRL(d['n_features'], E, H, d['n_nodes'], '<0>', 1, 3, 10., True, 1, False, False)
+
+def solvers(args, d):
+    """
+    Returns (precision, forward(obs), solve(obs), size in bytes) for the
+    float32 and the int8 model
+    """
+    model = build(args, d)
+    if d['model'] == 'spg':
+        model.init_hx = model.init_hx.cpu()
+        fp32 = spg_inference.inference_actor(model)
+        int8 = spg_inference.inference_actor(model, quantized=True)
+        make_solver = solve.spg_solver
+        forward = lambda m: m
+    else:
+        fp32 = model
+        int8 = nco_inference.quantize(model)
+        make_solver = solve.nco_solver
+        forward = lambda m: lambda obs: m(torch.transpose(obs, 2, 1))
+    return [(name, forward(m), make_solver(d, m), state_dict_size(m))
+            for name, m in [('fp32', fp32), ('int8', int8)]]
+
+def state_dict_size(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+def metric(d, R, opt):
+    """The task metric from the rewards returned by the solvers (higher is better)"""
+    if d['COP'] == 'sort':
+        return 'kendall_tau', float(R.mean())
+    if d['COP'] == 'mwm2D':
+        return 'optimality_ratio', float(R.mean()) / opt
+    return 'tour_length', -float(R.mean())
+
+def main(args):
+    common.setup(args)
+    if args['load_path'] != '' and (len(args['tasks']) > 1 or len(args['models']) > 1):
+        print(' [!] --load_path needs a single --tasks and --models')
+        return 1
+    results = []
+    for task in args['tasks']:
+        for model in args['models']:
+            d = {'task': task, 'model': model, 'n_features': 0, 'use_cuda': False, 'workers': 0,
+                 'k': 1, 'decode_type': 'greedy', 'multistart': False, 'use_KT': True}
+            d = solve.task_config(d)
+            x, opt = test_set(args, task, model)
+            batches = x.split(args['batch_size'])
+            perms = {}
+            for precision, forward, solve_fn, size in solvers(args, d):
+                print(' [*] {} {}, {}'.format(model, task, precision))
+                R, P = zip(*[solve_fn(obs) for obs in batches])
+                perms[precision] = torch.cat(P)
+                name, value = metric(d, torch.cat(R), opt)
+                agreement = float((perms[precision] == perms['fp32']).all(1).float().mean())
+                with torch.no_grad():
+                    t = common.time_fn(lambda: forward(batches[0]), args['repeats'], args['warmup'])
+                t_solve = common.time_fn(lambda: solve_fn(batches[0]), args['repeats'], args['warmup'])
+                params = [('task', task), ('precision', precision), ('batch_size', batches[0].size(0))]
+                results.append(common.result(model, params, t, solve_p50_ms=t_solve['p50_ms'], metric=name,
+                    value=value, agreement=agreement, size_kb=size / 1024.))
+    print('{:<5} {:<10} {:<5} {:>17} {:>9} {:>10} {:>11} {:>11} {:>10}'.format(
+        'model', 'task', 'prec', 'metric', 'value', 'agreement', 'forward ms', 'solve ms', 'size kb'))
+    for r in results:
+        print('{:<5} {:<10} {:<5} {:>17} {:9.4f} {:10.3f} {:11.3f} {:11.3f} {:10.1f}'.format(
+            r['name'], r['params']['task'], r['params']['precision'], r['metric'], r['value'],
+            r['agreement'], r['p50_ms'], r['solve_p50_ms'], r['size_kb']))
+    extra = {'load_path': args['load_path'], 'test_size': args['test_size']}
+    return common.finish(args, 'quantize', results, extra)
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
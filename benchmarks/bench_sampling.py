@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Cost and yield of Gumbel-Sinkhorn sampling in an SPG rollout on tsp. For
+each number of samples S, the rollout of a batch either
+
+    * sample: runs actor.sample, i.e. the encoder once and one Sinkhorn
+      and one rounding call over [batch_size * S, N, N], or
+    * repeat: runs the actor S times on Gumbel-perturbed scores, one
+      copy of each instance per call, as a loop around actor() would
+
+and scores all the tours. Reports the rollout latency, and the mean gain
+in reward of the best of the S samples over the deterministic psi, on
+an untrained actor.
+
+Usage:
+    python -m benchmarks.bench_sampling
+    python -m benchmarks.bench_sampling --n_nodes 50 --n_samples 4 16
+"""
+import argparse
+import torch
+
+from spg.models import SPGSequentialActor, perturb_scores
+from envs import tsp_task
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="Gumbel-Sinkhorn sampling benchmark")
+parser.add_argument('--n_nodes', type=int, nargs='+', default=[20, 50])
+parser.add_argument('--n_samples', type=int, nargs='+', default=[4, 16])
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--embedding_dim', type=int, default=128)
+parser.add_argument('--rnn_dim', type=int, default=128)
+parser.add_argument('--sinkhorn_iters', type=int, default=10)
+parser.add_argument('--sinkhorn_tau', type=float, default=0.05)
+parser.add_argument('--gumbel_noise', type=float, default=1.)
+parser.add_argument('--repeats', type=int, default=5)
+parser.add_argument('--warmup', type=int, default=1)
+common.add_common_args(parser, 'sampling')
+
+def rewards(obs, perms):
+    """Rewards of [batch_size, N, N] perms, as in train_spg.py"""
+    tours = torch.transpose(torch.matmul(torch.transpose(obs, 1, 2), perms), 1, 2)
+    return tsp_task.reward_spg(tours, False).view(-1)
+
+def main(args):
+    common.setup(args)
+    results = []
+    B = args['batch_size']
+    for N in args['n_nodes']:
+        actor = SPGSequentialActor(2, N, args['embedding_dim'], args['rnn_dim'], True,
+            args['sinkhorn_iters'], args['sinkhorn_tau'], num_workers=0, cuda=False)
+        obs = torch.rand(B, N, 2)
+        with torch.no_grad():
+            _, perms = actor(obs)
+            R = rewards(obs, perms)
+        for S in args['n_samples']:
+            def sample():
+                with torch.no_grad():
+                    _, perms = actor.sample(obs, S, args['gumbel_noise'])
+                    return rewards(obs.repeat_interleave(S, 0), perms.view(-1, N, N)).view(B, S)
+
+            def repeat():
+                with torch.no_grad():
+                    out = []
+                    for _ in range(S):
+                        M, mask = actor.scores(obs)
+                        M, _ = perturb_scores(M, mask, 1, args['gumbel_noise'])
+                        _, perms = actor.normalize(M)
+                        out.append(rewards(obs, perms))
+                    return torch.stack(out, 1)
+            for name, fn in [('sample', sample), ('repeat', repeat)]:
+                print(' [*] {}, N: {}, n_samples: {}'.format(name, N, S))
+                t = common.time_fn(fn, args['repeats'], args['warmup'])
+                gain = float((fn().max(1)[0] - R).mean())
+                results.append(common.result(name, [('n_nodes', N), ('batch_size', B), ('n_samples', S)], t,
+                    best_gain=gain, mean_reward=float(R.mean())))
+    print('{:<8} {:>5} {:>9} {:>10} {:>12}'.format('mode', 'N', 'samples', 'p50 ms', 'best gain'))
+    for r in results:
+        print('{:<8} {:5d} {:9d} {:10.1f} {:12.4f}'.format(r['name'], r['params']['n_nodes'],
+            r['params']['n_samples'], r['p50_ms'], r['best_gain']))
+    extra = {'gumbel_noise': args['gumbel_noise'], 'sinkhorn_iters': args['sinkhorn_iters'],
+        'sinkhorn_tau': args['sinkhorn_tau']}
+    return common.finish(args, 'sampling', results, extra)
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
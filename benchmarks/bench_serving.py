@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Throughput and latency of serve.py under concurrent load. The server is
+started in-process on a free port with a randomly initialized SPG actor
+(or --load_path), and each of --concurrency client threads posts
+single-instance /solve requests back to back. Every level of concurrency
+is run with dynamic batching (--max_batch_size) and without it
+(max_batch_size 1), and reports requests/s, the client-side p50/p90/p99
+latency, and the server's mean batch size and queue depth.
+
+Usage:
+    python -m benchmarks.bench_serving
+    python -m benchmarks.bench_serving --task tsp_50 --concurrency 1 16 64
+"""
+import argparse
+import json
+import time
+import threading
+import urllib.request
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from spg.models import SPGSequentialActor
+from spg import inference
+import serve
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="SPG serving benchmark")
+parser.add_argument('--task', type=str, default='tsp_20')
+parser.add_argument('--load_path', type=str, default='')
+parser.add_argument('--embedding_dim', type=int, default=128)
+parser.add_argument('--rnn_dim', type=int, default=128)
+parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+parser.add_argument('--requests_per_client', type=int, default=50)
+parser.add_argument('--max_batch_size', type=int, default=64)
+parser.add_argument('--max_wait_ms', type=float, default=2.)
+parser.add_argument('--workers', type=int, default=0)
+parser.add_argument('--quantize', action='store_true', help='Serve the int8 quantized actor')
+parser.add_argument('--sinkhorn_memory_mb', type=float, default=0., help='Scratch memory budget of Sinkhorn in MB, as in serve.py; 0 for dense')
+common.add_common_args(parser, 'serving')
+
+def build_actor(args):
+    if args['load_path'] != '':
+        return serve.load_actor(args)
+    actor = SPGSequentialActor(args['n_features'], args['n_nodes'], args['embedding_dim'],
+            args['rnn_dim'], cuda=False)
+    return inference.inference_actor(actor, quantized=args['quantize'], sinkhorn_memory_mb=args['sinkhorn_memory_mb'])
+
+def client(url, instances, latencies):
+    for x in instances:
+        req = urllib.request.Request(url, data=json.dumps({'instance': x}).encode(),
+                headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+        latencies.append(time.perf_counter() - start)
+
+def run(args, psi_actor, max_batch_size, concurrency):
+    server_args = dict(args, host='127.0.0.1', port=0, unix_socket='', verbose=False,
+            max_batch_size=max_batch_size)
+    server, batcher = serve.make_server(server_args, psi_actor)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}/solve'.format(server.server_address[1])
+    shape = (args['requests_per_client'], server_args['n_inputs'], server_args['n_features'])
+    instances = [np.random.rand(*shape).tolist() for _ in range(concurrency)]
+    # warm up the actor and the connection handling
+    client(url, instances[0][:2], [])
+    latencies = [[] for _ in range(concurrency)]
+    clients = [threading.Thread(target=client, args=(url, instances[i], latencies[i]))
+            for i in range(concurrency)]
+    start = time.perf_counter()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.perf_counter() - start
+    stats = batcher.stats()
+    server.shutdown()
+    server.server_close()
+    batcher.close()
+    latencies = np.concatenate(latencies) * 1000.
+    return OrderedDict([
+        ('p50_ms', float(np.percentile(latencies, 50))),
+        ('p90_ms', float(np.percentile(latencies, 90))),
+        ('p99_ms', float(np.percentile(latencies, 99))),
+        ('requests', len(latencies))]), len(latencies) / elapsed, stats
+
+def main(args):
+    common.setup(args)
+    args['model'] = 'spg'
+    args['use_cuda'] = False
+    args['n_features'] = 0
+    args = serve.solve.task_config(args)
+    psi_actor = build_actor(args)
+    results = []
+    for concurrency in args['concurrency']:
+        for max_batch_size in [1, args['max_batch_size']]:
+            print(' [*] concurrency: {}, max batch size: {}'.format(concurrency, max_batch_size))
+            t, throughput, stats = run(args, psi_actor, max_batch_size, concurrency)
+            params = [('task', args['task']), ('concurrency', concurrency), ('max_batch_size', max_batch_size)]
+            results.append(common.result('serve', params, t, requests_per_sec=throughput,
+                mean_batch_size=stats['mean_batch_size'], mean_queue_depth=stats['mean_queue_depth'],
+                max_queue_depth=stats['max_queue_depth']))
+    for r in results:
+        print('{:<55} {:8.1f} req/s, p50/p90/p99: {:7.2f} / {:7.2f} / {:7.2f} ms, batch: {:5.1f}, queue: {:5.1f}'.format(
+            str(dict(r['params'])), r['requests_per_sec'], r['p50_ms'], r['p90_ms'], r['p99_ms'],
+            r['mean_batch_size'], r['mean_queue_depth']))
+    extra = {'load_path': args['load_path'], 'max_wait_ms': args['max_wait_ms'],
+             'requests_per_client': args['requests_per_client']}
+    return common.finish(args, 'serving', results, extra)
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Peak memory and latency of Sinkhorn without gradients: the dense layer
+vs. layers.chunked_sinkhorn under a scratch memory budget, over batch
+sizes and N. The peak is the growth of the resident set (VmHWM) while
+Sinkhorn runs in a fresh process, so it includes psi itself. The
+planned peak of the chunked mode (layers.sinkhorn_peak_bytes) is reported
+next to it. Linux only.
+
+Usage:
+    python -m benchmarks.bench_sinkhorn_memory
+    python -m benchmarks.bench_sinkhorn_memory --n_nodes 500 --batch_size 16 64 --memory_mb 4 64
+"""
+import argparse
+import multiprocessing
+import torch
+
+from spg.layers import Sinkhorn, chunked_sinkhorn, sinkhorn_peak_bytes
+import spg.util as util
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="Chunked Sinkhorn memory benchmark")
+parser.add_argument('--n_nodes', type=int, nargs='+', default=[100, 200])
+parser.add_argument('--batch_size', type=int, nargs='+', default=[32, 128, 512])
+parser.add_argument('--memory_mb', type=float, nargs='+', default=[4., 32.])
+parser.add_argument('--sinkhorn_iters', type=int, default=10)
+parser.add_argument('--sinkhorn_tau', type=float, default=0.05)
+parser.add_argument('--repeats', type=int, default=5)
+parser.add_argument('--warmup', type=int, default=1)
+common.add_common_args(parser, 'sinkhorn_memory')
+
+def _measure_peak(mode, B, N, tau, iters, max_bytes, seed):
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    x = torch.randn(B, N, N)
+    util.reset_peak_memory_usage()
+    before = util.memory_usage()
+    with torch.no_grad():
+        if mode == 'dense':
+            Sinkhorn(N, iters, tau)(x)
+        else:
+            chunked_sinkhorn(x, tau, iters, max_bytes)
+    return util.peak_memory_usage() - before
+
+def peak_mb(*args):
+    """
+    Growth of the peak RSS in MB while Sinkhorn runs, in a fresh process, as
+    the allocator of this one holds on to the memory of earlier runs
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_measure_peak, args)
+
+def main(args):
+    common.setup(args)
+    if not util.reset_peak_memory_usage():
+        print(' [!] cannot reset the peak RSS through /proc/self/clear_refs')
+        return 1
+    results = []
+    tau, iters = args['sinkhorn_tau'], args['sinkhorn_iters']
+    for N in args['n_nodes']:
+        sinkhorn = Sinkhorn(N, iters, tau)
+        for B in args['batch_size']:
+            x = torch.randn(B, N, N)
+            with torch.no_grad():
+                dense = sinkhorn(x)
+            psi_mb = dense.numel() * dense.element_size() / 1e6
+            del dense
+
+            def run_dense():
+                with torch.no_grad():
+                    sinkhorn(x)
+            print(' [*] dense, N: {}, batch_size: {}'.format(N, B))
+            t = common.time_fn(run_dense, args['repeats'], args['warmup'])
+            results.append(common.result('dense', [('n_nodes', N), ('batch_size', B)], t,
+                peak_mb=peak_mb('dense', B, N, tau, iters, 0, args['random_seed']), planned_peak_mb=None, psi_mb=psi_mb))
+            for mb in args['memory_mb']:
+                max_bytes = int(mb * 1e6)
+                run_chunked = lambda: chunked_sinkhorn(x, tau, iters, max_bytes)
+                print(' [*] chunked, N: {}, batch_size: {}, memory_mb: {}'.format(N, B, mb))
+                t = common.time_fn(run_chunked, args['repeats'], args['warmup'])
+                results.append(common.result('chunked', [('n_nodes', N), ('batch_size', B), ('memory_mb', mb)], t,
+                    peak_mb=peak_mb('chunked', B, N, tau, iters, max_bytes, args['random_seed']), planned_peak_mb=sinkhorn_peak_bytes(B, N, max_bytes) / 1e6,
+                    psi_mb=psi_mb))
+    print('{:<8} {:>5} {:>6} {:>7} {:>10} {:>10} {:>12} {:>8}'.format(
+        'mode', 'N', 'batch', 'budget', 'p50 ms', 'peak MB', 'planned MB', 'psi MB'))
+    for r in results:
+        planned = r['planned_peak_mb']
+        print('{:<8} {:5d} {:6d} {:>7} {:10.1f} {:10.1f} {:>12} {:8.1f}'.format(
+            r['name'], r['params']['n_nodes'], r['params']['batch_size'], r['params'].get('memory_mb', '-'),
+            r['p50_ms'], r['peak_mb'], '-' if planned is None else '{:.1f}'.format(planned), r['psi_mb']))
+    extra = {'sinkhorn_iters': iters, 'sinkhorn_tau': tau}
+    return common.finish(args, 'sinkhorn_memory', results, extra)
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Dense vs. sparse Sinkhorn + rounding on large mwm2D instances. The scores
+are the edge lengths (what a trained matching actor learns to favour, as
+mwm2D maximizes the total edge length), scaled by --score_scale. Dense
+runs spg.layers.Sinkhorn on [batch_size, N, N] and rounds with the
+Hungarian method. Sparse restricts each node to its k farthest nodes
+(util.knn_support), runs layers.sparse_sinkhorn on that support and rounds
+greedily on the support (util.sparse_matching).
+
+Reports the p50 latency of Sinkhorn + rounding without gradients, the
+memory autograd saves for the backward pass of Sinkhorn, the size of the
+support, the number of instances whose kNN graph needed patching to have
+a perfect matching, and the matching weight as a fraction of the optimal
+(maximum weight) matching.
+
+For sparse, two references split that loss between the support and the
+rounding, both as fractions of the optimal matching and computed outside
+the timing with the dense Hungarian method, pairs outside the support
+being ruled out:
+
+    * support_ratio: the maximum weight matching restricted to the
+      (patched) kNN support, the best any rounding on it can do
+    * hungarian_ratio: Hungarian rounding of the sparse psi, the rounding
+      the greedy one (optimality_ratio) stands in for
+
+Usage:
+    python -m benchmarks.bench_sparse
+    python -m benchmarks.bench_sparse --n_nodes 1000 --k 5 10 20
+"""
+import argparse
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+
+from spg.layers import Sinkhorn, sparse_sinkhorn
+import spg.util as util
+from benchmarks import common
+
+parser = argparse.ArgumentParser(description="Sparse kNN Sinkhorn benchmark")
+parser.add_argument('--n_nodes', type=int, nargs='+', default=[200, 500, 1000])
+parser.add_argument('--k', type=int, nargs='+', default=[10, 20])
+parser.add_argument('--batch_size', type=int, default=4)
+parser.add_argument('--sinkhorn_iters', type=int, default=10)
+parser.add_argument('--sinkhorn_tau', type=float, default=0.05)
+parser.add_argument('--score_scale', type=float, default=1.)
+parser.add_argument('--repeats', type=int, default=3)
+parser.add_argument('--warmup', type=int, default=1)
+common.add_common_args(parser, 'sparse')
+
+def saved_bytes(fn):
+    """Bytes of the tensors autograd saves for backward while running fn"""
+    total = [0]
+    def pack(t):
+        total[0] += t.numel() * t.element_size()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        fn()
+    return total[0]
+
+def weights(C, perms):
+    """Matching weight of the [batch_size, N, N] perms on the edge lengths C"""
+    return (C * perms).sum(2).sum(1)
+
+def support_matching(values, ids, B, N):
+    """
+    [B, N, N] permutations that maximize the total of values on the support
+    ids, by the Hungarian method, never using a pair outside the support
+    """
+    # below any sum of N entries on the support
+    outside = -(N * float(np.abs(values).max()) + 1.)
+    dense = np.full(B * N * N, outside)
+    dense[ids] = values
+    dense = dense.reshape(B, N, N)
+    perms = torch.zeros(B, N, N)
+    for b in range(B):
+        row_idxs, col_idxs = linear_sum_assignment(-dense[b])
+        perms[b, row_idxs, col_idxs] = 1
+    return perms
+
+def main(args):
+    common.setup(args)
+    results = []
+    B = args['batch_size']
+    tau, iters = args['sinkhorn_tau'], args['sinkhorn_iters']
+    for N in args['n_nodes']:
+        g1 = torch.rand(B, N, 2)
+        g2 = torch.rand(B, N, 2)
+        # rows are G2, cols are G1, as in SPGMatchingActor
+        C = torch.cdist(g2, g1)
+        M = args['score_scale'] * C
+        opt = torch.tensor([C[b].numpy()[linear_sum_assignment(-C[b].numpy())].sum() for b in range(B)])
+        sinkhorn = Sinkhorn(N, iters, tau)
+
+        def dense():
+            with torch.no_grad():
+                psi = sinkhorn(M)
+            return util.round_to_permutations(psi.numpy())
+        print(' [*] dense, N: {}'.format(N))
+        t = common.time_fn(dense, args['repeats'], args['warmup'])
+        M_grad = M.clone().requires_grad_()
+        mem = saved_bytes(lambda: sinkhorn(M_grad))
+        ratio = float((weights(C, dense()) / opt).mean())
+        results.append(common.result('dense', [('n_nodes', N), ('batch_size', B)], t,
+            support=N * N, saved_mb=mem / 1e6, patched=0, optimality_ratio=ratio))
+
+        for k in args['k']:
+            def sparse():
+                ids, rows, cols, n_patched = util.knn_support(g2, g1, k, largest=True)
+                with torch.no_grad():
+                    values = sparse_sinkhorn(M.reshape(-1)[ids], rows, cols, B * N, tau, iters)
+                perms, _ = util.round_sparse_to_permutations(values.numpy(), ids.numpy(), B, N)
+                return perms, len(ids), n_patched
+            print(' [*] sparse, N: {}, k: {}'.format(N, k))
+            t = common.time_fn(sparse, args['repeats'], args['warmup'])
+            perms, support, n_patched = sparse()
+            ids, rows, cols, _ = util.knn_support(g2, g1, k, largest=True)
+            mem = saved_bytes(lambda: sparse_sinkhorn(M_grad.reshape(-1)[ids], rows, cols, B * N, tau, iters))
+            ratio = float((weights(C, perms) / opt).mean())
+            with torch.no_grad():
+                values = sparse_sinkhorn(M.reshape(-1)[ids], rows, cols, B * N, tau, iters)
+            support_ratio = float((weights(C, support_matching(C.reshape(-1)[ids].numpy(), ids.numpy(), B, N)) / opt).mean())
+            hungarian_ratio = float((weights(C, support_matching(values.numpy(), ids.numpy(), B, N)) / opt).mean())
+            results.append(common.result('sparse', [('n_nodes', N), ('batch_size', B), ('k', k)], t,
+                support=support / B, saved_mb=mem / 1e6, patched=n_patched, optimality_ratio=ratio,
+                support_ratio=support_ratio, hungarian_ratio=hungarian_ratio))
+    print('{:<8} {:>6} {:>4} {:>12} {:>10} {:>12} {:>8} {:>8} {:>8} {:>9}'.format(
+        'mode', 'N', 'k', 'support', 'p50 ms', 'saved MB', 'patched', 'ratio', 'support', 'hungarian'))
+    for r in results:
+        print('{:<8} {:6d} {:>4} {:12.0f} {:10.1f} {:12.2f} {:8d} {:8.4f} {:>8} {:>9}'.format(
+            r['name'], r['params']['n_nodes'], r['params'].get('k', '-'), r['support'], r['p50_ms'],
+            r['saved_mb'], r['patched'], r['optimality_ratio'],
+            '{:.4f}'.format(r['support_ratio']) if 'support_ratio' in r else '-',
+            '{:.4f}'.format(r['hungarian_ratio']) if 'hungarian_ratio' in r else '-'))
+    extra = {'sinkhorn_iters': iters, 'sinkhorn_tau': tau, 'score_scale': args['score_scale']}
+    return common.finish(args, 'sparse', results, extra)
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
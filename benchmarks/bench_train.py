@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+End-to-end training throughput of train_spg.py and train_nco.py.
+
+Each configuration trains for a fixed number of steps on synthetic data
+generated in memory (--synthetic True), on the CPU and without tensorboard,
+in its own process. The numbers are read back from the --profile JSON:
+
+    * steps/s and instances/s
+    * peak RSS
+    * time to first step (from the start of the training loop setup)
+
+Usage:
+    python -m benchmarks.bench_train
+    python -m benchmarks.bench_train --configs spg-sort nco-tsp --max_steps 100
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+from benchmarks import common
+
+# name -> (script, task, extra args). SPG's matching arch only applies
+# to bipartite inputs, so it is run on mwm2D and the sequential arch on sort and tsp
+CONFIGS = OrderedDict([
+    ('spg-sort', ('train_spg.py', 'sort_0-9', ['--arch', 'sequential', '--n_nodes', '10', '--n_features', '1'])),
+    ('spg-tsp', ('train_spg.py', 'tsp_10', ['--arch', 'sequential', '--n_nodes', '10', '--n_features', '2'])),
+    ('spg-mwm2D', ('train_spg.py', 'mwm2D_10', ['--arch', 'matching', '--n_nodes', '10', '--n_features', '2'])),
+    ('nco-sort', ('train_nco.py', 'sort_0-9', ['--input_size', '10', '--n_features', '1', '--use_decoder', 'True'])),
+    ('nco-tsp', ('train_nco.py', 'tsp_10', ['--input_size', '10', '--n_features', '2', '--use_decoder', 'True'])),
+    ('nco-mwm2D', ('train_nco.py', 'mwm2D_10', ['--input_size', '10', '--n_features', '2', '--use_decoder', 'True'])),
+    ('nco-mwm2D-no-decoder', ('train_nco.py', 'mwm2D_10', ['--input_size', '10', '--n_features', '2', '--use_decoder', 'False'])),
+])
+
+parser = argparse.ArgumentParser(description="End-to-end training throughput benchmark")
+parser.add_argument('--configs', type=str, nargs='+', default=list(CONFIGS.keys()))
+parser.add_argument('--max_steps', type=int, default=50)
+parser.add_argument('--parallel_envs', type=int, default=32)
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--test_size', type=int, default=64)
+parser.add_argument('--actor_workers', type=int, default=0, help='SPG rounding pool size')
+parser.add_argument('--timeout', type=int, default=1800, help='Seconds before a run is killed')
+parser.add_argument('--verbose', action='store_true', help='Show the output of each run')
+common.add_common_args(parser, 'train')
+
+def command(args, name, base_dir):
+    script, task, extra = CONFIGS[name]
+    cmd = [sys.executable, os.path.join(common.REPO_DIR, script),
+           '--task', task,
+           '--synthetic', 'True',
+           '--max_steps', str(args['max_steps']),
+           '--n_epochs', '1',
+           '--parallel_envs', str(args['parallel_envs']),
+           '--batch_size', str(args['batch_size']),
+           '--train_size', str(args['max_steps'] * args['parallel_envs']),
+           '--random_seed', str(args['random_seed']),
+           '--use_cuda', 'False',
+           '--disable_tensorboard', 'True',
+           '--disable_progress_bar', 'True',
+           '--save_stats', 'False',
+           '--save_model', 'False',
+           '--profile', 'True',
+           '--profile_step', str(args['max_steps']),
+           '--log_step', str(args['max_steps'] + 1),
+           '--base_dir', base_dir,
+           '--_id', name]
+    if script == 'train_spg.py':
+        cmd += ['--test_size', str(args['test_size']),
+                '--actor_workers', str(args['actor_workers']),
+                '--buffer_size', str(10 * args['max_steps'] * args['parallel_envs']),
+                '--replay_buffer_gpu', 'False']
+    else:
+        cmd += ['--val_size', str(args['test_size'])]
+    return cmd + extra
+
+def run(args, name, base_dir):
+    script, task, _ = CONFIGS[name]
+    model = 'spg' if script == 'train_spg.py' else 'nco'
+    env = dict(os.environ)
+    if args['threads'] > 0:
+        env['OMP_NUM_THREADS'] = str(args['threads'])
+    start = time.time()
+    out = None if args['verbose'] else subprocess.DEVNULL
+    subprocess.check_call(command(args, name, base_dir), cwd=common.REPO_DIR, env=env,
+            stdout=out, stderr=subprocess.STDOUT, timeout=args['timeout'])
+    wall = time.time() - start
+    profile_path = os.path.join(base_dir, 'results', 'profile', model, task.split('_')[0], name, 'phases.json')
+    with open(profile_path, 'r') as f:
+        summary = json.load(f)['latest']
+    steps_per_sec = summary['instances_per_sec'] / args['parallel_envs']
+    metrics = OrderedDict([
+        ('step_ms', 1000. / steps_per_sec if steps_per_sec > 0 else None),
+        ('steps_per_sec', steps_per_sec),
+        ('instances_per_sec', summary['instances_per_sec']),
+        ('peak_rss_mb', summary['peak_rss_mb']),
+        ('time_to_first_step', summary['time_to_first_step']),
+        ('wall_s', wall),
+        ('steps', summary['steps']),
+        ('phases', OrderedDict([(k, v['mean_ms']) for k, v in summary['phases'].items()]))])
+    params = [('task', task), ('max_steps', args['max_steps']), ('parallel_envs', args['parallel_envs'])]
+    return common.result(name, params, {}, **metrics)
+
+def main(args):
+    common.setup(args)
+    results = []
+    for name in args['configs']:
+        if name not in CONFIGS:
+            print(' [!] unknown config {}, choose from {}'.format(name, list(CONFIGS.keys())))
+            return 1
+    base_dir = tempfile.mkdtemp()
+    try:
+        for name in args['configs']:
+            print(' [*] running {}'.format(name))
+            try:
+                r = run(args, name, base_dir)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                print(' [!] {} failed, rerun with --verbose to see its output'.format(name))
+                results.append(common.result(name, [('task', CONFIGS[name][1]), ('max_steps', args['max_steps']),
+                    ('parallel_envs', args['parallel_envs'])], {}, error=str(e)))
+                continue
+            print('    {:.2f} steps/s, {:.1f} instances/s, peak rss: {:.1f} MB, time to first step: {:.2f} s'.format(
+                r['steps_per_sec'], r['instances_per_sec'], r['peak_rss_mb'], r['time_to_first_step']))
+            results.append(r)
+    finally:
+        shutil.rmtree(base_dir)
+    return common.finish(args, 'train', results, metric='step_ms')
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,170 @@
+"""
+Shared helpers for the benchmark scripts: timing, environment
+metadata, and reading/writing/comparing result files
+"""
+import os
+import json
+import time
+import platform
+import subprocess
+from collections import OrderedDict
+import numpy as np
+import torch
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+def sync(use_cuda):
+    if use_cuda:
+        torch.cuda.synchronize()
+
+def time_fn(fn, repeats=20, warmup=3, use_cuda=False, setup=None):
+    """
+    Time fn() over repeats calls after warmup calls.
+
+    Args:
+        fn: callable taking no arguments, or the output of setup() if given
+        setup: optional callable run (untimed) before each call of fn
+    Returns:
+        dict of timings in milliseconds
+    """
+    times = []
+    for i in range(warmup + repeats):
+        arg = setup() if setup is not None else None
+        sync(use_cuda)
+        start = time.perf_counter()
+        if setup is not None:
+            fn(arg)
+        else:
+            fn()
+        sync(use_cuda)
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000.
+    return OrderedDict([
+        ('mean_ms', float(np.mean(times))),
+        ('p50_ms', float(np.percentile(times, 50))),
+        ('min_ms', float(np.min(times))),
+        ('std_ms', float(np.std(times))),
+        ('repeats', repeats)])
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def environment_metadata():
+    meta = OrderedDict()
+    meta['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    meta['git_revision'] = git_revision()
+    meta['python'] = platform.python_version()
+    meta['platform'] = platform.platform()
+    meta['processor'] = platform.processor()
+    meta['cpu_count'] = os.cpu_count()
+    meta['torch'] = torch.__version__
+    meta['torch_threads'] = torch.get_num_threads()
+    meta['numpy'] = np.__version__
+    try:
+        import scipy
+        meta['scipy'] = scipy.__version__
+    except ImportError:
+        meta['scipy'] = None
+    meta['cuda'] = torch.cuda.is_available()
+    if meta['cuda']:
+        meta['cuda_device'] = torch.cuda.get_device_name(0)
+    return meta
+
+def result(name, params, timings, **metrics):
+    """
+    A single benchmark result. name and params identify it
+    when comparing against a baseline
+    """
+    r = OrderedDict()
+    r['name'] = name
+    r['params'] = OrderedDict(params)
+    r.update(timings)
+    r.update(metrics)
+    return r
+
+def result_key(r):
+    return (r['name'],) + tuple(sorted(r['params'].items()))
+
+def write_results(path, name, results, extra=None):
+    out = OrderedDict()
+    out['benchmark'] = name
+    out['metadata'] = environment_metadata()
+    if extra is not None:
+        out.update(extra)
+    out['results'] = results
+    d = os.path.dirname(path)
+    if d != '' and not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=2)
+    print(' [*] wrote {} results to {}'.format(len(results), path))
+    return out
+
+def compare_to_baseline(results, baseline_path, tolerance=0.2, metric='p50_ms'):
+    """
+    Compare results against a stored baseline file. A result regresses
+    if its metric is more than (1 + tolerance) times the baseline's.
+
+    Returns:
+        list of (key, baseline, current, ratio) for the regressions
+    """
+    if not os.path.exists(baseline_path):
+        print(' [!] no baseline at {}, run with --update_baseline to create one'.format(baseline_path))
+        return []
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    meta = environment_metadata()
+    for k in ['processor', 'cpu_count', 'torch', 'torch_threads']:
+        if baseline['metadata'].get(k) != meta[k]:
+            print(' [!] baseline was recorded with {}={}, now {}={}; timings may not be comparable'.format(
+                k, baseline['metadata'].get(k), k, meta[k]))
+    base = dict([(result_key(r), r) for r in baseline['results'] if r.get(metric) is not None])
+    regressions = []
+    print('{:<60} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for r in results:
+        key = result_key(r)
+        if r.get(metric) is None or key not in base:
+            continue
+        b = base[key][metric]
+        ratio = r[metric] / b if b > 0 else float('inf')
+        flag = ''
+        if ratio > 1. + tolerance:
+            flag = ' <-- regression'
+            regressions.append((key, b, r[metric], ratio))
+        name = key[0] + ' ' + ', '.join(['{}={}'.format(k, v) for k, v in key[1:]])
+        print('{:<60} {:>12.3f} {:>12.3f} {:>8.2f}{}'.format(name[:60], b, r[metric], ratio, flag))
+    print(' [*] {} regressions beyond {:.0f}% against {}'.format(len(regressions), 100 * tolerance, baseline_path))
+    return regressions
+
+def add_common_args(parser, name):
+    parser.add_argument('--output', type=str, default=os.path.join(BENCH_DIR, 'results', '{}.json'.format(name)))
+    parser.add_argument('--baseline', type=str, default=os.path.join(BENCH_DIR, 'baselines', '{}.json'.format(name)))
+    parser.add_argument('--update_baseline', action='store_true', help='Write the results to the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown vs. baseline')
+    parser.add_argument('--fail_on_regression', action='store_true')
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 leaves the default')
+    parser.add_argument('--random_seed', type=int, default=1234)
+    return parser
+
+def setup(args):
+    if args['threads'] > 0:
+        torch.set_num_threads(args['threads'])
+    torch.manual_seed(args['random_seed'])
+    np.random.seed(args['random_seed'])
+
+def finish(args, name, results, extra=None, metric='p50_ms'):
+    """Write results, then update or compare against the baseline on metric"""
+    write_results(args['output'], name, results, extra)
+    if args['update_baseline']:
+        write_results(args['baseline'], name, results, extra)
+        return 0
+    regressions = compare_to_baseline(results, args['baseline'], args['tolerance'], metric)
+    if regressions and args['fail_on_regression']:
+        return 1
+    return 0
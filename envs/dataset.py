@@ -3,26 +3,40 @@ from envs import sorting_task
 from envs import mwm2D_task
 from envs import tsp_task
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 def build(args, epoch):
     # Task specific configuration - generate dataset if needed
     args['data_dir'] = os.path.join('data', args['COP'])
     task = args['task'].split('_')
+    # generate the data in memory instead of on disk, e.g. for benchmarking
+    synthetic = args.get('synthetic', False)
+    train_seed = int(args['random_seed']) + epoch
+    # the test set stays the same across epochs
+    test_seed = int(args['random_seed']) - 1
+    # in data-parallel training only rank 0 evaluates
+    with_test = args.get('rank', 0) == 0
 
     if args['COP'] == 'sort':
         sort_range = task[1].split('-')
         args['sort_low'] = int(sort_range[0])
         args['sort_high'] = int(sort_range[1])
-        train_fname, test_fname = sorting_task.create_dataset(
-            args['train_size'],
-            args['test_size'],
-            args['data_dir'],
-            epoch,
-            low=args['sort_low'],
-            high=args['sort_high'],
-            random_seed=args['random_seed'])
-        training_dataset = sorting_task.SortingDataset(train_fname, use_graph=False)
-        test_dataset = sorting_task.SortingDataset(test_fname, use_graph=False)
+        if synthetic:
+            training_dataset = sorting_task.SyntheticSortingDataset(args['train_size'],
+                args['sort_low'], args['sort_high'], random_seed=train_seed)
+            test_dataset = sorting_task.SyntheticSortingDataset(args['test_size'],
+                args['sort_low'], args['sort_high'], random_seed=test_seed) if with_test else None
+        else:
+            train_fname, test_fname = sorting_task.create_dataset(
+                args['train_size'],
+                args['test_size'],
+                args['data_dir'],
+                epoch,
+                low=args['sort_low'],
+                high=args['sort_high'],
+                random_seed=args['random_seed'])
+            training_dataset = sorting_task.SortingDataset(train_fname, use_graph=False)
+            test_dataset = sorting_task.SortingDataset(test_fname, use_graph=False) if with_test else None
         if args['model'] == 'nco':
             env = sorting_task.reward_nco
         else:
@@ -31,18 +45,25 @@ def build(args, epoch):
         N = task[1]
         if not 'val_size' in args:
             args['val_size'] = 0
-        train_dir, val_dir, test_dir = mwm2D_task.create_dataset(
-            args['train_size'],
-            args['val_size'],
-            args['test_size'],
-            args['data_dir'],
-            N=int(N),
-            maximal=False,
-            random_seed=args['random_seed'],
-            sl=args['sl'],
-            only=args['make_only'])
-        test_dataset = mwm2D_task.MWM2DDataset(test_dir, args['test_size'], has_labels=args['sl'], sl=args['sl'])           
-        training_dataset = mwm2D_task.MWM2DDataset(train_dir, args['train_size'], has_labels=args['sl'], sl=args['sl'])
+        if synthetic:
+            # no labels, so only for RL
+            training_dataset = mwm2D_task.SyntheticMWM2DDataset(args['train_size'], int(N), random_seed=train_seed)
+            test_dataset = mwm2D_task.SyntheticMWM2DDataset(args['test_size'], int(N), random_seed=test_seed) \
+                if with_test else None
+        else:
+            train_dir, val_dir, test_dir = mwm2D_task.create_dataset(
+                args['train_size'],
+                args['val_size'],
+                args['test_size'],
+                args['data_dir'],
+                N=int(N),
+                maximal=False,
+                random_seed=args['random_seed'],
+                sl=args['sl'],
+                only=args['make_only'])
+            test_dataset = mwm2D_task.MWM2DDataset(test_dir, args['test_size'], has_labels=args['sl'], sl=args['sl']) \
+                if with_test else None
+            training_dataset = mwm2D_task.MWM2DDataset(train_dir, args['train_size'], has_labels=args['sl'], sl=args['sl'])
         #if args['val_size'] > 0:
         #    val_dataset = mwm2D_task.MWM2DDataset(val_dir, args['val_size'], has_labels=args['sl'])
         if args['model'] == 'nco' or args['arch'] == 'pnac':
@@ -51,32 +72,62 @@ def build(args, epoch):
             env = mwm2D_task.reward
     elif args['COP'] == 'tsp':
         tour_len = int(task[1])
-        train_fname, test_fname = tsp_task.create_dataset(
-            args['train_size'],
-            args['test_size'],
-            args['data_dir'],
-            tour_len=tour_len,
-            epoch=epoch,
-            random_seed=args['random_seed'])
-        training_dataset = tsp_task.TSPDataset(train_fname)
-        #if not reset:
-        #    val_dataset = tsp_task.TSPDataset(val_fname)
-        test_dataset = tsp_task.TSPDataset(test_fname)
+        if synthetic:
+            training_dataset = tsp_task.SyntheticTSPDataset(args['train_size'], tour_len, random_seed=train_seed)
+            test_dataset = tsp_task.SyntheticTSPDataset(args['test_size'], tour_len, random_seed=test_seed) \
+                if with_test else None
+        else:
+            train_fname, test_fname = tsp_task.create_dataset(
+                args['train_size'],
+                args['test_size'],
+                args['data_dir'],
+                tour_len=tour_len,
+                epoch=epoch,
+                random_seed=args['random_seed'])
+            training_dataset = tsp_task.TSPDataset(train_fname)
+            #if not reset:
+            #    val_dataset = tsp_task.TSPDataset(val_fname)
+            test_dataset = tsp_task.TSPDataset(test_fname) if with_test else None
         if args['model'] == 'spg':
             env = tsp_task.reward_spg
         elif args['model'] == 'nco':
             env = tsp_task.reward_nco
     # Dataloaders
-    training_dataloader = DataLoader(training_dataset,
-         batch_size=args['parallel_envs'], shuffle=True, drop_last=True, num_workers=args['num_workers'])
+    if args.get('world_size', 1) > 1:
+        # each rank rolls out its own shard of the training set, parallel_envs / world_size at a time
+        sampler = DistributedSampler(training_dataset, args['world_size'], args['rank'], seed=int(args['random_seed']))
+        training_dataloader = DataLoader(training_dataset, batch_size=args['parallel_envs'] // args['world_size'],
+             sampler=sampler, drop_last=True, num_workers=args['num_workers'])
+    else:
+        training_dataloader = DataLoader(training_dataset,
+             batch_size=args['parallel_envs'], shuffle=True, drop_last=True, num_workers=args['num_workers'])
     #validation_dataloader = DataLoader(val_dataset,
     #     batch_size=args['parallel_envs'], shuffle=True, drop_last=True, num_workers=args['num_workers'])
     #if args['COP'] == 'mwm2D' and args['sl']:
-    test_dataloader = DataLoader(test_dataset,
-         batch_size=args['parallel_envs'], shuffle=True, drop_last=True, num_workers=args['num_workers'])
+    test_dataloader = None
+    if test_dataset is not None:
+        test_dataloader = DataLoader(test_dataset,
+             batch_size=args['parallel_envs'], shuffle=True, drop_last=True, num_workers=args['num_workers'])
     return args, env, training_dataloader, test_dataloader
     #else:
     #    return args, env, training_dataloader, validation_dataloader
     #else:
     #    return None, None, training_dataloader, None
 
+def build_heldout(args, size):
+    """
+    A loader over size synthetic instances of args['task'], seeded apart
+    from the training and test sets, e.g. to validate a rollout baseline
+    without selecting it on the test set. Call after build()
+    """
+    heldout_seed = int(args['random_seed']) - 2
+    task = args['task'].split('_')
+    if args['COP'] == 'sort':
+        heldout_dataset = sorting_task.SyntheticSortingDataset(size, args['sort_low'], args['sort_high'],
+            random_seed=heldout_seed)
+    elif args['COP'] == 'mwm2D':
+        heldout_dataset = mwm2D_task.SyntheticMWM2DDataset(size, int(task[1]), random_seed=heldout_seed)
+    elif args['COP'] == 'tsp':
+        heldout_dataset = tsp_task.SyntheticTSPDataset(size, int(task[1]), random_seed=heldout_seed)
+    return DataLoader(heldout_dataset, batch_size=args['parallel_envs'], shuffle=False,
+        num_workers=args['num_workers'])
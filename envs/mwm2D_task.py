@@ -12,9 +12,11 @@ import numpy as np
 # from sklearn.utils.linear_assignment_ import linear_assignment
 from scipy.optimize import linear_sum_assignment as linear_assignment
 
-def reward(matching, use_cuda):
+def reward(matching, use_cuda, lengths=None):
     """
     matching is Tensor of dim [batch, N, 2]
+    lengths is an optional [batch] LongTensor of the number of valid nodes
+    per graph of zero-padded instances, whose padding stays at the end
     """
     (batch_size, N, features) = matching.size()
     matching_weight = Variable(torch.zeros(batch_size, 1), requires_grad=False)
@@ -23,6 +25,8 @@ def reward(matching, use_cuda):
     M = int(N/2)    
     for i in range(M):
         dists = torch.norm(matching[:, i + M, :] - matching[:, i, :], 2, dim=1)
+        if lengths is not None:
+            dists = dists * (lengths.to(dists.device) > i).float()
         matching_weight += dists.float().unsqueeze(1)
     return matching_weight 
 
@@ -165,3 +169,37 @@ class MWM2DDataset(Dataset):
         if not self.sl:
             self.has_labels = False
         return np.mean(opt)
+
+class SyntheticMWM2DDataset(Dataset):
+    """
+    Uniform random bipartite graphs in the unit square, generated in
+    memory instead of read from files. Items match MWM2DDataset without
+    labels, [2N, 2], with the first N rows being one side of the graph
+    """
+    def __init__(self, size, N, random_seed=None):
+        super(SyntheticMWM2DDataset, self).__init__()
+        g = torch.Generator()
+        if random_seed is not None:
+            g.manual_seed(int(random_seed))
+        self.data_set = torch.rand(size, 2 * N, 2, generator=g)
+        self.size = size
+        self.N = N
+        self.avg_optimal_weight = None
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        return self.data_set[idx]
+
+    def get_average_optimal_weight(self):
+        if self.avg_optimal_weight is None:
+            # C[i,j] is the weight of the edge between node i on the
+            # second side and node j on the first side
+            C = torch.cdist(self.data_set[:, self.N:], self.data_set[:, :self.N]).numpy()
+            opt = []
+            for i in tqdm(range(self.size)):
+                row_idxs, col_idxs = linear_assignment(-C[i])
+                opt.append(np.sum(C[i, row_idxs, col_idxs]))
+            self.avg_optimal_weight = np.mean(opt)
+        return self.avg_optimal_weight
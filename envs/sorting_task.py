@@ -54,7 +54,7 @@ def reward_ddpg_A(solution, use_cuda):
     """
     (batch_size, n, m) = solution.size()
     n_correctly_sorted = Variable(torch.zeros(batch_size, 1), requires_grad=False)
-    mask = Variable(torch.ones(batch_size, 1).byte(), requires_grad=False)
+    mask = Variable(torch.ones(batch_size, 1).bool(), requires_grad=False)
     if use_cuda:
         n_correctly_sorted = n_correctly_sorted.cuda()
         mask = mask.cuda()
@@ -120,9 +120,12 @@ def reward_ddpg_C(solution, use_cuda, nco=False):
 
     return torch.div(longest, m)
 
-def reward_ddpg_D(solution, use_cuda):
+def reward_ddpg_D(solution, use_cuda, lengths=None):
     """
     Kendall-Tau correlation coefficient
+
+    lengths is an optional [batch_size] LongTensor of the number of values
+    of zero-padded instances, whose padding stays at the end
     """
     (batch_size, n, m) = solution.size()
     if use_cuda:
@@ -133,7 +136,8 @@ def reward_ddpg_D(solution, use_cuda):
     target = np.array(list(range(m)))
     R = []
     for i in range(batch_size):
-        R.append(torch.FloatTensor([stats.kendalltau(solution[i], target).correlation]))
+        l = m if lengths is None else int(lengths[i])
+        R.append(torch.FloatTensor([stats.kendalltau(solution[i][:, :l], target[:l]).correlation]))
     R = torch.stack(R)
     if use_cuda:
         R = R.cuda()
@@ -262,3 +266,26 @@ class SortingDataset(Dataset):
 
     def __getitem__(self, idx):
         return self.data_set[idx]
+
+class SyntheticSortingDataset(Dataset):
+    """
+    Random permutations of [low, high], generated in memory
+    instead of read from a file. Items match SortingDataset, [N, 1]
+    """
+    def __init__(self, size, low=1, high=10, random_seed=None):
+        super(SyntheticSortingDataset, self).__init__()
+        self.is_bipartite = False
+        g = torch.Generator()
+        if random_seed is not None:
+            g.manual_seed(int(random_seed))
+        data_len = high - low + 1
+        # argsort of uniform noise is a batch of random permutations
+        perms = torch.argsort(torch.rand(size, data_len, generator=g), dim=1) + low
+        self.data_set = perms.float().unsqueeze(2)
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        return self.data_set[idx]
@@ -18,20 +18,31 @@ from collections import namedtuple
 #######################################
 # Reward Fns
 #######################################
-def reward_spg(solution, use_cuda):
+def reward_spg(solution, use_cuda, lengths=None):
     """
     Args:
         solution is a Tensor of size [batch_size, N, 2]
+        lengths is an optional [batch_size] LongTensor of the number of
+            cities of zero-padded instances, whose padding stays at the end
     Returns:
         Tensor of shape [batch_size] containing rewards
     """
     batch_size, N, _ = solution.data.shape
+    if lengths is not None:
+        lengths = lengths.to(solution.device)
+        steps = torch.norm(solution[:,1:,:].data - solution[:,:-1,:].data, p=2, dim=2)
+        # only the steps between valid cities, then back from the last valid city
+        valid = torch.arange(N - 1, device=solution.device).unsqueeze(0) < (lengths - 1).unsqueeze(1)
+        tour_len = torch.sum(steps * valid.float(), dim=1, keepdim=True)
+        last = solution.data[torch.arange(batch_size, device=solution.device), lengths - 1]
+        tour_len += torch.norm(last - solution[:,0,:].data, p=2, dim=1, keepdim=True)
+        return Variable(-tour_len, requires_grad=False)
     tour_len = torch.zeros(batch_size, 1)
     if use_cuda:
         tour_len = tour_len.cuda()
     for i in range(N - 1):
-        tour_len += torch.norm(solution[:,i,:].data - solution[:,i+1,:].data, p=2, dim=1)
-    tour_len += torch.norm(solution[:,N-1,:].data - solution[:,0,:].data, p=2, dim=1)
+        tour_len += torch.norm(solution[:,i,:].data - solution[:,i+1,:].data, p=2, dim=1, keepdim=True)
+    tour_len += torch.norm(solution[:,N-1,:].data - solution[:,0,:].data, p=2, dim=1, keepdim=True)
 
     return Variable(-tour_len, requires_grad=False)
 
@@ -319,3 +330,22 @@ class TSPDataset(Dataset):
 
     def __getitem__(self, idx):
         return self.data_set[idx]
+
+class SyntheticTSPDataset(Dataset):
+    """
+    Uniform random cities in the unit square, generated in memory
+    instead of read from a file. Items match TSPDataset, [N, 2]
+    """
+    def __init__(self, size, tour_len, random_seed=None):
+        super(SyntheticTSPDataset, self).__init__()
+        g = torch.Generator()
+        if random_seed is not None:
+            g.manual_seed(int(random_seed))
+        self.data_set = torch.rand(size, tour_len, 2, generator=g)
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        return self.data_set[idx]
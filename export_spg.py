@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Export a trained SPG actor, as saved by train_spg.py, to a TorchScript file
+that maps x to psi and loads with torch.jit.load, without this repo.
+
+Usage:
+    python export_spg.py --load_path actor-epoch-1.pt --output actor.ts
+"""
+import argparse
+import time
+import torch
+
+from spg import inference
+from spg.models import SPGSequentialActor
+import spg.util as util
+
+parser = argparse.ArgumentParser(description="Export a trained SPG actor to TorchScript")
+parser.add_argument('--load_path', type=str, required=True, help='Actor saved by train_spg.py')
+parser.add_argument('--output', type=str, required=True, help='TorchScript file to write')
+parser.add_argument('--quantize', type=util.str2bool, default=False, help='Dynamic int8 quantization of the Linear/GRU layers, the exported actor runs on the CPU only')
+parser.add_argument('--check', type=util.str2bool, default=True, help='Compare the exported and the original actor on random inputs')
+parser.add_argument('--batch_size', type=int, default=128, help='Batch size for the check')
+
+def main(args):
+    print(' [*] Loading actor from {}'.format(args['load_path']))
+    actor = torch.load(args['load_path'], map_location=lambda storage, loc: storage, weights_only=False)
+    actor.use_cuda = False
+    actor.init_hx = actor.init_hx.cpu()
+    actor.eval()
+    psi_actor = inference.export(actor, args['output'], args['quantize'])
+    print(' [*] wrote {}'.format(args['output']))
+    if not args['check']:
+        return 0
+    n_inputs = actor.n_nodes if isinstance(actor, SPGSequentialActor) else 2 * actor.n_nodes
+    x = torch.rand(args['batch_size'], n_inputs, actor.embedding.in_features)
+    loaded = torch.jit.load(args['output'])
+    with torch.no_grad():
+        psi, _ = actor(x, do_round=False)
+        psi_ts = loaded(x)
+        err = (psi - psi_ts).abs().max().item()
+        print(' [*] max abs difference to the original actor: {:.3g}'.format(err))
+        # the first calls of a scripted module run the profiling executor
+        for name, fn in [('original', lambda: actor(x, do_round=False)), ('exported', lambda: loaded(x))]:
+            for _ in range(3):
+                fn()
+            start = time.perf_counter()
+            for _ in range(10):
+                fn()
+            print(' [*] {} actor: {:.2f} ms per batch of {}'.format(name, 100 * (time.perf_counter() - start), args['batch_size']))
+    if args['quantize']:
+        # int8 weights move psi a little, compare the rounded permutations instead
+        perms = util.round_to_permutations(psi.numpy(), None, 0)
+        perms_ts = util.round_to_permutations(psi_ts.numpy(), None, 0)
+        same = (perms == perms_ts).view(perms.size(0), -1).all(1).float().mean().item()
+        print(' [*] same permutation as the original actor for {:.1f}% of the inputs'.format(100 * same))
+    elif err > 1e-5:
+        print(' [!] the exported actor does not match the original')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
@@ -0,0 +1,86 @@
+"""
+Greedy rollout baseline for REINFORCE (Kool et al., 2019, "Attention,
+Learn to Solve Routing Problems!")
+"""
+import copy
+import numpy as np
+import torch
+from scipy.stats import ttest_rel
+
+
+class RolloutBaseline(object):
+    """
+    The baseline for an instance is the cost of the tour decoded greedily by
+    a frozen copy of the policy. The copy is replaced by the current policy
+    when the policy's greedy tours on a held-out set are shorter, according
+    to a one-sided paired t-test.
+
+    Args:
+        model: the policy, a NeuralCombOptRL, MatchingNeuralCombOptRL or MatchingNoDecoder
+        reward_fn: from inference.make_reward_fn
+        eval_batches: list of held-out [batch_size, input_dim, sourceL] inputs
+        alpha: significance level of the t-test
+    """
+    def __init__(self, model, reward_fn, eval_batches, alpha=0.05):
+        self.reward_fn = reward_fn
+        self.eval_batches = eval_batches
+        self.alpha = alpha
+        self.n_updates = 0
+        self._update(model)
+
+    def _update(self, model):
+        self.model = copy.deepcopy(model)
+        # only the actions are needed, not the per-step probs
+        self.model.is_train = False
+        self.model.eval()
+        self.model.decode_type("greedy")
+        for p in self.model.parameters():
+            p.requires_grad = False
+        self.eval_R = self._rollout(self.model, self.eval_batches)
+
+    def _rollout(self, model, batches):
+        return np.concatenate([self.rollout(b, model).cpu().numpy() for b in batches])
+
+    def rollout(self, obs, model=None):
+        """
+        Returns the [batch_size] costs of the greedy tours of model,
+        the frozen copy by default, for obs
+        """
+        model = self.model if model is None else model
+        with torch.no_grad():
+            _, actions, _, _ = model(obs)
+            return self.reward_fn(obs, actions)
+
+    def eval(self, obs):
+        """[batch_size] baseline for the training batch obs"""
+        return self.rollout(obs)
+
+    def epoch_callback(self, model):
+        """
+        Compare the greedy tours of model and the frozen copy on the held-out
+        set and replace the copy if model is significantly better
+
+        Returns:
+            True if the frozen copy was replaced
+        """
+        model.eval()
+        model.decode_type("greedy")
+        candidate_R = self._rollout(model, self.eval_batches)
+        model.train()
+        model.decode_type("stochastic")
+        candidate_mean = candidate_R.mean()
+        baseline_mean = self.eval_R.mean()
+        print(' [*] rollout baseline: candidate mean cost {}, baseline mean cost {}'.format(
+            candidate_mean, baseline_mean))
+        if candidate_mean >= baseline_mean:
+            return False
+        t, p = ttest_rel(candidate_R, self.eval_R)
+        # one-sided test, the candidate has the lower mean
+        p_val = p / 2.
+        print(' [*] rollout baseline: p-value {}'.format(p_val))
+        if p_val < self.alpha:
+            print(' [*] updating the rollout baseline')
+            self._update(model)
+            self.n_updates += 1
+            return True
+        return False
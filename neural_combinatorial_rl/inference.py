@@ -0,0 +1,86 @@
+"""
+Inference helpers for the NCO models: scoring decoded solutions with the
+task reward, best-of-K / multi-start decoding, and int8 quantization
+"""
+import torch
+import torch.nn as nn
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    from torch.quantization import quantize_dynamic
+
+
+def make_reward_fn(args, env):
+    """
+    Wraps the task reward from envs.dataset.build so every task takes the same inputs
+
+    Args:
+        args: the run args, uses COP, input_size, use_KT and use_cuda
+        env: the NCO reward function of the task
+    Returns:
+        reward_fn(obs, actions), where obs is [batch_size, input_dim, sourceL]
+        and actions is a list of [batch_size, input_dim] as returned by the
+        models, returning the [batch_size] costs (lower is better)
+    """
+    def reward_fn(obs, actions):
+        if args['COP'] == 'sort':
+            R = env(actions, args['use_KT'], args['use_cuda'])
+        elif args['COP'] == 'mwm2D':
+            # actions is list of len N of (batch_size, n_features)
+            x1 = obs[:, :, 0:args['input_size']]
+            x2 = torch.stack(actions, 2)
+            a = torch.cat([x1, x2], dim=2)
+            R = env(torch.transpose(a, 2, 1), args['use_cuda'])
+        else:
+            R = env(actions, args['use_cuda'])
+        return R.view(-1)
+    return reward_fn
+
+def best_of_k(model, obs, k, reward_fn, multistart=False, decode_type=None):
+    """
+    Decodes k solutions per instance in one batched pass by repeating each
+    instance k times along the batch dimension, and keeps the best one.
+
+    Args:
+        model: a NeuralCombOptRL, MatchingNeuralCombOptRL or MatchingNoDecoder
+        obs: [batch_size, input_dim, sourceL]
+        k: number of solutions per instance
+        reward_fn: from make_reward_fn
+        multistart: force the k copies of an instance to start from
+            distinct inputs, cycling through them if k > n_starts
+        decode_type: "stochastic" or "greedy". Defaults to greedy when
+            every copy has its own start, since then greedy decodes are
+            already distinct, and to stochastic otherwise
+    Returns:
+        R: [batch_size] cost of the best solution of each instance
+        actions: list of len sourceL of [batch_size, input_dim]
+        action_idxs: list of len sourceL of [batch_size]
+    """
+    batch_size = obs.size(0)
+    # number of choices for the first decoding step
+    n_starts = model.n_nodes
+    if decode_type is None:
+        decode_type = "greedy" if multistart and k <= n_starts else "stochastic"
+    obs_k = obs.repeat_interleave(k, 0)
+    start_idxs = None
+    if multistart:
+        start_idxs = (torch.arange(k, device=obs.device) % n_starts).repeat(batch_size)
+    model.decode_type(decode_type)
+    with torch.no_grad():
+        _, actions, action_idxs, _ = model(obs_k, start_idxs=start_idxs)
+        R = reward_fn(obs_k, actions).view(batch_size, k)
+    R, best = R.min(1)
+    # rows of the best solutions in the [batch_size * k] batch
+    rows = torch.arange(batch_size, device=obs.device) * k + best
+    actions = [a.index_select(0, rows) for a in actions]
+    action_idxs = [a.index_select(0, rows) for a in action_idxs]
+    return R, actions, action_idxs
+
+def quantize(model):
+    """
+    Dynamic int8 quantization of the Linear, LSTM and LSTMCell layers of
+    an NCO model, for CPU inference. Returns a quantized copy. The 1x1
+    convolutions that project the attention references, the input
+    embedding and the attention logits stay in float
+    """
+    return quantize_dynamic(model, {nn.Linear, nn.LSTM, nn.LSTMCell}, dtype=torch.qint8)
@@ -0,0 +1,53 @@
+"""
+Masking of visited inputs, shared by the NCO decoders
+"""
+import numpy as np
+import torch
+
+_aranges = {}
+
+def batch_arange(batch_size, device):
+    """A cached torch.arange(batch_size) on device, do not modify in place"""
+    key = (batch_size, str(device))
+    if key not in _aranges:
+        _aranges[key] = torch.arange(batch_size, device=device)
+    return _aranges[key]
+
+def select_inputs(embedded_inputs, idxs):
+    """
+    Args:
+        embedded_inputs: [sourceL x batch_size x embedding_dim]
+        idxs: [batch_size] the input selected for each instance
+    Returns:
+        [batch_size x embedding_dim] the embeddings of the selected inputs
+    """
+    return embedded_inputs[idxs, batch_arange(idxs.size(0), idxs.device)]
+
+
+class VisitedMask(object):
+    """
+    The inputs visited so far in one decode, as a [batch_size x sourceL] bool
+    mask that is updated in place after each selection. The same mask is
+    applied to the glimpse and pointer logits of a step, so nothing is
+    allocated per glimpse.
+
+    Logits are filled outside of autograd, so the mask is never saved for
+    backward and can keep changing in place. The softmax already has zero
+    gradient wherever its output is zero
+    """
+    def __init__(self, batch_size, sourceL, device):
+        self.mask = torch.zeros(batch_size, sourceL, dtype=torch.bool, device=device)
+
+    def apply(self, logits):
+        """Set the logits of visited inputs to -inf, in place"""
+        with torch.no_grad():
+            logits.masked_fill_(self.mask, -np.inf)
+        return logits
+
+    def visit(self, idxs):
+        """Mark the [batch_size] inputs idxs as visited"""
+        self.mask.scatter_(1, idxs.unsqueeze(1), True)
+
+    def reorder(self, rows):
+        """Keep the masks of the given rows, e.g. the parents of the beams in beam search"""
+        self.mask = self.mask.index_select(0, rows)
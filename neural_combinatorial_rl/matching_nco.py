@@ -5,7 +5,8 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 import math
 import numpy as np
-from neural_combinatorial_rl.neural_combinatorial_rl import Encoder
+from neural_combinatorial_rl.neural_combinatorial_rl import Encoder, rename_legacy_lstm_keys, upgrade_legacy_lstm
+from neural_combinatorial_rl.mask import VisitedMask, select_inputs
 #from neural_combinatorial_rl.neural_combinatorial_rl import Attention
 #from neural_combinatorial_rl.neural_combinatorial_rl import Decoder
 
@@ -25,25 +26,35 @@ class Attention(nn.Module):
         self.v = nn.Parameter(v)
         self.v.data.uniform_(-(1. / math.sqrt(out_dim)) , 1. / math.sqrt(out_dim))
 
-    def forward(self, query, ref):
+    def project(self, ref):
+        """
+        Project the encoder hidden states once per decode
+
+        Args:
+            ref: the set of hidden states from the encoder. 
+                sourceL x batch_size x hidden_dim
+        Returns:
+            batch_size x out_dim x sourceL
+        """
+        return self.project_ref(ref.permute(1, 2, 0))
+
+    def forward(self, query, ref, e=None):
         """
         Args: 
             query: is the hidden state of the decoder at the current
                 time step. batch x dim
             ref: the set of hidden states from the encoder. 
-                sourceL x hidden_dim x batch_size
+                sourceL x batch_size x hidden_dim
+            e: optionally, the output of project(ref)
         """
-        # ref is now [batch_size x hidden_dim x sourceL]
-        ref = ref.permute(2, 1, 0)
+        if e is None:
+            e = self.project(ref)  # batch_size x hidden_dim x sourceL 
         q = self.project_query(query).unsqueeze(2)  # batch x dim x 1
-        e = self.project_ref(ref)  # batch_size x hidden_dim x sourceL 
-        # expand the query by sourceL
-        # batch x dim x sourceL
-        expanded_q = q.repeat(1, 1, e.size(2))
         # batch x 1 x hidden_dim
-        v_view = self.v.unsqueeze(0).expand(expanded_q.size(0), len(self.v)).unsqueeze(1)
+        v_view = self.v.unsqueeze(0).expand(e.size(0), len(self.v)).unsqueeze(1)
+        # the query broadcasts over sourceL
         # [batch_size x 1 x hidden_dim] * [batch_size x hidden_dim x sourceL]
-        u = torch.bmm(v_view, self.tanh(expanded_q + e)).squeeze(1)
+        u = torch.bmm(v_view, self.tanh(q + e)).squeeze(1)
         if self.use_tanh:
             logits = self.C * self.tanh(u)
         else:
@@ -73,35 +84,20 @@ class Decoder(nn.Module):
          self.decode_type = decode_type
          self.beam_size = beam_size
          self.use_cuda = use_cuda
-         self.input_weights = nn.Linear(embedding_dim, 4 * hidden_dim)
-         self.hidden_weights = nn.Linear(hidden_dim, 4 * hidden_dim)
+         self.lstm = nn.LSTMCell(embedding_dim, hidden_dim)
          self.pointer = Attention(hidden_dim, hidden_dim, use_tanh=use_tanh, C=tanh_exploration, use_cuda=self.use_cuda)
          self.glimpse = Attention(hidden_dim, hidden_dim, use_tanh=False, use_cuda=self.use_cuda)
          self.sm = nn.Softmax()
 
-    def apply_mask_to_logits(self, step, logits, mask, prev_idxs):    
-         if mask is None:
-             mask = torch.zeros(logits.size()).byte()
-         if self.use_cuda: # move from GPU to CPU for speedup
-             #logits = logits.cpu()
-             mask = mask.cuda()
-         maskk = mask.clone()
-         # to prevent them from being reselected. 
-         if prev_idxs is not None:
-             #if self.use_cuda:
-             #    prev_idxs = prev_idxs.cpu()
-             # set most recently selected idx values to 1
-             maskk[[x for x in range(logits.size(0))],
-                     prev_idxs.data] = 1
-             #for x in range(logits.size(0)):
-             #    maskk[x, prev_idxs.data[x]] = 1
-             logits[maskk] = -np.inf
-         # move back to GPU
-         #if self.use_cuda:
-         #    logits = logits.cuda()
-         return logits, maskk
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+         rename_legacy_lstm_keys(state_dict, prefix)
+         super(Decoder, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __setstate__(self, state):
+         super(Decoder, self).__setstate__(state)
+         upgrade_legacy_lstm(self)
 
-    def forward(self, decoder_input, embedded_x1, embedded_x2, hidden, context):
+    def forward(self, decoder_input, embedded_x1, embedded_x2, hidden, context, start_idxs=None):
          """
          Args:
              decoder_input: The initial input to the decoder
@@ -111,53 +107,56 @@ class Decoder(nn.Module):
              hidden: the prev hidden state, size is [batch_size x hidden_dim]. 
                  Initially this is set to (enc_h[-1], enc_c[-1])
              context: encoder outputs, [sourceL x batch_size x hidden_dim] 
+             start_idxs: optional [batch_size] nodes of graph 2 to match
+                 with the first node of graph 1
          """
-         def recurrence(x, hidden, logit_mask, prev_idxs, step):
+         def recurrence(x, hidden, visited, glimpse_ref, pointer_ref):
            
-             hx, cx = hidden  # batch_size x hidden_dim
-           
-             gates = self.input_weights(x) + self.hidden_weights(hx)
-             ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
-             ingate = F.sigmoid(ingate)
-             forgetgate = F.sigmoid(forgetgate)
-             cellgate = F.tanh(cellgate)
-             outgate = F.sigmoid(outgate)
-             cy = (forgetgate * cx) + (ingate * cellgate)
-             hy = outgate * F.tanh(cy)  # batch_size x hidden_dim
+             # hidden is (hx, cx), each batch_size x hidden_dim
+             hy, cy = self.lstm(x, hidden)
              g_l = hy
              for i in range(self.n_glimpses):
-                 ref, logits = self.glimpse(g_l, context)
-                 logits, logit_mask = self.apply_mask_to_logits(step, logits, logit_mask, prev_idxs)
+                 ref, logits = self.glimpse(g_l, context, glimpse_ref)
+                 logits = visited.apply(logits)
                  # [batch_size x h_dim x sourceL] * [batch_size x sourceL x 1] = 
                  # [batch_size x h_dim x 1]
                  g_l = torch.bmm(ref, self.sm(logits).unsqueeze(2)).squeeze(2) 
-             _, logits = self.pointer(g_l, context)
+             _, logits = self.pointer(g_l, context, pointer_ref)
            
-             logits, logit_mask = self.apply_mask_to_logits(step, logits, logit_mask, prev_idxs)
+             logits = visited.apply(logits)
              probs = self.sm(logits)
-             return hy, cy, probs, logit_mask
+             return hy, cy, probs
    
+         # project the encoder outputs once for the whole decode
+         glimpse_ref = self.glimpse.project(context)
+         pointer_ref = self.pointer.project(context)
          batch_size = context.size(1)
          outputs = []
          selections = []
          steps = range(self.max_length)  # or until terminating symbol ?
          inps = []
-         idxs = None
-         mask = None
+         # visited inputs, updated in place after each selection
+         visited = VisitedMask(batch_size, context.size(0), context.device)
       
          if self.decode_type == "stochastic" or self.decode_type == "greedy":
              for i in steps:
-                 hx, cx, probs, mask = recurrence(decoder_input, hidden, mask, idxs, i)
+                 hx, cx, probs = recurrence(decoder_input, hidden, visited,
+                         glimpse_ref, pointer_ref)
                  hidden = (hx, cx)
                  # select the next inputs for the decoder [batch_size x hidden_dim]
                  if self.decode_type == "stochastic":
                      fn = self.decode_stochastic
                  elif self.decode_type == "greedy":
                      fn = self.decode_greedy
-                 x2_selects, idxs = fn(
-                     probs,
-                     embedded_x2,
-                     selections)
+                 if i == 0 and start_idxs is not None:
+                     # forced first selection, e.g. for multi-start decoding
+                     idxs = start_idxs
+                     x2_selects = select_inputs(embedded_x2, idxs)
+                 else:
+                     x2_selects, idxs = fn(
+                         probs,
+                         embedded_x2)
+                 visited.visit(idxs)
                  inps.append(x2_selects) 
                  # use outs to point to next object
                  outputs.append(probs)
@@ -165,38 +164,27 @@ class Decoder(nn.Module):
                  decoder_input = torch.cat([embedded_x1[i], x2_selects], dim=1)
              return (outputs, selections), hidden
 
-    def decode_stochastic(self, probs, embedded_inputs, selections):
+    def decode_stochastic(self, probs, embedded_inputs):
          """
          Return the next input for the decoder by sampling from the 
-         input probabilities
+         input probabilities. Visited inputs have zero probability,
+         so one draw is always valid
 
          Args: 
              probs: [batch_size x sourceL]
              embedded_inputs: [sourceL x batch_size x embedding_dim]
-             selections: list of all of the previously selected indices during decoding
         Returns:
              Tensor of size [batch_size x sourceL] containing the embeddings
              from the inputs corresponding to the [batch_size] indices
              selected for this iteration of the decoding, as well as the 
              corresponding indicies
          """
-         batch_size = probs.size(0)
          # idxs is [batch_size]
-         idxs = probs.multinomial().squeeze(1)
-
-         # due to race conditions, might need to resample here
-         for old_idxs in selections:
-             # compare new idxs
-             # elementwise with the previous idxs. If any matches,
-             # then need to resample
-             if old_idxs.eq(idxs).data.any():
-                 print(' [!] resampling due to race condition')
-                 idxs = probs.multinomial().squeeze(1)
-                 break
-         sels = embedded_inputs[idxs.data, [i for i in range(batch_size)], :] 
+         idxs = probs.multinomial(1).squeeze(1)
+         sels = select_inputs(embedded_inputs, idxs)
          return sels, idxs
 
-    def decode_greedy(self, probs, embedded_inputs, selections):
+    def decode_greedy(self, probs, embedded_inputs):
          """
          Return the next input for the decoder by selecting the 
          input corresponding to the max output
@@ -204,17 +192,15 @@ class Decoder(nn.Module):
          Args: 
              probs: [batch_size x sourceL]
              embedded_inputs: [sourceL x batch_size x embedding_dim]
-             selections: list of all of the previously selected indices during decoding
          Returns:
              Tensor of size [batch_size x sourceL] containing the embeddings
              from the inputs corresponding to the [batch_size] indices
              selected for this iteration of the decoding, as well as the 
              corresponding indicies
          """
-         batch_size = probs.size(0)
          # idxs is [batch_size]
          _, idxs = probs.max(1)
-         sels = embedded_inputs[idxs.data, [i for i in range(batch_size)], :] 
+         sels = select_inputs(embedded_inputs, idxs)
          return sels, idxs
 
 class MatchingPointerNetwork(nn.Module):
@@ -259,11 +245,12 @@ class MatchingPointerNetwork(nn.Module):
         self.decoder_in_0.data.uniform_(-(1. / math.sqrt(2 * embedding_dim)),
                 1. / math.sqrt(2 * embedding_dim))
             
-    def forward(self, x, x1, x2):
+    def forward(self, x, x1, x2, start_idxs=None):
         """ Propagate inputs through the network
         Args: 
             x: fused embeddings [batch_size, n, n]
             x2: embedding graph 2, [batch_size, sourceL, embedding_dim]
+            start_idxs: optional [batch_size] first selections
         """
         batch_size = x.size(0)
         x = torch.transpose(x, 0, 1)
@@ -287,7 +274,8 @@ class MatchingPointerNetwork(nn.Module):
                 torch.transpose(x1, 0, 1),
                 torch.transpose(x2, 0, 1),
                 dec_init_state,
-                enc_h)
+                enc_h,
+                start_idxs)
 
         return pointer_probs, input_idxs
 
@@ -299,92 +287,70 @@ class MatchingNoDecoder(nn.Module):
         self.encoder = nn.GRU(n_nodes, hidden_dim)
         self.n_nodes = n_nodes
         self.init_hx = Variable(torch.zeros(1, hidden_dim), requires_grad=False)
-        self.sm = nn.LogSoftmax()
         self.decode = "stochastic"
         self.mask_logits = True
         self.use_cuda = use_cuda
         if use_cuda:
             self.init_hx = self.init_hx.cuda()
     
-    def apply_mask_to_logits(self, step, logits, mask, prev_idxs):    
-         if mask is None:
-             mask = torch.zeros(logits.size()).byte()
-         if self.use_cuda:
-            mask = mask.cuda()
-         maskk = mask.clone()
-         # to prevent them from being reselected. 
-         if prev_idxs is not None:
-             maskk[[x for x in range(logits.size(0))],
-                     prev_idxs.data] = 1
-             logits[maskk] = -np.inf
-         return logits, maskk
-    
     def decode_type(self, dt):
         self.decode = dt
     
-    def forward(self, x):
+    def forward(self, x, start_idxs=None):
         batch_size = x.size(0)
         x1 = torch.transpose(x[:, :, 0:self.n_nodes], 2, 1)
         x2 = torch.transpose(x[:, :, self.n_nodes:self.n_nodes*2], 2, 1)
         x1 = F.leaky_relu(self.embedding(x1))
         x2 = F.leaky_relu(self.embedding(x2))
         xx = torch.bmm(x1, torch.transpose(x2, 1, 2))
+        # [n_nodes x batch_size x n_nodes]
         xx = torch.transpose(xx, 0, 1)
-        xx = torch.chunk(xx, self.n_nodes, 0)
         h = self.init_hx.unsqueeze(1).repeat(1, batch_size, 1)
+        # the GRU inputs do not depend on the selections, so the recurrence
+        # runs as one call over the whole sequence.
+        # enc_h is [n_nodes x batch_size x hidden_dim]
+        enc_h, _ = self.encoder(xx, h)
+        # [n_nodes x batch_size x n_nodes]
+        logits = 10 * F.tanh(self.to_logits(enc_h))
         
-        logit_mask = None
-        idxs = None
+        # only masking and sampling are sequential. masks[i] holds the
+        # inputs visited before step i
+        visited = VisitedMask(batch_size, self.n_nodes, x.device)
+        masks = torch.empty(self.n_nodes, batch_size, self.n_nodes, dtype=torch.bool, device=x.device)
         selections = []
-        probs = []
-        
-        for i in range(self.n_nodes):
-            enc_h, h = self.encoder(xx[i], h)
-            # Need something extra here?
-            logits = 10 * F.tanh(self.to_logits(enc_h.squeeze()))
-            if self.mask_logits: 
-                masked_logits, logit_mask = self.apply_mask_to_logits(i, logits.clone(), logit_mask, idxs)
-                soft_probs = self.sm(masked_logits)
-            else:
-                soft_probs = self.sm(logits)
-            if self.decode == "stochastic":
-                # idxs is [batch_size]
-                idxs = torch.exp(soft_probs).multinomial().squeeze(1)
-                # due to race conditions, might need to resample here
+        with torch.no_grad():
+            for i in range(self.n_nodes):
+                masks[i] = visited.mask
+                step_logits = logits[i]
                 if self.mask_logits:
-                    for old_idxs in selections:
-                        # compare new idxs
-                        # elementwise with the previous idxs. If any matches,
-                        # then need to resample
-                        if old_idxs.eq(idxs).data.any():
-                            print(' [!] resampling due to race condition')
-                            idxs = torch.exp(soft_probs).multinomial().squeeze(1)
-                            break
-            else:
-                _, idxs = soft_probs.max(1)
-            selections.append(idxs)
-            probs.append(soft_probs)
+                    step_logits = visited.apply(step_logits.clone())
+                if i == 0 and start_idxs is not None:
+                    # forced first selection, e.g. for multi-start decoding
+                    idxs = start_idxs
+                elif self.decode == "stochastic":
+                    # idxs is [batch_size]
+                    idxs = torch.exp(F.log_softmax(step_logits, dim=1)).multinomial(1).squeeze(1)
+                else:
+                    _, idxs = step_logits.max(1)
+                visited.visit(idxs)
+                selections.append(idxs)
+        if self.mask_logits:
+            logits = logits.masked_fill(masks, -np.inf)
+        # [n_nodes x batch_size x n_nodes]
+        probs = F.log_softmax(logits, dim=2)
         # Select the actions (inputs pointed to 
         # by the pointer net) and the corresponding
         # logits
-        # should be size [batch_size x 
-        actions = []
-        # x is [batch_size, input_dim, sourceL]
-        x_ = torch.transpose(x[:, :, self.n_nodes:self.n_nodes*2], 1, 2)
+        # idxs is [batch_size x n_nodes], the input selected at each step
+        idxs = torch.stack(selections, 1)
         # x_ is [batch_size, sourceL, input_dim]
-        for action_id in selections:
-            actions.append(x_[[x for x in range(batch_size)], action_id.data, :])
-
-        #if self.is_train:
-        # logits_ is a list of len sourceL of [batch_size x sourceL]
-        probs_ = []
-        for p, action_id in zip(probs, selections):
-            probs_.append(p[[x for x in range(batch_size)], action_id.data])
-        #else:
-            # return the list of len sourceL of [batch_size x sourceL]
-        #    probs_ = probs
-
-        return probs_, actions, selections, torch.stack(probs)
+        x_ = torch.transpose(x[:, :, self.n_nodes:self.n_nodes*2], 1, 2)
+        actions = x_.gather(1, idxs.unsqueeze(2).expand(-1, -1, x_.size(2)))
+        # list of len sourceL of [batch_size x input_dim]
+        actions = list(actions.unbind(1))
+        # list of len sourceL of [batch_size], the log prob of each selection
+        probs_ = list(probs.gather(2, idxs.t().unsqueeze(2)).squeeze(2).unbind(0))
+        return probs_, actions, selections, probs
 
 class MatchingNeuralCombOptRL(nn.Module):
     """
@@ -408,6 +374,7 @@ class MatchingNeuralCombOptRL(nn.Module):
             use_cuda):
         super(MatchingNeuralCombOptRL, self).__init__()
         self.input_dim = input_dim
+        self.n_nodes = n_nodes
         self.is_train = is_train
         self.use_cuda = use_cuda
         
@@ -435,10 +402,11 @@ class MatchingNeuralCombOptRL(nn.Module):
     def decode_type(self, dt):
         self.actor_net.decoder.decode_type = dt
 
-    def forward(self, inputs):
+    def forward(self, inputs, start_idxs=None):
         """
         Args:
             inputs: [batch_size, input_dim, 2 * sourceL]
+            start_idxs: optional [batch_size] first selections
         """
         batch_size = inputs.size(0)
         input_dim = inputs.size(1)
@@ -473,24 +441,23 @@ class MatchingNeuralCombOptRL(nn.Module):
         fused_embedding = torch.bmm(x1, torch.transpose(x2, 1, 2))
         # query the actor net for the input indices 
         # making up the output, and the pointer attn 
-        probs_, action_idxs = self.actor_net(fused_embedding, x1, x2)
+        probs_, action_idxs = self.actor_net(fused_embedding, x1, x2, start_idxs)
        
         # Select the actions (inputs pointed to 
         # by the pointer net) and the corresponding
         # logits
         # should be size [batch_size x 
-        actions = []
+        # idxs is [batch_size x sourceL], the input selected at each step
+        idxs = torch.stack(action_idxs, 1)
         # inputs is [batch_size, input_dim, sourceL]
         inputs_ = inputs[:, :, sourceL:sourceL * 2].transpose(1, 2)
         # inputs_ is [batch_size, sourceL, input_dim]
-        for action_id in action_idxs:
-            actions.append(inputs_[[x for x in range(batch_size)], action_id.data, :])
+        actions = inputs_.gather(1, idxs.unsqueeze(2).expand(-1, -1, inputs_.size(2)))
+        actions = list(actions.unbind(1))
 
         if self.is_train:
             # probs_ is a list of len sourceL of [batch_size x sourceL]
-            probs = []
-            for prob, action_id in zip(probs_, action_idxs):
-                probs.append(prob[[x for x in range(batch_size)], action_id.data])
+            probs = list(torch.stack(probs_, 1).gather(2, idxs.unsqueeze(2)).squeeze(2).unbind(1))
         else:
             # return the list of len sourceL of [batch_size x sourceL]
             probs = probs_
@@ -5,8 +5,9 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 import math
 import numpy as np
+from collections import OrderedDict
+from neural_combinatorial_rl.mask import VisitedMask, select_inputs, batch_arange
 
-from neural_combinatorial_rl.beam_search import Beam
 
 class Encoder(nn.Module):
     """Maps a graph represented as an input sequence
@@ -48,26 +49,37 @@ class Attention(nn.Module):
         self.v = nn.Parameter(v)
         self.v.data.uniform_(-(1. / math.sqrt(dim)) , 1. / math.sqrt(dim))
         
-    def forward(self, query, ref):
+    def project(self, ref):
+        """
+        Project the encoder hidden states. They are the same at every
+        decoding step, so this can be done once per decode and passed to forward
+
+        Args:
+            ref: the set of hidden states from the encoder. 
+                sourceL x batch x hidden_dim
+        Returns:
+            batch_size x hidden_dim x sourceL
+        """
+        return self.project_ref(ref.permute(1, 2, 0))
+
+    def forward(self, query, ref, e=None):
         """
         Args: 
             query: is the hidden state of the decoder at the current
                 time step. batch x dim
             ref: the set of hidden states from the encoder. 
                 sourceL x batch x hidden_dim
+            e: optionally, the output of project(ref)
         """
-        # ref is now [batch_size x hidden_dim x sourceL]
-        ref = ref.permute(1, 2, 0)
+        if e is None:
+            e = self.project(ref)  # batch_size x hidden_dim x sourceL 
         q = self.project_query(query).unsqueeze(2)  # batch x dim x 1
-        e = self.project_ref(ref)  # batch_size x hidden_dim x sourceL 
-        # expand the query by sourceL
-        # batch x dim x sourceL
-        expanded_q = q.repeat(1, 1, e.size(2)) 
         # batch x 1 x hidden_dim
         v_view = self.v.unsqueeze(0).expand(
-                expanded_q.size(0), len(self.v)).unsqueeze(1)
+                e.size(0), len(self.v)).unsqueeze(1)
+        # the query broadcasts over sourceL
         # [batch_size x 1 x hidden_dim] * [batch_size x hidden_dim x sourceL]
-        u = torch.bmm(v_view, self.tanh(expanded_q + e)).squeeze(1)
+        u = torch.bmm(v_view, self.tanh(q + e)).squeeze(1)
         if self.use_tanh:
             logits = self.C * self.tanh(u)
         else:
@@ -75,6 +87,46 @@ class Attention(nn.Module):
         return e, logits
 
 
+# the decoders used to build their LSTM cell from two nn.Linear layers.
+# nn.LSTMCell uses the same (input, forget, cell, output) gate order, so
+# old weights load unchanged under the new names. The fused cell sums in a
+# different order, so selections are identical but gradients only equal
+# the old ones to within float rounding
+LEGACY_LSTM_KEYS = [
+    ('input_weights.weight', 'lstm.weight_ih'),
+    ('input_weights.bias', 'lstm.bias_ih'),
+    ('hidden_weights.weight', 'lstm.weight_hh'),
+    ('hidden_weights.bias', 'lstm.bias_hh')]
+
+def rename_legacy_lstm_keys(state_dict, prefix):
+    """Rename the LSTM cell parameters of a decoder state dict saved before nn.LSTMCell, in place"""
+    for old, new in LEGACY_LSTM_KEYS:
+        if prefix + old in state_dict:
+            state_dict[prefix + new] = state_dict.pop(prefix + old)
+
+def upgrade_legacy_lstm(decoder):
+    """Replace the nn.Linear LSTM layers of a decoder unpickled from before nn.LSTMCell"""
+    if 'input_weights' not in decoder._modules:
+        return
+    input_weights = decoder._modules['input_weights']
+    hidden_weights = decoder._modules['hidden_weights']
+    lstm = nn.LSTMCell(input_weights.in_features, hidden_weights.in_features)
+    lstm = lstm.to(input_weights.weight.device)
+    with torch.no_grad():
+        lstm.weight_ih.copy_(input_weights.weight)
+        lstm.bias_ih.copy_(input_weights.bias)
+        lstm.weight_hh.copy_(hidden_weights.weight)
+        lstm.bias_hh.copy_(hidden_weights.bias)
+    # keep the submodule order, and so the parameter order, of a new decoder
+    modules = OrderedDict()
+    for name, module in decoder._modules.items():
+        if name == 'input_weights':
+            modules['lstm'] = lstm
+        elif name != 'hidden_weights':
+            modules[name] = module
+    decoder._modules = modules
+
+
 class Decoder(nn.Module):
     def __init__(self, 
             embedding_dim,
@@ -98,36 +150,21 @@ class Decoder(nn.Module):
         self.beam_size = beam_size
         self.use_cuda = use_cuda
 
-        self.input_weights = nn.Linear(embedding_dim, 4 * hidden_dim)
-        self.hidden_weights = nn.Linear(hidden_dim, 4 * hidden_dim)
+        self.lstm = nn.LSTMCell(embedding_dim, hidden_dim)
 
         self.pointer = Attention(hidden_dim, use_tanh=use_tanh, C=tanh_exploration, use_cuda=self.use_cuda)
         self.glimpse = Attention(hidden_dim, use_tanh=False, use_cuda=self.use_cuda)
         self.sm = nn.Softmax()
 
-    def apply_mask_to_logits(self, step, logits, mask, prev_idxs):    
-        if mask is None:
-            mask = torch.zeros(logits.size()).byte()
-        if self.use_cuda: # move from GPU to CPU for speedup
-            #logits = logits.cpu()
-            mask = mask.cuda()
-        maskk = mask.clone()
-        # to prevent them from being reselected. 
-        if prev_idxs is not None:
-            #if self.use_cuda:
-            #    prev_idxs = prev_idxs.cpu()
-            # set most recently selected idx values to 1
-            maskk[[x for x in range(logits.size(0))],
-                    prev_idxs.data] = 1
-            #for x in range(logits.size(0)):
-            #    maskk[x, prev_idxs.data[x]] = 1
-            logits[maskk] = -np.inf
-        # move back to GPU
-        #if self.use_cuda:
-        #    logits = logits.cuda()
-        return logits, maskk
-
-    def forward(self, decoder_input, embedded_inputs, hidden, context):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        rename_legacy_lstm_keys(state_dict, prefix)
+        super(Decoder, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __setstate__(self, state):
+        super(Decoder, self).__setstate__(state)
+        upgrade_legacy_lstm(self)
+
+    def forward(self, decoder_input, embedded_inputs, hidden, context, start_idxs=None):
         """
         Args:
             decoder_input: The initial input to the decoder
@@ -136,53 +173,56 @@ class Decoder(nn.Module):
             hidden: the prev hidden state, size is [batch_size x hidden_dim]. 
                 Initially this is set to (enc_h[-1], enc_c[-1])
             context: encoder outputs, [sourceL x batch_size x hidden_dim] 
+            start_idxs: optional [batch_size] inputs to select at the first
+                step, for stochastic and greedy decoding
         """
-        def recurrence(x, hidden, logit_mask, prev_idxs, step):
-            
-            hx, cx = hidden  # batch_size x hidden_dim
+        def recurrence(x, hidden, visited, glimpse_ref, pointer_ref):
             
-            gates = self.input_weights(x) + self.hidden_weights(hx)
-            ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
-            ingate = F.sigmoid(ingate)
-            forgetgate = F.sigmoid(forgetgate)
-            cellgate = F.tanh(cellgate)
-            outgate = F.sigmoid(outgate)
-            cy = (forgetgate * cx) + (ingate * cellgate)
-            hy = outgate * F.tanh(cy)  # batch_size x hidden_dim
+            # hidden is (hx, cx), each batch_size x hidden_dim
+            hy, cy = self.lstm(x, hidden)
             g_l = hy
             for i in range(self.n_glimpses):
-                ref, logits = self.glimpse(g_l, context)
-                logits, logit_mask = self.apply_mask_to_logits(step, logits, logit_mask, prev_idxs)
+                ref, logits = self.glimpse(g_l, context, glimpse_ref)
+                logits = visited.apply(logits)
                 # [batch_size x h_dim x sourceL] * [batch_size x sourceL x 1] = 
                 # [batch_size x h_dim x 1]
                 g_l = torch.bmm(ref, self.sm(logits).unsqueeze(2)).squeeze(2) 
-            _, logits = self.pointer(g_l, context)
+            _, logits = self.pointer(g_l, context, pointer_ref)
             
-            logits, logit_mask = self.apply_mask_to_logits(step, logits, logit_mask, prev_idxs)
+            logits = visited.apply(logits)
             probs = self.sm(logits)
-            return hy, cy, probs, logit_mask
+            return hy, cy, probs
     
+        # project the encoder outputs once for the whole decode
+        glimpse_ref = self.glimpse.project(context)
+        pointer_ref = self.pointer.project(context)
         batch_size = context.size(1)
         outputs = []
         selections = []
         steps = range(self.max_length)  # or until terminating symbol ?
         inps = []
-        idxs = None
-        mask = None
+        # visited inputs, updated in place after each selection
+        visited = VisitedMask(batch_size, context.size(0), context.device)
        
         if self.decode_type == "stochastic" or self.decode_type == "greedy":
             for i in steps:
-                hx, cx, probs, mask = recurrence(decoder_input, hidden, mask, idxs, i)
+                hx, cx, probs = recurrence(decoder_input, hidden, visited,
+                        glimpse_ref, pointer_ref)
                 hidden = (hx, cx)
                 # select the next inputs for the decoder [batch_size x hidden_dim]
                 if self.decode_type == "stochastic":
                     fn = self.decode_stochastic
                 elif self.decode_type == "greedy":
                     fn = self.decode_greedy
-                decoder_input, idxs = fn(
-                    probs,
-                    embedded_inputs,
-                    selections)
+                if i == 0 and start_idxs is not None:
+                    # forced first selection, e.g. for multi-start decoding
+                    idxs = start_idxs
+                    decoder_input = select_inputs(embedded_inputs, idxs)
+                else:
+                    decoder_input, idxs = fn(
+                        probs,
+                        embedded_inputs)
+                visited.visit(idxs)
                 inps.append(decoder_input) 
                 # use outs to point to next object
                 outputs.append(probs)
@@ -190,120 +230,93 @@ class Decoder(nn.Module):
             return (outputs, selections), hidden
 
         elif self.decode_type == "beam_search":
-            
-            # Expand input tensors for beam search
-            decoder_input = Variable(decoder_input.data.repeat(self.beam_size, 1))
-            context = Variable(context.data.repeat(1, self.beam_size, 1))
-            hidden = (Variable(hidden[0].data.repeat(self.beam_size, 1)),
-                    Variable(hidden[1].data.repeat(self.beam_size, 1)))
-            
-            beam = [
-                    Beam(self.beam_size, self.max_length, cuda=self.use_cuda) 
-                    for k in range(batch_size)
-            ]
-            
-            for i in steps:
-                hx, cx, probs, mask = recurrence(decoder_input, hidden, mask, idxs, i)
-                hidden = (hx, cx)
-                
-                probs = probs.view(self.beam_size, batch_size, -1
-                        ).transpose(0, 1).contiguous()
-                
-                n_best = 1
-                # select the next inputs for the decoder [batch_size x hidden_dim]
-                decoder_input, idxs, active = self.decode_beam(probs,
-                        embedded_inputs, beam, batch_size, n_best, i)
-               
-                inps.append(decoder_input) 
-                # use probs to point to next object
-                if self.beam_size > 1:
-                    outputs.append(probs[:, 0,:])
-                else:
-                    outputs.append(probs.squeeze(0))
-                # Check for indexing
-                selections.append(idxs)
-                 # Should be done decoding
-                if len(active) == 0:
-                    break
-                decoder_input = Variable(decoder_input.data.repeat(self.beam_size, 1))
+            return self.beam_search(decoder_input, embedded_inputs, hidden,
+                    (glimpse_ref, pointer_ref), recurrence)
 
-            return (outputs, selections), hidden
+    def beam_search(self, decoder_input, embedded_inputs, hidden, refs, recurrence):
+        """
+        Batched beam search. All beams of all instances are decoded together
+        as [batch_size * beam_size] rows, where row b * beam_size + k is beam k
+        of instance b, so each step is one top-k over [batch_size, beam_size * sourceL]
 
-    def decode_stochastic(self, probs, embedded_inputs, selections):
+        Args:
+            same as forward, except refs are the glimpse and pointer
+            projections of the context, plus the recurrence for one decoding step
+        Returns:
+            the best hypothesis of each instance, in the same format
+            as stochastic and greedy decoding
+        """
+        K = self.beam_size
+        sourceL, batch_size, _ = embedded_inputs.size()
+        device = embedded_inputs.device
+        batch_idxs = batch_arange(batch_size, device)
+        # the instance each row belongs to
+        row_batch = batch_idxs.repeat_interleave(K)
+        decoder_input = decoder_input.repeat_interleave(K, 0)
+        glimpse_ref, pointer_ref = [e.repeat_interleave(K, 0) for e in refs]
+        hidden = (hidden[0].repeat_interleave(K, 0), hidden[1].repeat_interleave(K, 0))
+        # all beams start out identical, so only the first one is expanded at step 0
+        scores = torch.full((batch_size, K), -np.inf, device=device)
+        scores[:, 0] = 0.
+        visited = VisitedMask(batch_size * K, sourceL, device)
+        step_probs, step_parents, step_idxs = [], [], []
+        for i in range(self.max_length):
+            hx, cx, probs = recurrence(decoder_input, hidden, visited,
+                    glimpse_ref, pointer_ref)
+            logprobs = torch.log(probs)
+            # beams with a -inf score can end up with every input masked
+            logprobs = logprobs.masked_fill(logprobs != logprobs, -np.inf)
+            candidates = scores.unsqueeze(2) + logprobs.view(batch_size, K, sourceL)
+            # [batch_size x beam_size], sorted best first
+            scores, best = candidates.view(batch_size, -1).topk(K, dim=1)
+            parents = best // sourceL
+            beam_idxs = best % sourceL
+            # reorder the per-beam state by the backpointers
+            rows = (parents + (batch_idxs * K).unsqueeze(1)).view(-1)
+            hidden = (hx.index_select(0, rows), cx.index_select(0, rows))
+            idxs = beam_idxs.view(-1)
+            visited.reorder(rows)
+            visited.visit(idxs)
+            decoder_input = embedded_inputs[idxs, row_batch]
+            step_probs.append(probs.view(batch_size, K, sourceL))
+            step_parents.append(parents)
+            step_idxs.append(beam_idxs)
+
+        # walk the backpointers from the best beam
+        k = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+        outputs = []
+        selections = []
+        for probs, parents, beam_idxs in reversed(list(zip(step_probs, step_parents, step_idxs))):
+            selections.append(beam_idxs.gather(1, k).squeeze(1))
+            k = parents.gather(1, k)
+            outputs.append(probs[batch_idxs, k.squeeze(1)])
+        outputs.reverse()
+        selections.reverse()
+        best_rows = batch_idxs * K
+        hidden = (hidden[0].index_select(0, best_rows), hidden[1].index_select(0, best_rows))
+        return (outputs, selections), hidden
+
+    def decode_stochastic(self, probs, embedded_inputs):
         """
         Return the next input for the decoder by sampling from the 
-        input probabilities
+        input probabilities. Visited inputs have zero probability,
+        so one draw is always valid
 
         Args: 
             probs: [batch_size x sourceL]
             embedded_inputs: [sourceL x batch_size x embedding_dim]
-            selections: list of all of the previously selected indices during decoding
        Returns:
             Tensor of size [batch_size x sourceL] containing the embeddings
             from the inputs corresponding to the [batch_size] indices
             selected for this iteration of the decoding, as well as the 
             corresponding indicies
         """
-        batch_size = probs.size(0)
         # idxs is [batch_size]
-        idxs = probs.multinomial().squeeze(1)
-
-        # due to race conditions, might need to resample here
-        for old_idxs in selections:
-            # compare new idxs
-            # elementwise with the previous idxs. If any matches,
-            # then need to resample
-            if old_idxs.eq(idxs).data.any():
-                print(' [!] resampling due to race condition')
-                idxs = probs.multinomial().squeeze(1)
-                break
-
-        sels = embedded_inputs[idxs.data, [i for i in range(batch_size)], :] 
+        idxs = probs.multinomial(1).squeeze(1)
+        sels = select_inputs(embedded_inputs, idxs)
         return sels, idxs
 
-    def decode_beam(self, probs, embedded_inputs, beam, batch_size, n_best, step):
-        active = []
-        for b in range(batch_size):
-            if beam[b].done:
-                continue
-
-            if not beam[b].advance(probs.data[b]):
-                active += [b]
-        
-        
-        all_hyp, all_scores = [], []
-        for b in range(batch_size):
-            scores, ks = beam[b].sort_best()
-            all_scores += [scores[:n_best]]
-            hyps = zip(*[beam[b].get_hyp(k) for k in ks[:n_best]])
-            all_hyp += [hyps]
-        
-        all_idxs = Variable(torch.LongTensor([[x for x in hyp] for hyp in all_hyp]).squeeze())
-      
-        if all_idxs.dim() == 2:
-            if all_idxs.size(1) > n_best:
-                idxs = all_idxs[:,-1]
-            else:
-                idxs = all_idxs
-        elif all_idxs.dim() == 3:
-            idxs = all_idxs[:, -1, :]
-        else:
-            if all_idxs.size(0) > 1:
-                idxs = all_idxs[-1]
-            else:
-                idxs = all_idxs
-        
-        if self.use_cuda:
-            idxs = idxs.cuda()
-
-        if idxs.dim() > 1:
-            x = embedded_inputs[idxs.transpose(0,1).contiguous().data, 
-                    [x for x in range(batch_size)], :]
-        else:
-            x = embedded_inputs[idxs.data, [x for x in range(batch_size)], :]
-        return x.view(idxs.size(0) * n_best, embedded_inputs.size(2)), idxs, active
-
-    def decode_greedy(self, probs, embedded_inputs, selections):
+    def decode_greedy(self, probs, embedded_inputs):
         """
         Return the next input for the decoder by selecting the 
         input corresponding to the max output
@@ -311,17 +324,15 @@ class Decoder(nn.Module):
         Args: 
             probs: [batch_size x sourceL]
             embedded_inputs: [sourceL x batch_size x embedding_dim]
-            selections: list of all of the previously selected indices during decoding
         Returns:
             Tensor of size [batch_size x sourceL] containing the embeddings
             from the inputs corresponding to the [batch_size] indices
             selected for this iteration of the decoding, as well as the 
             corresponding indicies
         """
-        batch_size = probs.size(0)
         # idxs is [batch_size]
         _, idxs = probs.max(1)
-        sels = embedded_inputs[idxs.data, [i for i in range(batch_size)], :] 
+        sels = select_inputs(embedded_inputs, idxs)
         return sels, idxs
 
 class PointerNetwork(nn.Module):
@@ -364,10 +375,11 @@ class PointerNetwork(nn.Module):
         self.decoder_in_0.data.uniform_(-(1. / math.sqrt(embedding_dim)),
                 1. / math.sqrt(embedding_dim))
             
-    def forward(self, inputs):
+    def forward(self, inputs, start_idxs=None):
         """ Propagate inputs through the network
         Args: 
             inputs: [sourceL x batch_size x embedding_dim]
+            start_idxs: optional [batch_size] first inputs to select
         """
         
         (encoder_hx, encoder_cx) = self.encoder.enc_init_state
@@ -381,7 +393,8 @@ class PointerNetwork(nn.Module):
         (pointer_probs, input_idxs), dec_hidden_t = self.decoder(decoder_input,
                 inputs,
                 dec_init_state,
-                enc_h)
+                enc_h,
+                start_idxs)
 
         return pointer_probs, input_idxs
         
@@ -425,8 +438,9 @@ class CriticNetwork(nn.Module):
         enc_outputs, (enc_h_t, enc_c_t) = self.encoder(inputs, (encoder_hx, encoder_cx))
         # grab the hidden state and process it via the process block 
         process_block_state = enc_h_t[-1]
+        process_block_ref = self.process_block.project(enc_outputs)
         for i in range(self.n_process_block_iters):
-            ref, logits = self.process_block(process_block_state, enc_outputs)
+            ref, logits = self.process_block(process_block_state, enc_outputs, process_block_ref)
             process_block_state = torch.bmm(ref, self.sm(logits).unsqueeze(2)).squeeze(2)
         # produce the final scalar output
         out = self.decoder(process_block_state)
@@ -453,6 +467,7 @@ class NeuralCombOptRL(nn.Module):
             use_cuda):
         super(NeuralCombOptRL, self).__init__()
         self.input_dim = input_dim
+        self.n_nodes = max_decoding_len
         self.is_train = is_train
         self.use_cuda = use_cuda
         
@@ -486,52 +501,34 @@ class NeuralCombOptRL(nn.Module):
     def decode_type(self, dt):
         self.actor_net.decoder.decode_type = dt
 
-    def forward(self, inputs):
+    def forward(self, inputs, start_idxs=None):
         """
         Args:
             inputs: [batch_size, input_dim, sourceL]
+            start_idxs: optional [batch_size] first inputs to select
         """
-        batch_size = inputs.size(0)
-        input_dim = inputs.size(1)
-        sourceL = inputs.size(2)
-        # repeat embeddings across batch_size
-        # result is [batch_size x input_dim x embedding_dim]
-        embedding = self.embedding.repeat(batch_size, 1, 1)  
-        embedded_inputs = []
-        # result is [batch_size, 1, input_dim, sourceL] 
-        ips = inputs.unsqueeze(1)
-        for i in range(sourceL):
-            # [batch_size x 1 x input_dim] * [batch_size x input_dim x embedding_dim]
-            # result is [batch_size, embedding_dim]
-            embedded_inputs.append(torch.bmm(
-                ips[:, :, :, i].float(),
-                embedding).squeeze(1))
-
-        # Result is [sourceL x batch_size x embedding_dim]
-        embedded_inputs = torch.cat(embedded_inputs).view(
-                sourceL,
-                batch_size,
-                embedding.size(2))
+        # [batch_size x sourceL x input_dim] * [input_dim x embedding_dim]
+        # result is [sourceL x batch_size x embedding_dim]
+        embedded_inputs = torch.matmul(inputs.transpose(1, 2).float(),
+                self.embedding).transpose(0, 1)
         # query the actor net for the input indices 
         # making up the output, and the pointer attn 
-        probs_, action_idxs = self.actor_net(embedded_inputs)
+        probs_, action_idxs = self.actor_net(embedded_inputs, start_idxs)
        
         # Select the actions (inputs pointed to 
         # by the pointer net) and the corresponding
         # logits
-        # should be size [batch_size x 
-        actions = []
-        # inputs is [batch_size, input_dim, sourceL]
-        inputs_ = inputs.transpose(1, 2)
+        # idxs is [batch_size x sourceL], the input selected at each step
+        idxs = torch.stack(action_idxs, 1)
         # inputs_ is [batch_size, sourceL, input_dim]
-        for action_id in action_idxs:
-            actions.append(inputs_[[x for x in range(batch_size)], action_id.data, :])
+        inputs_ = inputs.transpose(1, 2)
+        actions = inputs_.gather(1, idxs.unsqueeze(2).expand(-1, -1, inputs_.size(2)))
+        # list of len sourceL of [batch_size x input_dim]
+        actions = list(actions.unbind(1))
 
         if self.is_train:
-            # probs_ is a list of len sourceL of [batch_size x sourceL]
-            probs = []
-            for prob, action_id in zip(probs_, action_idxs):
-                probs.append(prob[[x for x in range(batch_size)], action_id.data])
+            # list of len sourceL of [batch_size]
+            probs = list(torch.stack(probs_, 1).gather(2, idxs.unsqueeze(2)).squeeze(2).unbind(1))
         else:
             # return the list of len sourceL of [batch_size x sourceL]
             probs = probs_
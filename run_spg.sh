@@ -23,6 +23,8 @@ EPSILON=1.
 EPSILON_DECAY_RATE=0.95
 EPSILON_DECAY_STEP=$TRAIN_SIZE
 BUFFER_SIZE=1000000
+UPDATES_PER_STEP=1
+ROLLOUTS_PER_UPDATE=1
 SINKHORN_TAU=0.05
 SINKHORN_ITERS=10
 ID=$RANDOM_SEED
@@ -53,4 +55,5 @@ python3 train_spg.py --task $COP --arch $ARCH --train_size $TRAIN_SIZE \
                     --critic_lr_decay_rate $CRITIC_LR_DECAY_RATE --critic_lr_decay_step $CRITIC_LR_DECAY_STEP \
                     --k_exchange $K_EXCHANGE --use_cuda $USE_CUDA --save_model $SAVE_MODEL \
                     --parallel_envs $PARALLEL_ENVS  --cuda_device $CUDA_DEVICE --base_dir $BASE_DIR \
-                    --actor_workers $ACTOR_WORKERS --replay_buffer_gpu $REPLAY_BUFFER_GPU --make_only $MAKE_ONLY
+                    --actor_workers $ACTOR_WORKERS --replay_buffer_gpu $REPLAY_BUFFER_GPU --make_only $MAKE_ONLY \
+                    --updates_per_step $UPDATES_PER_STEP --rollouts_per_update $ROLLOUTS_PER_UPDATE
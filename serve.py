@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Local HTTP server for a trained SPG actor. Concurrent single-instance
+requests are coalesced into batches by spg.serving.DynamicBatcher.
+
+    POST /solve   {"instance": [[x, y], ...]}  ->  {"permutation": [...], "reward": r}
+    GET  /stats   request latency percentiles, batch sizes and queue depth
+
+The instance is [n, n_features], as for solve.py, for any n up to the
+N of --task (2n up to 2N for mwm2D, the two graphs one after the other),
+and the reward is the task's SPG reward (higher is better).
+
+Usage:
+    python serve.py --task tsp_20 --load_path actor-epoch-1.pt --port 8000
+    python serve.py --task tsp_20 --load_path actor.ts --unix_socket /tmp/spg.sock
+    curl -s -d '{"instance": [[0.1, 0.2], ...]}' localhost:8000/solve
+"""
+import argparse
+import os
+import json
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+from pathos.multiprocessing import ProcessingPool as Pool
+
+from spg import inference
+from spg.serving import DynamicBatcher, make_solver
+import spg.util as util
+import solve
+
+parser = argparse.ArgumentParser(description="Serve a trained SPG actor over HTTP")
+parser.add_argument('--task', type=str, required=True, help="{COP}_{size}, as in training, e.g. tsp_20")
+parser.add_argument('--load_path', type=str, required=True, help='Actor saved by train_spg.py, or exported by export_spg.py (.ts)')
+parser.add_argument('--n_features', type=int, default=0, help='Features per input, 0 for the task default')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--unix_socket', type=str, default='', help='Listen on this Unix socket instead of host:port')
+parser.add_argument('--max_batch_size', type=int, default=64)
+parser.add_argument('--max_wait_ms', type=float, default=2.)
+parser.add_argument('--workers', type=int, default=0, help='Pool size for rounding psi to permutations')
+parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 leaves the default')
+parser.add_argument('--quantize', type=util.str2bool, default=False, help='Dynamic int8 quantization of the Linear/GRU layers')
+parser.add_argument('--sinkhorn_memory_mb', type=float, default=0., help='Scratch memory budget of Sinkhorn in MB, computed in chunks without gradients; 0 for dense')
+parser.add_argument('--verbose', type=util.str2bool, default=False, help='Log every request')
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class SolveHandler(BaseHTTPRequestHandler):
+    # set by make_server
+    batcher = None
+    shape = None
+    matching = False
+    verbose = False
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, self.batcher.stats())
+        else:
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/solve':
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            x = torch.tensor(body['instance'], dtype=torch.float32)
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(400, {'error': 'bad request: {}'.format(e)})
+            return
+        n_inputs, n_features = self.shape
+        if x.dim() != 2 or x.size(1) != n_features or x.size(0) == 0 or x.size(0) > n_inputs \
+                or (self.matching and x.size(0) % 2 != 0):
+            self.reply(400, {'error': 'expected an instance of shape [n, {}] with n up to {}{}, got {}'.format(
+                n_features, n_inputs, ' and even' if self.matching else '', list(x.shape))})
+            return
+        if not bool(torch.isfinite(x).all()):
+            self.reply(400, {'error': 'the instance has NaN or infinite coordinates'})
+            return
+        try:
+            perm, R = self.batcher(x)
+        except Exception as e:
+            # the batcher fails every request of the batch with the solver's exception
+            self.reply(500, {'error': 'solver failed: {}'.format(e)})
+            return
+        self.reply(200, {'permutation': perm, 'reward': R})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, *args):
+        if self.verbose:
+            BaseHTTPRequestHandler.log_message(self, *args)
+
+def load_actor(args):
+    if args['load_path'].endswith('.ts'):
+        if args['quantize']:
+            print(' [!] quantize the actor when exporting it, with export_spg.py --quantize True')
+        psi_actor = torch.jit.load(args['load_path'], map_location='cpu')
+        solve.set_sinkhorn_memory(args, psi_actor)
+        return psi_actor
+    actor = torch.load(args['load_path'], map_location=lambda storage, loc: storage, weights_only=False)
+    actor.init_hx = actor.init_hx.cpu()
+    return inference.inference_actor(actor, quantized=args['quantize'], sinkhorn_memory_mb=args['sinkhorn_memory_mb'])
+
+def make_server(args, psi_actor):
+    """Returns the server and its batcher, for psi_actor on args['task']"""
+    args['model'] = 'spg'
+    args['use_cuda'] = False
+    args = solve.task_config(args)
+    reward_fn = inference.make_reward_fn(args, solve.reward_env(args))
+    pool = Pool(args['workers']) if args['workers'] > 0 else None
+    matching = args['COP'] == 'mwm2D'
+    solve_fn = make_solver(psi_actor, args['n_nodes'], matching, reward_fn, pool, args['workers'])
+    batcher = DynamicBatcher(solve_fn, args['max_batch_size'], args['max_wait_ms'])
+    handler = type('Handler', (SolveHandler,), {'batcher': batcher, 'verbose': args['verbose'],
+        'shape': (args['n_inputs'], args['n_features']), 'matching': matching})
+    if args['unix_socket'] != '':
+        if os.path.exists(args['unix_socket']):
+            os.remove(args['unix_socket'])
+        server = ThreadingUnixHTTPServer(args['unix_socket'], handler)
+    else:
+        server = ThreadingHTTPServer((args['host'], args['port']), handler, bind_and_activate=False)
+        server.daemon_threads = True
+        # the default backlog of 5 resets connections under concurrent load
+        server.request_queue_size = 128
+        server.server_bind()
+        server.server_activate()
+    return server, batcher
+
+def main(args):
+    if args['threads'] > 0:
+        torch.set_num_threads(args['threads'])
+    print(' [*] Loading actor from {}'.format(args['load_path']))
+    server, batcher = make_server(args, load_actor(args))
+    where = args['unix_socket'] if args['unix_socket'] != '' else '{}:{}'.format(*server.server_address[:2])
+    print(' [*] serving {} on {}'.format(args['task'], where))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        print(' [*] {}'.format(batcher.stats()))
+    return 0
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
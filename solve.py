@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+Apply a trained SPG actor or NCO model to the instances in a file.
+
+Instances are streamed from the input file in batches and the solutions
+are appended to the output file after each batch, so memory use does not
+depend on the size of the input file.
+
+Input formats:
+    * .npy: an array of [n_instances, n_inputs, n_features], memory-mapped
+    * text: one instance per line, n_inputs * n_features whitespace-separated
+      numbers, all features of input 0 first, then input 1, etc.
+where n_inputs is N for sort and tsp and 2N for mwm2D (graph 1, then graph 2).
+SPG actors also solve text instances with fewer than N nodes, which are
+zero-padded to the largest instance of the batch. Only the actor takes
+such batches; the SPG critics batch-normalize over the N positions and
+reject a batch padded to fewer than N nodes.
+
+Each output line is the reward of the solution (higher is better, e.g. the
+negative tour length for tsp) followed by the permutation, i.e. the index
+of the input placed at each position (of graph 2 for mwm2D).
+
+Usage:
+    python solve.py --model spg --task tsp_20 --load_path actor-epoch-1.pt --input tsp20.npy --output tsp20.sol
+    python solve.py --model nco --task tsp_20 --load_path nco-COP-tsp-N-20-epoch-0.pt --input tsp20.txt --output tsp20.sol --k 32
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from pathos.multiprocessing import ProcessingPool as Pool
+
+from envs import sorting_task, mwm2D_task, tsp_task
+from spg import inference as spg_inference
+import spg.util as util
+from neural_combinatorial_rl import inference as nco_inference
+
+parser = argparse.ArgumentParser(description="Solve a file of instances with a trained SPG or NCO model")
+parser.add_argument('--model', type=str, default='spg', choices=['spg', 'nco'])
+parser.add_argument('--task', type=str, required=True, help="{COP}_{size}, as in training, e.g. tsp_20 or sort_0-19. SPG text instances may have fewer nodes; "
+        "they are padded to the largest of their batch, which only the actor (not the critic) accepts")
+parser.add_argument('--load_path', type=str, required=True, help='Model saved by train_spg.py/train_nco.py, or an SPG actor exported by export_spg.py (.ts)')
+parser.add_argument('--input', type=str, required=True)
+parser.add_argument('--output', type=str, required=True)
+parser.add_argument('--format', type=str, default='auto', choices=['auto', 'npy', 'txt'], help='Input format, auto picks npy for .npy files')
+parser.add_argument('--n_features', type=int, default=0, help='Features per input, 0 for the task default')
+parser.add_argument('--batch_size', type=int, default=1024)
+parser.add_argument('--workers', type=int, default=0, help='Pool size for rounding psi to permutations (SPG)')
+parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 leaves the default')
+parser.add_argument('--quantize', type=util.str2bool, default=False, help='Dynamic int8 quantization of the Linear/GRU/LSTM layers, CPU only')
+parser.add_argument('--sinkhorn_memory_mb', type=float, default=0., help='SPG: Scratch memory budget of Sinkhorn in MB, computed in chunks without gradients; 0 for dense')
+parser.add_argument('--decode_type', type=str, default='greedy', choices=['greedy', 'stochastic'], help='NCO decoding when k is 1')
+parser.add_argument('--k', type=int, default=1, help='NCO: decode k solutions per instance and keep the best')
+parser.add_argument('--multistart', type=util.str2bool, default=False, help='NCO: give each of the k solutions a distinct first node')
+parser.add_argument('--use_KT', type=util.str2bool, default=True, help='NCO sort reward')
+parser.add_argument('--use_cuda', type=util.str2bool, default=False)
+parser.add_argument('--random_seed', type=int, default=1234)
+parser.add_argument('--log_step', type=int, default=10, help='Report instances/s every log_step batches')
+
+def task_config(args):
+    """Sets COP, n_nodes, n_inputs and n_features from the task name"""
+    COP, size = args['task'].split('_')
+    args['COP'] = COP
+    if COP == 'sort':
+        low, high = size.split('-')
+        args['n_nodes'] = int(high) - int(low) + 1
+    else:
+        args['n_nodes'] = int(size)
+    args['n_inputs'] = 2 * args['n_nodes'] if COP == 'mwm2D' else args['n_nodes']
+    if args['n_features'] <= 0:
+        args['n_features'] = 1 if COP == 'sort' else 2
+    # for the NCO reward
+    args['input_size'] = args['n_nodes']
+    return args
+
+def reward_env(args):
+    """The reward function each training script uses for the task"""
+    if args['model'] == 'spg':
+        return {'sort': sorting_task.reward_ddpg_D, 'mwm2D': mwm2D_task.reward,
+                'tsp': tsp_task.reward_spg}[args['COP']]
+    return {'sort': sorting_task.reward_nco, 'mwm2D': mwm2D_task.reward_nco,
+            'tsp': tsp_task.reward_nco}[args['COP']]
+
+def read_batches(args):
+    """
+    Yields [batch_size, n_inputs, n_features] FloatTensors from the input file,
+    and the number of nodes of each instance if some were padded, else None
+    """
+    fmt = args['format']
+    if fmt == 'auto':
+        fmt = 'npy' if args['input'].endswith('.npy') else 'txt'
+    shape = (args['n_inputs'], args['n_features'])
+    if fmt == 'npy':
+        data = np.load(args['input'], mmap_mode='r')
+        if tuple(data.shape[1:]) != shape:
+            raise ValueError('expected instances of shape {}, got {}'.format(shape, data.shape[1:]))
+        for i in range(0, data.shape[0], args['batch_size']):
+            yield torch.from_numpy(np.ascontiguousarray(data[i:i + args['batch_size']], dtype=np.float32)), None
+    else:
+        batch, line_nos = [], []
+        with open(args['input'], 'r') as f:
+            for line_no, line in enumerate(f, 1):
+                if line.strip() == '':
+                    continue
+                batch.append(torch.from_numpy(np.array(line.split(), dtype=np.float32).reshape(-1, shape[1])))
+                line_nos.append(line_no)
+                if len(batch) == args['batch_size']:
+                    yield collate(args, batch, line_nos)
+                    batch, line_nos = [], []
+        if len(batch) > 0:
+            yield collate(args, batch, line_nos)
+
+def collate(args, batch, line_nos=None):
+    """
+    Stack a list of [n_i, n_features] instances into one batch, zero-padded
+    to the largest if they have fewer than n_inputs inputs. line_nos are the
+    input file lines of the instances, for the error messages
+    """
+    matching = args['COP'] == 'mwm2D'
+    for i, x in enumerate(batch):
+        if x.size(0) == 0 or x.size(0) > args['n_inputs'] or (matching and x.size(0) % 2 != 0):
+            raise ValueError('{} {}: expected an instance of shape [n, {}] with n up to {}{}, got {}'.format(
+                'line' if line_nos is not None else 'instance', line_nos[i] if line_nos is not None else i,
+                args['n_features'], args['n_inputs'], ' and even' if matching else '', list(x.shape)))
+    if all([x.size(0) == args['n_inputs'] for x in batch]):
+        return torch.stack(batch), None
+    if args['model'] != 'spg':
+        raise ValueError('only SPG actors solve instances with fewer than {} nodes'.format(args['n_nodes']))
+    # pad to the largest instance of the batch, not to N
+    n = max([x.size(0) for x in batch]) // (2 if matching else 1)
+    return util.pad_instances(batch, n, matching)
+
+def load_spg(args):
+    if args['load_path'].endswith('.ts'):
+        psi_actor = torch.jit.load(args['load_path'], map_location='cpu')
+        if args['quantize']:
+            print(' [!] quantize the actor when exporting it, with export_spg.py --quantize True')
+        set_sinkhorn_memory(args, psi_actor)
+    else:
+        actor = torch.load(args['load_path'], map_location=lambda storage, loc: storage, weights_only=False)
+        actor.init_hx = actor.init_hx.cpu()
+        psi_actor = spg_inference.inference_actor(actor, quantized=args['quantize'],
+                sinkhorn_memory_mb=args['sinkhorn_memory_mb'])
+    return spg_solver(args, psi_actor)
+
+def set_sinkhorn_memory(args, psi_actor):
+    """Set the Sinkhorn memory budget of an exported actor"""
+    if args['sinkhorn_memory_mb'] <= 0:
+        return
+    if hasattr(psi_actor, 'max_bytes'):
+        psi_actor.max_bytes = int(args['sinkhorn_memory_mb'] * 1e6)
+    else:
+        print(' [!] {} was exported without chunked Sinkhorn, export it again to use --sinkhorn_memory_mb'.format(args['load_path']))
+
+def spg_solver(args, psi_actor):
+    """solve(obs) returning the rewards and permutations of a batch"""
+    if args['use_cuda']:
+        psi_actor = psi_actor.cuda()
+    pool = Pool(args['workers']) if args['workers'] > 0 else None
+    reward_fn = spg_inference.make_reward_fn(args, reward_env(args))
+
+    def solve(obs, lengths=None):
+        with torch.no_grad():
+            # actors exported before padding support only take x
+            psi = psi_actor(obs) if lengths is None else psi_actor(obs, lengths.to(obs.device))
+        perms = util.round_to_permutations(psi.cpu().numpy(), pool, args['workers'])
+        if args['use_cuda']:
+            perms = perms.cuda()
+        R = reward_fn(obs, perms, lengths)
+        # the input at each position
+        return R, perms.argmax(1)
+    return solve
+
+def load_nco(args):
+    model = torch.load(args['load_path'], map_location=lambda storage, loc: storage, weights_only=False)
+    if args['quantize']:
+        model = nco_inference.quantize(model)
+    return nco_solver(args, model)
+
+def nco_solver(args, model):
+    """solve(obs) returning the rewards (not costs) and permutations of a batch"""
+    model.is_train = False
+    model.eval()
+    if args['use_cuda']:
+        model = model.cuda()
+    reward_fn = nco_inference.make_reward_fn(args, reward_env(args))
+
+    def solve(obs, lengths=None):
+        obs = torch.transpose(obs, 2, 1)
+        if args['k'] > 1:
+            # samples, or greedy decodes from distinct starts with --multistart
+            R, _, action_idxs = nco_inference.best_of_k(model, obs, args['k'], reward_fn, args['multistart'])
+        else:
+            model.decode_type(args['decode_type'])
+            with torch.no_grad():
+                _, actions, action_idxs, _ = model(obs)
+            R = reward_fn(obs, actions)
+        # NCO rewards are costs
+        return -R, torch.stack(action_idxs, 1)
+    return solve
+
+def main(args):
+    args = task_config(args)
+    if args['quantize'] and args['use_cuda']:
+        print(' [!] quantized models run on the CPU only')
+        return 1
+    if args['threads'] > 0:
+        torch.set_num_threads(args['threads'])
+    torch.manual_seed(args['random_seed'])
+    print(' [*] Loading model from {}'.format(args['load_path']))
+    solve = load_spg(args) if args['model'] == 'spg' else load_nco(args)
+    n = 0
+    total_R = 0.
+    start = time.perf_counter()
+    with open(args['output'], 'w') as out:
+        for step, (obs, lengths) in enumerate(read_batches(args)):
+            if args['use_cuda']:
+                obs = obs.cuda()
+            R, perms = solve(obs, lengths)
+            R = R.cpu().numpy()
+            perms = perms.cpu().numpy()
+            if lengths is not None:
+                # drop the padded positions
+                perms = [p[:n] for p, n in zip(perms, lengths.tolist())]
+            out.write(''.join(['{} {}\n'.format(r, ' '.join(map(str, p))) for r, p in zip(R, perms)]))
+            out.flush()
+            n += len(R)
+            total_R += float(R.sum())
+            if (step + 1) % args['log_step'] == 0:
+                print(' [*] {} instances, {:.1f} instances/s'.format(n, n / (time.perf_counter() - start)))
+    elapsed = time.perf_counter() - start
+    print(' [*] solved {} instances in {:.2f} s, {:.1f} instances/s, mean reward: {:.4f}'.format(
+        n, elapsed, n / max(elapsed, 1e-9), total_R / max(n, 1)))
+    print(' [*] wrote {}'.format(args['output']))
+    return 0
+
+if __name__ == '__main__':
+    exit(main(vars(parser.parse_args())))
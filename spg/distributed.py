@@ -0,0 +1,53 @@
+"""
+Helpers for data-parallel SPG training with torch.distributed, one
+process per rank on this machine, over the gloo backend
+"""
+import torch
+import torch.distributed as dist
+
+def init(rank, world_size, port):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+            rank=rank, world_size=world_size)
+
+def cleanup():
+    dist.destroy_process_group()
+
+def barrier():
+    dist.barrier()
+
+def broadcast_module(module, src=0):
+    """Copy the parameters and buffers of module on rank src to every rank"""
+    for t in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(t.data, src)
+
+def any_rank(flag):
+    """True on every rank if flag is True on any of them"""
+    t = torch.tensor([1. if flag else 0.])
+    dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    return bool(t.item() > 0)
+
+def all_reduce_gradients(module):
+    """
+    Average the gradients of module across ranks, as one flat all-reduce
+    over all its trainable parameters, with a count of the ranks that have
+    a gradient for each. A rank without a gradient for a parameter, e.g.
+    one its batch did not reach, contributes zeros. Parameters that no
+    rank has a gradient for keep grad None, so the optimizer skips them as
+    it would in a single process
+    """
+    params = [p for p in module.parameters() if p.requires_grad]
+    flat = torch.cat([p.grad.contiguous().view(-1) if p.grad is not None else p.new_zeros(p.numel())
+        for p in params] + [torch.tensor([0. if p.grad is None else 1. for p in params])])
+    dist.all_reduce(flat)
+    counts = flat[-len(params):]
+    flat = flat[:-len(params)] / dist.get_world_size()
+    offset = 0
+    for p, count in zip(params, counts.tolist()):
+        n = p.numel()
+        if count > 0:
+            g = flat[offset:offset + n].view_as(p)
+            if p.grad is None:
+                p.grad = g.clone()
+            else:
+                p.grad.copy_(g)
+        offset += n
@@ -0,0 +1,192 @@
+"""
+Inference-only SPG actors. They map the input to psi, the doubly
+stochastic matrix, as a pure tensor-in/tensor-out graph, so they can be
+scripted with TorchScript, saved, and loaded with torch.jit.load without
+the training code (pathos pools, Variables, the profiler, etc.)
+
+    psi_actor = inference_actor(actor)
+    export(actor, 'actor.ts')
+    psi = torch.jit.load('actor.ts')(x)
+"""
+import copy
+from typing import Optional
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    from torch.quantization import quantize_dynamic
+
+from spg.models import SPGSequentialActor, SPGMatchingActor
+from spg.layers import sinkhorn
+
+
+def _length_mask(lengths, max_len: int):
+    # util.length_mask, annotated for TorchScript
+    return torch.arange(max_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+
+class SequentialPsi(nn.Module):
+    """
+    psi = SequentialPsi(actor)(x), for x of [batch_size, n_nodes, n_features],
+    or SequentialPsi(actor)(x, lengths) for instances zero-padded to at most n_nodes
+    """
+    def __init__(self, actor):
+        super(SequentialPsi, self).__init__()
+        self.n_nodes = int(actor.n_nodes)
+        self.embedding = copy.deepcopy(actor.embedding)
+        self.gru = copy.deepcopy(actor.gru)
+        self.fc2 = copy.deepcopy(actor.fc2)
+        self.register_buffer('init_hx', actor.init_hx.detach().clone())
+        self.tau = float(actor.sinkhorn.tau)
+        self.sinkhorn_iters = int(actor.sinkhorn.sinkhorn_iters)
+        self.max_bytes = int(actor.sinkhorn.max_bytes)
+
+    def forward(self, x, lengths: Optional[torch.Tensor] = None):
+        batch_size = x.size(0)
+        x = F.leaky_relu(self.embedding(x))
+        x = torch.transpose(x, 0, 1)
+        init_hx = self.init_hx.unsqueeze(1).repeat(1, batch_size, 1)
+        if lengths is None:
+            h_last, _ = self.gru(x, init_hx)
+            return sinkhorn(self.fc2(torch.transpose(h_last, 0, 1)), self.tau, self.sinkhorn_iters,
+                max_bytes=self.max_bytes)
+        # the batch may be padded to fewer than n_nodes
+        n = x.size(0)
+        packed = pack_padded_sequence(x, lengths.cpu(), enforce_sorted=False)
+        h_packed, _ = self.gru(packed, init_hx)
+        h_last, _ = pad_packed_sequence(h_packed, total_length=n)
+        M = self.fc2(torch.transpose(h_last, 0, 1))[:, :, 0:n]
+        return sinkhorn(M, self.tau, self.sinkhorn_iters, mask=_length_mask(lengths, n), max_bytes=self.max_bytes)
+
+
+class MatchingPsi(nn.Module):
+    """
+    psi = MatchingPsi(actor)(x), for x of [batch_size, 2 * n_nodes, n_features],
+    or MatchingPsi(actor)(x, lengths) with both graphs zero-padded to at most n_nodes
+    """
+    def __init__(self, actor):
+        super(MatchingPsi, self).__init__()
+        if actor.sparse_k > 0:
+            # the kNN support needs a maximum matching on the CPU, see util.knn_support
+            raise ValueError('the inference actor has no sparse Sinkhorn, set sparse_k = 0 on the actor '
+                'to run dense Sinkhorn')
+        self.n_nodes = int(actor.n_nodes)
+        self.embedding = copy.deepcopy(actor.embedding)
+        self.gru = copy.deepcopy(actor.gru)
+        self.fc1 = copy.deepcopy(actor.fc1)
+        self.register_buffer('init_hx', actor.init_hx.detach().clone())
+        self.tau = float(actor.sinkhorn.tau)
+        self.sinkhorn_iters = int(actor.sinkhorn.sinkhorn_iters)
+        self.max_bytes = int(actor.sinkhorn.max_bytes)
+
+    def forward(self, x, lengths: Optional[torch.Tensor] = None):
+        batch_size = x.size(0)
+        n = x.size(1) // 2
+        g1 = F.leaky_relu(self.embedding(x[:, 0:n, :]))
+        g2 = F.leaky_relu(self.embedding(x[:, n:2 * n, :]))
+        mask: Optional[torch.Tensor] = None
+        if lengths is not None:
+            mask = _length_mask(lengths, n)
+            g1 = g1 * mask.unsqueeze(2).float()
+            g2 = g2 * mask.unsqueeze(2).float()
+        # take outer product, result is [batch_size, N, N]
+        x = torch.bmm(g2, torch.transpose(g1, 2, 1))
+        if n < self.n_nodes:
+            x = F.pad(x, [0, self.n_nodes - n])
+        x = torch.transpose(x, 0, 1)
+        init_hx = self.init_hx.unsqueeze(1).repeat(1, batch_size, 1)
+        if lengths is None:
+            h, _ = self.gru(x, init_hx)
+        else:
+            packed = pack_padded_sequence(x, lengths.cpu(), enforce_sorted=False)
+            h_packed, _ = self.gru(packed, init_hx)
+            h, _ = pad_packed_sequence(h_packed, total_length=n)
+        h = torch.transpose(h, 0, 1)
+        M = self.fc1(h)[:, :, 0:n]
+        return sinkhorn(M, self.tau, self.sinkhorn_iters, mask=mask, max_bytes=self.max_bytes)
+
+
+def quantize(psi_actor):
+    """
+    Dynamic int8 quantization of the Linear and GRU layers of an inference
+    actor, for CPU inference. Weights are stored in int8 and activations
+    are quantized on the fly, so no calibration data is needed. Sinkhorn
+    runs on the float output of the last layer and stays in float
+    """
+    return quantize_dynamic(psi_actor, {nn.Linear, nn.GRU}, dtype=torch.qint8)
+
+def inference_actor(actor, script=False, compile=False, quantized=False, sinkhorn_memory_mb=0.):
+    """
+    Copy the weights of a trained SPGSequentialActor or SPGMatchingActor
+    into the matching inference module, in eval mode and without gradients
+
+    Args:
+        actor: the trained actor
+        script: return the torch.jit.script'ed module
+        compile: return the torch.compile'd module, when torch.compile is available
+        quantized: dynamic int8 quantization of the Linear and GRU layers, CPU only
+        sinkhorn_memory_mb: scratch memory budget of Sinkhorn, see layers.chunked_sinkhorn,
+            0 keeps the budget of the actor's Sinkhorn layer
+    """
+    if isinstance(actor, SPGSequentialActor):
+        psi_actor = SequentialPsi(actor)
+    elif isinstance(actor, SPGMatchingActor):
+        psi_actor = MatchingPsi(actor)
+    else:
+        raise ValueError('no inference actor for {}'.format(type(actor).__name__))
+    if sinkhorn_memory_mb > 0:
+        psi_actor.max_bytes = int(sinkhorn_memory_mb * 1e6)
+    psi_actor.eval()
+    for p in psi_actor.parameters():
+        p.requires_grad = False
+    if quantized:
+        psi_actor = quantize(psi_actor)
+    if script:
+        psi_actor = torch.jit.script(psi_actor)
+    if compile:
+        if hasattr(torch, 'compile'):
+            psi_actor = torch.compile(psi_actor)
+        else:
+            print(' [!] torch.compile is not available in torch {}, using the eager module'.format(torch.__version__))
+    return psi_actor
+
+def export(actor, path, quantized=False):
+    """Script the inference actor of actor and save it to path, to be loaded with torch.jit.load"""
+    psi_actor = inference_actor(actor, script=True, quantized=quantized)
+    torch.jit.save(psi_actor, path)
+    return psi_actor
+
+def make_reward_fn(args, env):
+    """
+    Wraps the SPG task reward the same way train_spg.py applies it
+
+    Args:
+        args: uses COP, n_nodes and use_cuda
+        env: the SPG reward function of the task
+    Returns:
+        reward_fn(obs, perms, lengths=None), where obs is [batch_size, n_inputs, n_features]
+        and perms is [batch_size, n, n], n <= n_nodes, returning the
+        [batch_size] rewards (higher is better). lengths is the number of
+        valid nodes of zero-padded instances, see util.pad_instances
+    """
+    def reward_fn(obs, perms, lengths=None):
+        # padded batches may be padded to fewer than n_nodes
+        N = perms.size(1)
+        # the rewards only take lengths for padded batches
+        kwargs = {} if lengths is None else {'lengths': lengths}
+        if args['COP'] == 'sort' or args['COP'] == 'tsp':
+            # apply the permutation to the input
+            solutions = torch.matmul(torch.transpose(obs, 1, 2), perms)
+            if args['COP'] == 'tsp':
+                solutions = torch.transpose(solutions, 1, 2)
+            R = env(solutions, args['use_cuda'], **kwargs)
+        elif args['COP'] == 'mwm2D':
+            matchings = torch.matmul(torch.transpose(obs[:, N:2*N, :], 1, 2), perms)
+            matchings = torch.transpose(matchings, 1, 2)
+            matchings = torch.cat([obs[:, 0:N, :], matchings], dim=1)
+            R = env(matchings, args['use_cuda'], **kwargs)
+        return R.view(-1)
+    return reward_fn
@@ -3,9 +3,93 @@ from torch.nn.parameter import Parameter
 from torch.nn.modules.module import Module
 from torch.autograd import Variable
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import numpy as np
+from typing import List, Optional
+try:
+    from torch.func import functional_call
+except ImportError:
+    from torch.nn.utils.stateless import functional_call
 
-from spg.util import logsumexp
+
+def mask_logits(x, mask):
+    """
+    Restrict the [batch_size, N, N] logits x of padded instances to their
+    valid rows and cols. Entries outside the valid block are set to -inf,
+    except on the diagonal of the padded block, which is set to 0, so each
+    row and col keeps one finite entry. Sinkhorn then normalizes the valid
+    block on its own, and psi rounds to a permutation that leaves the
+    padded nodes in place.
+
+    Args:
+        x: [batch_size, N, N]
+        mask: [batch_size, N] bool, True for the valid nodes
+    """
+    valid = mask.unsqueeze(2) & mask.unsqueeze(1)
+    pad = ~mask
+    pad_diag = pad.unsqueeze(2) & torch.eye(x.size(1), dtype=torch.bool, device=x.device).unsqueeze(0)
+    x = x.masked_fill(~valid, float('-inf'))
+    return x.masked_fill(pad_diag, 0.)
+
+def run_rnn(rnn, x, hx, lengths=None):
+    """
+    Run rnn over x, [seq_len, batch_size, input_dim]. With lengths, the
+    padded steps of each sequence are packed away, so they never reach the
+    valid steps (e.g. of the backward direction of a bidirectional GRU),
+    and their outputs are zeros. A bfloat16 x on the CPU, as under
+    --precision bf16, goes through autocast_rnn
+    """
+    if x.device.type == 'cpu' and x.dtype == torch.bfloat16:
+        return autocast_rnn(rnn, x, hx, lengths)
+    if lengths is None:
+        return rnn(x, hx)
+    packed = pack_padded_sequence(x, lengths.cpu(), enforce_sorted=False)
+    h, hx = rnn(packed, hx)
+    h, _ = pad_packed_sequence(h, total_length=x.size(0))
+    return h, hx
+
+def autocast_rnn(rnn, x, hx, lengths=None):
+    """
+    run_rnn under CPU autocast, which leaves nn.GRU out. The weights and
+    hidden state are cast to the dtype of x for the call; the float32
+    parameters are what the optimizer updates
+    """
+    dtype = x.dtype
+    params = dict([(name, p.to(dtype)) for name, p in rnn.named_parameters()])
+    with torch.autocast('cpu', enabled=False):
+        hx = hx.to(dtype)
+        if lengths is None:
+            return functional_call(rnn, params, (x, hx))
+        packed = pack_padded_sequence(x, lengths.cpu(), enforce_sorted=False)
+        h, hx = functional_call(rnn, params, (packed, hx))
+        h, _ = pad_packed_sequence(h, total_length=x.size(0))
+    return h, hx
+
+def log_normalize(x, dim: int):
+    """x - logsumexp(x, dim), as util.logsumexp computes it, in a form TorchScript can compile"""
+    s, _ = torch.max(x, dim=dim, keepdim=True)
+    return x - (s + (x - s).exp().sum(dim=dim, keepdim=True).log())
+
+def sinkhorn(x, tau: float, sinkhorn_iters: int, eps: float = 1e-6, mask: Optional[torch.Tensor] = None,
+        max_bytes: int = 0):
+    """
+    The Sinkhorn normalization of the [batch_size, N, N] logits x, in
+    log-scale, or chunked_sinkhorn if max_bytes > 0. Shared by the Sinkhorn
+    layer and the scripted inference actors, see spg.inference
+
+    Args:
+        mask: optional [batch_size, N] bool, True for the valid nodes of padded instances
+        max_bytes: scratch memory budget of chunked_sinkhorn, which tracks no gradients
+    """
+    if max_bytes > 0:
+        return chunked_sinkhorn(x, tau, sinkhorn_iters, max_bytes, eps, mask)
+    x = x / tau
+    if mask is not None:
+        x = mask_logits(x, mask)
+    for _ in range(sinkhorn_iters):
+        x = log_normalize(x, 2)
+        x = log_normalize(x, 1)
+    return torch.exp(x) + eps
 
 class Sinkhorn(Module):
     """
@@ -14,33 +98,145 @@ class Sinkhorn(Module):
     If L is too large or tau is too small, gradients will disappear 
     and cause the network to NaN out!
     """    
-    def __init__(self, n_nodes, sinkhorn_iters=5, tau=0.01):
+    # scratch memory budget of chunked_sinkhorn in bytes, 0 for the dense layer
+    max_bytes = 0
+
+    def __init__(self, n_nodes, sinkhorn_iters=5, tau=0.01, max_bytes=0):
         super(Sinkhorn, self).__init__()
         self.n_nodes = n_nodes
         self.tau = tau
         self.sinkhorn_iters = sinkhorn_iters
+        self.max_bytes = max_bytes
 
     def row_norm(self, x):
         """Unstable implementation"""
         #y = torch.matmul(torch.matmul(x, self.ones), torch.t(self.ones))
         #return torch.div(x, y)
         """Stable, log-scale implementation"""
-        return x - logsumexp(x, dim=2, keepdim=True)
+        return log_normalize(x, 2)
 
     def col_norm(self, x):
         """Unstable implementation"""
         #y = torch.matmul(torch.matmul(self.ones, torch.t(self.ones)), x)
         #return torch.div(x, y)
         """Stable, log-scale implementation"""
-        return x - logsumexp(x, dim=1, keepdim=True)
+        return log_normalize(x, 1)
 
-    def forward(self, x, eps=1e-6):
+    def forward(self, x, eps=1e-6, mask=None):
         """ 
             x: [batch_size, N, N]
+            mask: optional [batch_size, N] bool, True for the valid nodes of padded instances
+
+        With max_bytes > 0 and no gradient to track, e.g. under torch.no_grad(),
+        runs chunked_sinkhorn instead. Under mixed precision x may be
+        bfloat16; the normalization always runs in float32
         """
-        x = x / self.tau
-        for _ in range(self.sinkhorn_iters):
-            x = self.row_norm(x)
-            x = self.col_norm(x)
-        return torch.exp(x) + eps
+        x = x.float()
+        max_bytes = self.max_bytes
+        if torch.is_grad_enabled() and x.requires_grad:
+            max_bytes = 0
+        return sinkhorn(x, self.tau, self.sinkhorn_iters, eps, mask, max_bytes)
 
+
+def sinkhorn_chunks(batch_size: int, N: int, max_bytes: int, element_size: int = 4) -> List[int]:
+    """
+    [instances per chunk, rows per block] for chunked_sinkhorn, such that
+    the ~2 temporaries of a [chunk, rows, N] block fit in max_bytes. Whole
+    instances are preferred, blocks of rows of one instance otherwise
+    """
+    row_bytes = 2 * N * element_size
+    rows = max(1, min(N, max_bytes // row_bytes))
+    if rows < N:
+        return [1, rows]
+    return [max(1, min(batch_size, max_bytes // (row_bytes * N))), N]
+
+def sinkhorn_peak_bytes(batch_size, N, max_bytes, element_size=4):
+    """Bytes chunked_sinkhorn allocates at its peak: psi, plus the scratch of one block"""
+    chunk, rows = sinkhorn_chunks(batch_size, N, max_bytes, element_size)
+    return (batch_size * N * N + 2 * chunk * rows * N) * element_size
+
+def chunked_sinkhorn(x, tau: float, sinkhorn_iters: int, max_bytes: int, eps: float = 1e-6,
+        mask: Optional[torch.Tensor] = None):
+    """
+    Sinkhorn without gradients under a memory budget. The dense layer
+    allocates several [batch_size, N, N] temporaries per iteration; here
+    psi is normalized in place, a chunk of instances at a time, and the
+    row and col logsumexps are computed over blocks of rows, so besides
+    psi itself at most max_bytes of scratch are live
+    (see sinkhorn_peak_bytes). Matches Sinkhorn.forward up to float
+    rounding
+
+    Args:
+        x: [batch_size, N, N]
+        max_bytes: scratch memory budget, see sinkhorn_chunks
+        mask: optional [batch_size, N] bool, True for the valid nodes of padded instances
+    """
+    batch_size = x.size(0)
+    N = x.size(1)
+    chunks = sinkhorn_chunks(batch_size, N, max_bytes, x.element_size())
+    chunk = chunks[0]
+    rows = chunks[1]
+    out = torch.empty_like(x)
+    for b0 in range(0, batch_size, chunk):
+        b1 = min(b0 + chunk, batch_size)
+        y = out[b0:b1]
+        y.copy_(x[b0:b1]).div_(tau)
+        if mask is not None:
+            # mask_logits, a block at a time
+            m = mask[b0:b1]
+            for r0 in range(0, N, rows):
+                r1 = min(r0 + rows, N)
+                block = y[:, r0:r1]
+                block.masked_fill_(~(m[:, r0:r1].unsqueeze(2) & m.unsqueeze(1)), float('-inf'))
+                block.diagonal(r0, 1, 2).masked_fill_(~m[:, r0:r1], 0.)
+        for _ in range(sinkhorn_iters):
+            for r0 in range(0, N, rows):
+                block = y[:, r0:min(r0 + rows, N)]
+                block.sub_(torch.logsumexp(block, dim=2, keepdim=True))
+            # col logsumexp over the row blocks, max first, then the sum
+            col_max = y.new_full((b1 - b0, 1, N), float('-inf'))
+            for r0 in range(0, N, rows):
+                col_max = torch.maximum(col_max, y[:, r0:min(r0 + rows, N)].amax(dim=1, keepdim=True))
+            col_sum = torch.zeros_like(col_max)
+            for r0 in range(0, N, rows):
+                col_sum += (y[:, r0:min(r0 + rows, N)] - col_max).exp_().sum(dim=1, keepdim=True)
+            lse = col_max + col_sum.log()
+            for r0 in range(0, N, rows):
+                y[:, r0:min(r0 + rows, N)].sub_(lse)
+        y.exp_().add_(eps)
+    return out
+
+def segment_logsumexp(x, segments, n_segments):
+    """
+    logsumexp of the entries of x in each segment
+
+    Args:
+        x: [E] values
+        segments: [E] LongTensor, the segment of each value, in [0, n_segments)
+    Returns:
+        [n_segments], -inf for empty segments
+    """
+    # the max only stabilizes the exp, so it needs no gradient
+    s = x.new_full((n_segments,), float('-inf')).scatter_reduce(0, segments, x.detach(), reduce='amax')
+    s = s.masked_fill(torch.isinf(s), 0.)
+    sums = x.new_zeros(n_segments).index_add(0, segments, torch.exp(x - s[segments]))
+    return s + torch.log(sums)
+
+def sparse_sinkhorn(x, rows, cols, n_segments, tau=0.01, sinkhorn_iters=5, eps=1e-6):
+    """
+    Log-domain Sinkhorn over a sparse support, e.g. from util.knn_support.
+    Each row and col of the support must have at least one entry.
+
+    Args:
+        x: [E] logits of the entries of the support
+        rows, cols: [E] LongTensors, the row and col of each entry, numbered
+            across the batch, i.e. b * N + i
+        n_segments: batch_size * N
+    Returns:
+        [E] the entries of psi on the support
+    """
+    x = x.float() / tau
+    for _ in range(sinkhorn_iters):
+        x = x - segment_logsumexp(x, rows, n_segments)[rows]
+        x = x - segment_logsumexp(x, cols, n_segments)[cols]
+    return torch.exp(x) + eps
@@ -52,15 +52,26 @@ def array_min2d(x):
 
 
 class Memory:
-    def __init__(self, limit, action_shape, observation_shape, use_cuda=True):
+    """
+    With encoding_shape and encoding_limit > 0, the actor's encoder outputs
+    for the latest encoding_limit entries are kept as well, with the
+    learner step at which they were computed
+    """
+    def __init__(self, limit, action_shape, observation_shape, use_cuda=True,
+            encoding_shape=None, encoding_limit=0):
         self.limit = limit
 
         self.observations = RingBuffer(limit, observation_shape, use_cuda)
         self.discrete_actions = RingBuffer(limit, action_shape, use_cuda, dtype='torch.ByteTensor')
         self.dense_actions = RingBuffer(limit, action_shape, use_cuda)
         self.rewards = RingBuffer(limit, [1], use_cuda)
+        self.encodings = None
+        if encoding_shape is not None and encoding_limit > 0:
+            encoding_limit = min(encoding_limit, limit)
+            self.encodings = RingBuffer(encoding_limit, encoding_shape, use_cuda)
+            self.encoding_steps = RingBuffer(encoding_limit, [1], use_cuda, dtype='torch.LongTensor')
 
-    def sample(self, batch_size):
+    def sample(self, batch_size, with_encodings=False):
         # Draw such that we always have a proceeding element.
         batch_idxs = np.random.random_integers(self.nb_entries - 2, size=batch_size)
 
@@ -69,14 +80,37 @@ class Memory:
         dense_actions_batch = self.dense_actions.get_batch(batch_idxs)
         reward_batch = self.rewards.get_batch(batch_idxs)
 
+        if with_encodings:
+            encoding_batch, step_batch = self.get_encodings(batch_idxs)
+            return obs_batch, discrete_actions_batch, dense_actions_batch, reward_batch, encoding_batch, step_batch
         return obs_batch, discrete_actions_batch, dense_actions_batch, reward_batch
 
-    def append(self, obs, discrete_action, dense_action, reward):
+    def get_encodings(self, batch_idxs):
+        """
+        The cached encodings of the entries batch_idxs, and the learner step
+        each was computed at, as a [batch_size] LongTensor. Entries that
+        have dropped out of the cache get zeros and step -1
+        """
+        # the cache holds the latest len(self.encodings) entries, in order
+        cache_idxs = batch_idxs - (self.nb_entries - len(self.encodings))
+        cached = np.nonzero(cache_idxs >= 0)[0]
+        encoding_batch = self.encodings.data.new_zeros(len(batch_idxs), *self.encodings.data.size()[1:])
+        step_batch = self.encoding_steps.data.new_full((len(batch_idxs),), -1)
+        if len(cached) > 0:
+            idxs = torch.from_numpy(cached).long().to(encoding_batch.device)
+            encoding_batch[idxs] = self.encodings.get_batch(cache_idxs[cached])
+            step_batch[idxs] = self.encoding_steps.get_batch(cache_idxs[cached]).view(-1)
+        return encoding_batch, step_batch
+
+    def append(self, obs, discrete_action, dense_action, reward, encoding=None, step=0):
         
         self.observations.append(obs)
         self.discrete_actions.append(discrete_action)
         self.dense_actions.append(dense_action)
         self.rewards.append(reward)
+        if self.encodings is not None:
+            self.encodings.append(encoding)
+            self.encoding_steps.append(torch.full((obs.size(0), 1), step, dtype=torch.long))
 
     @property
     def nb_entries(self):
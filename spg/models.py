@@ -4,17 +4,71 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 import numpy as np
 import math
-from spg.layers import Sinkhorn
-from spg.util import parallel_matching
-# from sklearn.utils.linear_assignment_ import linear_assignment
-from scipy.optimize import linear_sum_assignment as linear_assignment
+from spg.layers import Sinkhorn, run_rnn, sparse_sinkhorn
+from spg.util import round_to_permutations, length_mask, knn_support, sparse_to_dense, round_sparse_to_permutations
+from spg.util import sample_gumbel, repeat_support
+from spg import profiler
 from pathos.multiprocessing import ProcessingPool as Pool
 
+def perturb_scores(M, mask, n_samples, noise=1.):
+    """
+    n_samples copies of each of the [batch_size, N, N] scores M with
+    Gumbel noise of scale noise added, as [batch_size * n_samples, N, N],
+    the copies of an instance being contiguous, and the mask repeated to match
+    """
+    M = M.repeat_interleave(n_samples, 0)
+    M = M + noise * sample_gumbel(M.size(), M.device)
+    if mask is not None:
+        mask = mask.repeat_interleave(n_samples, 0)
+    return M, mask
+
+def unflatten_samples(out, n_samples):
+    """(psi, perms) of [batch_size * n_samples, N, N] to [batch_size, n_samples, N, N]"""
+    psi, perms = out
+    if psi is None:
+        return None, None
+    psi = psi.view(-1, n_samples, psi.size(1), psi.size(2))
+    if perms is not None:
+        perms = perms.view(psi.size())
+    return psi, perms
+
+def repeated_batch_norm(bn, x, n=1):
+    """
+    bn(x), with the running statistics updated as n calls of bn(x) would
+    update them, e.g. for a state embedded once but scored against n actions
+    """
+    if n == 1 or not bn.training or not bn.track_running_stats:
+        return bn(x)
+    if bn.momentum is None:
+        # cumulative average, the extra calls only count towards the statistics
+        with torch.no_grad():
+            for _ in range(n - 1):
+                bn(x)
+        return bn(x)
+    momentum = bn.momentum
+    # n updates of the same batch statistics with momentum m are one with 1 - (1 - m)^n
+    bn.momentum = 1. - (1. - momentum) ** n
+    try:
+        return bn(x)
+    finally:
+        bn.momentum = momentum
+
+def check_critic_size(critic, n):
+    """
+    The critics batch-normalize over the n_nodes positions, so they only
+    take batches padded to exactly n_nodes, unlike the actors
+    """
+    if n != critic.n_nodes:
+        raise ValueError('the critic needs instances padded to its n_nodes = {}, got {} nodes; '
+            'pad with util.pad_instances(instances, {})'.format(critic.n_nodes, n, critic.n_nodes))
+
 class SPGSequentialActor(nn.Module):
     """
     Embeds the input, then an RNN maps it to an intermediate representation
     which gets transofrmed to a stochastic matrix
 
+    Instances with fewer than n_nodes nodes can share a batch, zero-padded
+    to the largest of them (see util.pad_instances) and passed with their lengths
     """
     def __init__(self, n_features, n_nodes, embedding_dim, rnn_dim, bidirectional=True,
             sinkhorn_iters=5, sinkhorn_tau=1, num_workers=4, cuda=True):
@@ -29,7 +83,6 @@ class SPGSequentialActor(nn.Module):
         scale = 2 if bidirectional else 1
         self.fc2 = nn.Linear(scale * self.rnn_dim, n_nodes)
         self.sinkhorn = Sinkhorn(n_nodes, sinkhorn_iters, sinkhorn_tau)
-        self.round = linear_assignment
         init_hx = torch.zeros(scale, self.rnn_dim)
         if cuda:
             init_hx = init_hx.cuda()
@@ -39,37 +92,67 @@ class SPGSequentialActor(nn.Module):
 
     def cuda_after_load(self):
         self.init_hx = self.init_hx.cuda()
+
+    def check_sparse_lengths(self, lengths):
+        if self.sparse_k > 0 and lengths is not None:
+            # knn_support has no padding mask, and dense Sinkhorn would give up the sparse speedup unnoticed
+            raise ValueError('sparse Sinkhorn (sparse_k = {}) only takes instances of {} nodes, without lengths; '
+                'set sparse_k = 0 on the actor to solve padded instances with dense Sinkhorn'.format(self.sparse_k, self.n_nodes))
     
-    def forward(self, x, do_round=True):
+    def forward(self, x, do_round=True, lengths=None, encoding=None):
         """
         x is [batch_size, n_nodes, num_features]
+        lengths is an optional [batch_size] LongTensor of the number of valid nodes
+        encoding is an optional output of encode(x), computed earlier, in place of running the encoder
+        """
+        M, mask = self.scores(x, lengths, encoding)
+        return self.normalize(M, mask, do_round)
+
+    def sample(self, x, n_samples, noise=1., do_round=True, lengths=None, encoding=None):
+        """
+        Gumbel-Sinkhorn: n_samples Gumbel-perturbed copies of the scores of
+        each instance, normalized and rounded in one batch. The encoder runs once
+
+        Returns psi and perms of [batch_size, n_samples, n_nodes, n_nodes]
         """
+        M, mask = self.scores(x, lengths, encoding)
+        M, mask = perturb_scores(M, mask, n_samples, noise)
+        return unflatten_samples(self.normalize(M, mask, do_round), n_samples)
+
+    def encode(self, x, lengths=None):
+        """The [batch_size, n_nodes, scale * rnn_dim] GRU outputs that fc2 maps to the scores"""
         batch_size = x.size()[0]
         x = F.leaky_relu(self.embedding(x))
         x = torch.transpose(x, 0, 1)
         init_hx = self.init_hx.unsqueeze(1).repeat(1, batch_size, 1)
-        h_last, _ = self.gru(x, init_hx)
+        h_last, _ = run_rnn(self.gru, x, init_hx, lengths)
         # h_last should be [n_nodes, batch_size, decoder_dim]
-        x = torch.transpose(h_last, 0, 1)
+        return torch.transpose(h_last, 0, 1)
+
+    def scores(self, x, lengths=None, encoding=None):
+        """The [batch_size, n_nodes, n_nodes] scores M for Sinkhorn, and the mask of the valid nodes"""
+        if encoding is None:
+            encoding = self.encode(x, lengths)
         # transform to [batch_size, n_nodes, n_nodes]
-        M = self.fc2(x)
-        psi = self.sinkhorn(M)
+        M = self.fc2(encoding)
+        mask = None
+        if lengths is not None:
+            # the batch may be padded to fewer than n_nodes
+            n = M.size(1)
+            M = M[:, :, 0:n]
+            mask = length_mask(lengths, n)
+        return M, mask
+
+    def normalize(self, M, mask=None, do_round=True):
+        """Sinkhorn, then round psi to permutations if do_round"""
+        with profiler.phase('sinkhorn'):
+            psi = self.sinkhorn(M, mask=mask)
         if do_round:
             batch = psi.data.cpu().numpy()
             if np.any(np.isnan(batch)):
-                return None, None, None, None
-            if self.num_workers > 0:
-                batches = np.split(batch, self.num_workers, 0)
-                perms = self.pool.map(parallel_matching, batches)
-                perms = [p for pp in perms for p in pp]
-            else:
-                perms = []
-                for i in range(batch_size):
-                    perm = torch.zeros(self.n_nodes, self.n_nodes)                   
-                    matching = self.round(-batch[i])
-                    perm[matching[:,0], matching[:,1]] = 1
-                    perms.append(perm)
-            perms = torch.stack(perms)
+                return None, None
+            with profiler.phase('rounding'):
+                perms = round_to_permutations(batch, getattr(self, 'pool', None), self.num_workers)
             if self.use_cuda:
                 perms = perms.cuda()
             #dist = torch.sum(torch.sum(psi * perms, dim=1), dim=1) / self.n_nodes
@@ -78,6 +161,21 @@ class SPGSequentialActor(nn.Module):
             return psi, None
 
 class SPGMatchingActor(nn.Module):
+    """
+    Scores every pair of nodes of the two graphs with an RNN over the rows
+    of their outer product, then Sinkhorn maps the scores to psi.
+
+    With sparse_k > 0, Sinkhorn and rounding only consider sparse_k
+    candidates for each node (see util.knn_support), which keeps them
+    tractable for large N. The candidates are the farthest nodes, since
+    mwm2D maximizes the total edge length, or the nearest ones with
+    sparse_largest = False. psi is still returned as a dense matrix, zero
+    outside the support. Sparse mode needs instances of the full n_nodes;
+    padded instances (lengths) raise a ValueError
+    """
+    sparse_k = 0
+    sparse_largest = True
+
     def __init__(self, n_features, n_nodes, embedding_dim, rnn_dim,
             sinkhorn_iters=5, sinkhorn_tau=1., num_workers=4, cuda=True):
         super(SPGMatchingActor, self).__init__()
@@ -89,7 +187,6 @@ class SPGMatchingActor(nn.Module):
         self.gru = nn.GRU(n_nodes, rnn_dim)
         self.fc1 = nn.Linear(self.rnn_dim, n_nodes)
         self.sinkhorn = Sinkhorn(n_nodes, sinkhorn_iters, sinkhorn_tau)
-        self.round = linear_assignment
         init_hx = torch.zeros(1, self.rnn_dim)
         if cuda:
             init_hx = init_hx.cuda()
@@ -99,44 +196,95 @@ class SPGMatchingActor(nn.Module):
 
     def cuda_after_load(self):
         self.init_hx = self.init_hx.cuda()
+
+    def check_sparse_lengths(self, lengths):
+        if self.sparse_k > 0 and lengths is not None:
+            # knn_support has no padding mask, and dense Sinkhorn would give up the sparse speedup unnoticed
+            raise ValueError('sparse Sinkhorn (sparse_k = {}) only takes instances of {} nodes, without lengths; '
+                'set sparse_k = 0 on the actor to solve padded instances with dense Sinkhorn'.format(self.sparse_k, self.n_nodes))
     
-    def forward(self, x, do_round=True):
+    def forward(self, x, do_round=True, lengths=None, encoding=None):
         """
         x is [batch_size, 2 * n_nodes, num_features]
+        lengths is an optional [batch_size] LongTensor of the number of valid
+        nodes in each graph, both graphs being padded to the same size, up to n_nodes
+        encoding is an optional output of encode(x), computed earlier, in place of running the encoder
+        """
+        self.check_sparse_lengths(lengths)
+        M, mask = self.scores(x, lengths, encoding)
+        if self.sparse_k > 0:
+            return self.sparse_forward(x, M, do_round)
+        return self.normalize(M, mask, do_round)
+
+    def sample(self, x, n_samples, noise=1., do_round=True, lengths=None, encoding=None):
         """
+        Gumbel-Sinkhorn: n_samples Gumbel-perturbed copies of the scores of
+        each instance, normalized and rounded in one batch. The encoder runs once
+
+        Returns psi and perms of [batch_size, n_samples, n_nodes, n_nodes]
+        """
+        self.check_sparse_lengths(lengths)
+        M, mask = self.scores(x, lengths, encoding)
+        M, mask = perturb_scores(M, mask, n_samples, noise)
+        if self.sparse_k > 0:
+            # the kNN support of each instance is built once and shared by its samples
+            N = M.size(1)
+            ids, _, _, _ = knn_support(x[:,N:2*N,:], x[:,0:N,:], self.sparse_k, self.sparse_largest)
+            out = self.sparse_forward(None, M, do_round, support=repeat_support(ids, N, n_samples))
+        else:
+            out = self.normalize(M, mask, do_round)
+        return unflatten_samples(out, n_samples)
+
+    def encode(self, x, lengths=None):
+        """The [batch_size, n_nodes, rnn_dim] GRU outputs that fc1 maps to the scores"""
         batch_size= x.size()[0]
+        n = x.size(1) // 2
         # split x into G1 and G2
-        g1 = x[:,0:self.n_nodes,:]
-        g2 = x[:,self.n_nodes:2*self.n_nodes,:]
+        g1 = x[:,0:n,:]
+        g2 = x[:,n:2*n,:]
         g1 = F.leaky_relu(self.embedding(g1))
         g2 = F.leaky_relu(self.embedding(g2))
+        if lengths is not None:
+            # zero the padded nodes, so they drop out of the outer product
+            mask = length_mask(lengths, n).unsqueeze(2).float()
+            g1 = g1 * mask
+            g2 = g2 * mask
         # take outer product, result is [batch_size, N, N]
         x = torch.bmm(g2, torch.transpose(g1, 2, 1))
+        if n < self.n_nodes:
+            # the GRU takes rows of n_nodes
+            x = F.pad(x, (0, self.n_nodes - n))
         x = torch.transpose(x, 0, 1)
         init_hx = self.init_hx.unsqueeze(1).repeat(1, batch_size, 1)
-        h, _ = self.gru(x, init_hx)
+        h, _ = run_rnn(self.gru, x, init_hx, lengths)
         # h is [n_nodes, batch_size, rnn_dim]
-        h = torch.transpose(h, 0, 1)
+        return torch.transpose(h, 0, 1)
+
+    def scores(self, x, lengths=None, encoding=None):
+        """The [batch_size, n_nodes, n_nodes] scores M of G2 (rows) to G1 (cols), and the mask of the valid nodes"""
+        n = x.size(1) // 2
+        if encoding is None:
+            encoding = self.encode(x, lengths)
         # result M is [batch_size, n_nodes, n_nodes]
-        M = self.fc1(h)
-        psi = self.sinkhorn(M)
+        M = self.fc1(encoding)[:, :, 0:n]
+        mask = None
+        if lengths is not None:
+            mask = length_mask(lengths, n)
+        return M, mask
+
+    def normalize(self, M, mask=None, do_round=True):
+        """Sinkhorn, then round psi to permutations if do_round"""
+        with profiler.phase('sinkhorn'):
+            psi = self.sinkhorn(M, mask=mask)
         if do_round:
             batch = psi.data.cpu().numpy()
             if np.any(np.isnan(batch)):
-                return None, None, None, None
-            if self.num_workers > 0:
-                batches = np.split(batch, self.num_workers, 0)
-                perms = self.pool.map(parallel_matching, batches)
-                perms = [p for pp in perms for p in pp]
-            else:
-                perms = []
-                for i in range(batch_size):
-                    perm = torch.zeros(self.n_nodes, self.n_nodes)
-                    matching = self.round(-batch[i])
-                    perm[matching[:,0], matching[:,1]] = 1
-                    perms.append(perm)
-            perms = torch.stack(perms).contiguous()
-            perms.pin_memory()
+                return None, None
+            with profiler.phase('rounding'):
+                perms = round_to_permutations(batch, getattr(self, 'pool', None), self.num_workers)
+            perms = perms.contiguous()
+            if self.use_cuda:
+                perms = perms.pin_memory()
             if self.use_cuda:
                 perms = perms.cuda(non_blocking=True)
             #dist = torch.sum(torch.sum(psi * perms, dim=1), dim=1) / self.n_nodes
@@ -144,6 +292,35 @@ class SPGMatchingActor(nn.Module):
         else:
             return psi, None
 
+    def sparse_forward(self, obs, M, do_round=True, support=None):
+        """
+        Sinkhorn and rounding over the sparse_k candidates of each node
+
+        obs is [batch_size, 2 * n_nodes, num_features]
+        M is [batch_size, n_nodes, n_nodes], the scores of G2 (rows) to G1 (cols)
+        support is an optional (ids, rows, cols) computed earlier, in place of knn_support on obs
+        """
+        batch_size, N, _ = M.size()
+        if support is None:
+            ids, rows, cols, _ = knn_support(obs[:,N:2*N,:], obs[:,0:N,:], self.sparse_k, self.sparse_largest)
+        else:
+            ids, rows, cols = support
+        with profiler.phase('sinkhorn'):
+            values = sparse_sinkhorn(M.reshape(-1)[ids], rows, cols, batch_size * N,
+                    self.sinkhorn.tau, self.sinkhorn.sinkhorn_iters)
+        psi = sparse_to_dense(values, ids, batch_size, N)
+        if not do_round:
+            return psi, None
+        np_values = values.data.cpu().numpy()
+        if np.any(np.isnan(np_values)):
+            return None, None
+        with profiler.phase('rounding'):
+            perms, _ = round_sparse_to_permutations(np_values, ids.cpu().numpy(), batch_size, N,
+                    getattr(self, 'pool', None), self.num_workers)
+        if self.use_cuda:
+            perms = perms.cuda()
+        return psi, perms
+
 SPGSiameseActor = SPGMatchingActor
 
 class SPGSequentialCritic(nn.Module):
@@ -172,25 +349,52 @@ class SPGSequentialCritic(nn.Module):
     def cuda_after_load(self):
         self.init_hx = self.init_hx.cuda()
 
-    def forward(self, x, p):
+    def embed_state(self, x, lengths=None, n_scores=1):
         """
+        Embeds the state on its own so that it can be scored 
+        against several actions with score()
+
         x is [batch_size, n_nodes, num_features]
+        lengths is an optional [batch_size] LongTensor of the number of valid nodes
+        n_scores is the number of actions it will be scored against; bn1's
+        running statistics are updated as by that many calls of forward()
+        """
+        check_critic_size(self, x.size(1))
+        x = F.leaky_relu(repeated_batch_norm(self.bn1, self.embeddingX(x), n_scores))
+        if lengths is not None:
+            x = x * length_mask(lengths, self.n_nodes).unsqueeze(2).float()
+        return x
+
+    def score(self, x, p, lengths=None):
+        """
+        x is the embedded state from embed_state(), [batch_size, n_nodes, embedding_dim]
+        p is [batch_size, n_nodes, n_nodes]
+        lengths is an optional [batch_size] LongTensor of the number of valid nodes
         """
+        check_critic_size(self, p.size(1))
         batch_size = x.size()[0]
-        x = F.leaky_relu(self.bn1(self.embeddingX(x)))
         p = F.leaky_relu(self.bn2(self.embeddingP(p)))
         xp = F.leaky_relu(self.bn3(self.combine(x + p)))
         x = torch.transpose(xp, 0, 1)
         init_hx = self.init_hx.unsqueeze(1).repeat(1, batch_size, 1)
-        h_last, hidden_state = self.gru(x, init_hx)
+        h_last, hidden_state = run_rnn(self.gru, x, init_hx, lengths)
         # h_last should be [n_nodes, batch_size, decoder_dim]
         x = torch.transpose(h_last, 0, 1)
         x = F.leaky_relu(self.fc3(x))
         out = self.fc1(x)
+        if lengths is not None:
+            # padded nodes do not count towards the value
+            out = out * length_mask(lengths, self.n_nodes).unsqueeze(2).float()
         out = self.fc2(torch.transpose(out, 1, 2))
         # out is [batch_size, 1, 1]
         return out
 
+    def forward(self, x, p, lengths=None):
+        """
+        x is [batch_size, n_nodes, num_features]
+        """
+        return self.score(self.embed_state(x, lengths), p, lengths)
+
 class SPGMatchingCritic(nn.Module):
     def __init__(self, n_features, n_nodes, embedding_dim, rnn_dim, cuda):
         super(SPGMatchingCritic, self).__init__()
@@ -215,30 +419,57 @@ class SPGMatchingCritic(nn.Module):
     def cuda_after_load(self):
         self.init_hx = self.init_hx.cuda()
 
-    def forward(self, x, p):
+    def embed_state(self, x, lengths=None, n_scores=1):
         """
+        Embeds the state on its own so that it can be scored 
+        against several actions with score()
+
         x is [batch_size, 2 * n_nodes, num_features]
-        p is [batch_size, n_nodes, n_nodes]
+        lengths is an optional [batch_size] LongTensor of the number of valid nodes per graph
+        n_scores is the number of actions it will be scored against; bn1's
+        running statistics are updated as by that many calls of forward()
         """
+        check_critic_size(self, x.size(1) // 2)
         batch_size = x.size()[0]
         # split x into G1 and G2
         g1 = x[:,0:self.n_nodes,:]
         g2 = x[:,self.n_nodes:2*self.n_nodes,:]
         g1 = F.leaky_relu(self.embedding(g1))
         g2 = F.leaky_relu(self.embedding(g2))
+        if lengths is not None:
+            mask = length_mask(lengths, self.n_nodes).unsqueeze(2).float()
+            g1 = g1 * mask
+            g2 = g2 * mask
         # take outer product, result is [batch_size, N, N]
         x = torch.bmm(g2, torch.transpose(g1, 2, 1))
         x = torch.transpose(x, 0, 1)
         init_hx = self.init_hx.unsqueeze(1).repeat(1, batch_size, 1)
-        h, hidden_state = self.gru(x, init_hx)
+        h, hidden_state = run_rnn(self.gru, x, init_hx, lengths)
         # h is [n_nodes, batch_size, rnn_dim]
         x = torch.transpose(h, 0, 1)
         # result is [batch_size, n_nodes, embedding_dim]
-        x = F.leaky_relu(self.bn1(self.fc1(x)))
+        return F.leaky_relu(repeated_batch_norm(self.bn1, self.fc1(x), n_scores))
+
+    def score(self, x, p, lengths=None):
+        """
+        x is the embedded state from embed_state(), [batch_size, n_nodes, embedding_dim]
+        p is [batch_size, n_nodes, n_nodes]
+        lengths is an optional [batch_size] LongTensor of the number of valid nodes per graph
+        """
+        check_critic_size(self, p.size(1))
         p = F.leaky_relu(self.embedding_bn(self.embed_action(p)))
         x = F.leaky_relu(self.bn2(self.combine(x + p)))
         out = self.fc2(x)
+        if lengths is not None:
+            # padded nodes do not count towards the value
+            out = out * length_mask(lengths, self.n_nodes).unsqueeze(2).float()
         out = self.fc3(torch.transpose(out, 1, 2))
         # out is [batch_size, 1, 1]
         return out
 
+    def forward(self, x, p, lengths=None):
+        """
+        x is [batch_size, 2 * n_nodes, num_features]
+        p is [batch_size, n_nodes, n_nodes]
+        """
+        return self.score(self.embed_state(x, lengths), p, lengths)
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+from collections import deque, OrderedDict
+import numpy as np
+import torch
+
+from spg.util import memory_usage, peak_memory_usage
+
+class _NullPhase(object):
+    """Context manager that does nothing, handed out when profiling is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    __slots__ = ('timer', 'name', 'start', 'out')
+
+    def __init__(self, timer, name, out=None):
+        self.timer = timer
+        self.name = name
+        self.out = out
+
+    def __enter__(self):
+        if self.timer.enabled:
+            self.timer.sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer.enabled:
+            self.timer.sync()
+        elapsed = time.perf_counter() - self.start
+        if self.timer.enabled:
+            self.timer.add(self.name, elapsed)
+        if self.out is not None:
+            self.out.append(elapsed)
+        return False
+
+class PhaseTimer(object):
+    """
+    Named wall-clock timers for the phases of a training loop.
+
+    Usage:
+        with timer.phase('reward'):
+            R = env(solutions, use_cuda)
+        ...
+        timer.step(n_instances)
+
+    Phases can nest, e.g. 'sinkhorn' and 'rounding' are timed inside the
+    actor and are also part of 'actor_forward' or 'actor_update'.
+    When disabled, phase() returns a shared no-op context manager.
+    """
+    def __init__(self, enabled=False, window=1000, sync_cuda=False):
+        self.configure(enabled, window, sync_cuda)
+
+    def configure(self, enabled=False, window=1000, sync_cuda=False):
+        self.enabled = enabled
+        self.window = window
+        # CUDA kernels run async, so optionally wait for them at phase boundaries
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.times = OrderedDict()
+        self.counts = {}
+        self.steps = deque(maxlen=window)
+        self.n_steps = 0
+        self.n_instances = 0
+        self.start_time = time.time()
+        self.first_step_time = None
+
+    def sync(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+
+    def phase(self, name, out=None):
+        """
+        Context manager timing its block under name. With out, e.g. a
+        deque, the elapsed seconds are also appended to it, even when
+        profiling is off
+        """
+        if not self.enabled and out is None:
+            return _NULL_PHASE
+        return _Phase(self, name, out)
+
+    def add(self, name, elapsed):
+        if name not in self.times:
+            self.times[name] = deque(maxlen=self.window)
+            self.counts[name] = 0
+        self.times[name].append(elapsed)
+        self.counts[name] += 1
+
+    def iterate(self, iterable, name='data'):
+        """Times each next() on iterable, e.g. a DataLoader, under name"""
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(iterable, name)
+
+    def _timed_iter(self, iterable, name):
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield x
+
+    def step(self, n_instances):
+        """Marks the end of a training step over n_instances problem instances"""
+        if not self.enabled:
+            return
+        now = time.time()
+        if self.first_step_time is None:
+            self.first_step_time = now
+        self.steps.append((now, n_instances))
+        self.n_steps += 1
+        self.n_instances += n_instances
+
+    def instances_per_sec(self):
+        if len(self.steps) < 2:
+            return 0.
+        elapsed = self.steps[-1][0] - self.steps[0][0]
+        # the first step in the window only marks the start time
+        n = sum([s[1] for s in self.steps]) - self.steps[0][1]
+        return n / elapsed if elapsed > 0 else 0.
+
+    def summary(self):
+        phases = OrderedDict()
+        for name, t in self.times.items():
+            t = np.array(t) * 1000.
+            phases[name] = {
+                'mean_ms': float(np.mean(t)),
+                'p50_ms': float(np.percentile(t, 50)),
+                'p99_ms': float(np.percentile(t, 99)),
+                'count': self.counts[name]}
+        time_to_first_step = None
+        if self.first_step_time is not None:
+            time_to_first_step = self.first_step_time - self.start_time
+        return {'phases': phases,
+                'steps': self.n_steps,
+                'instances': self.n_instances,
+                'instances_per_sec': self.instances_per_sec(),
+                'time_to_first_step': time_to_first_step,
+                'rss_mb': memory_usage(),
+                'peak_rss_mb': peak_memory_usage()}
+
+    def report(self, step, json_path=None, log_fn=None):
+        """
+        Prints the per-phase summary and optionally writes it to a JSON file
+        and passes each value to log_fn(name, value, step), e.g. tensorboard_logger.log_value
+
+        json_path only holds the latest summary; every summary is also
+        appended as one line to the .jsonl file next to it, so the I/O per
+        report stays constant over a run
+        """
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        summary['step'] = step
+        print(' [*] phase timings after {} steps ({:.1f} instances/s, rss: {:.1f} MB, peak rss: {:.1f} MB)'.format(
+            step, summary['instances_per_sec'], summary['rss_mb'], summary['peak_rss_mb']))
+        for name, s in summary['phases'].items():
+            print('    {:<16} mean: {:8.3f} ms, p50: {:8.3f} ms, p99: {:8.3f} ms, n: {}'.format(
+                name, s['mean_ms'], s['p50_ms'], s['p99_ms'], s['count']))
+        if log_fn is not None:
+            log_fn('Instances per sec', summary['instances_per_sec'], step)
+            for name, s in summary['phases'].items():
+                log_fn('Phase {} mean (ms)'.format(name), s['mean_ms'], step)
+                log_fn('Phase {} p99 (ms)'.format(name), s['p99_ms'], step)
+        if json_path is not None:
+            d = os.path.dirname(json_path)
+            if d != '' and not os.path.isdir(d):
+                os.makedirs(d)
+            with open(json_path, 'w') as f:
+                json.dump({'latest': summary}, f)
+            with open(os.path.splitext(json_path)[0] + '.jsonl', 'a') as f:
+                f.write(json.dumps(summary) + '\n')
+        return summary
+
+# shared timer, so that layers and models can time their own phases
+timer = PhaseTimer()
+
+def phase(name):
+    return timer.phase(name)
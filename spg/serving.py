@@ -0,0 +1,152 @@
+"""
+Dynamic request batching for serving SPG actors. Requests for single
+instances are queued, coalesced into batches of up to max_batch_size
+(waiting at most max_wait_ms for a batch to fill), solved with one
+batched actor forward + rounding, and the results are handed back to
+each request. Instances smaller than the actor's n_nodes are zero-padded,
+so one actor and one batch serve every size up to n_nodes
+"""
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+import torch
+
+import spg.util as util
+
+
+def make_solver(psi_actor, n_nodes, matching=False, reward_fn=None, pool=None, num_workers=0):
+    """
+    Args:
+        psi_actor: maps [batch_size, n_inputs, n_features] (and lengths) to psi, see spg.inference
+        n_nodes: the n_nodes of the actor, instances with fewer nodes are zero-padded
+        matching: the instances hold two graphs, as for mwm2D
+        reward_fn: optional, from spg.inference.make_reward_fn
+        pool: a pathos pool for rounding, if num_workers > 0
+    Returns:
+        solve(instances) for a list of [n_inputs, n_features] instances,
+        returning a list of (permutation, reward) with reward None if
+        reward_fn is None
+    """
+    n_inputs = 2 * n_nodes if matching else n_nodes
+    def solve(instances):
+        lengths = None
+        if all([x.size(0) == n_inputs for x in instances]):
+            obs = torch.stack(instances)
+        else:
+            # pad to the largest instance of the batch, not to n_nodes
+            n = max([x.size(0) for x in instances]) // (2 if matching else 1)
+            obs, lengths = util.pad_instances(instances, n, matching)
+        with torch.no_grad():
+            # actors exported before padding support only take x
+            psi = psi_actor(obs) if lengths is None else psi_actor(obs, lengths)
+        perms = util.round_to_permutations(psi.cpu().numpy(), pool, num_workers)
+        R = [None] * obs.size(0)
+        if reward_fn is not None:
+            R = reward_fn(obs, perms.to(obs.device), lengths).cpu().numpy().tolist()
+        # the input at each position, without the padding
+        idxs = perms.argmax(1).numpy().tolist()
+        if lengths is not None:
+            idxs = [p[:n] for p, n in zip(idxs, lengths.tolist())]
+        return list(zip(idxs, R))
+    return solve
+
+
+class DynamicBatcher(object):
+    """
+    Coalesces concurrent single-instance requests into batches for solve_fn,
+    on a single worker thread
+
+    Args:
+        solve_fn: maps a list of instances to the list of their results
+        max_batch_size: most requests per batch
+        max_wait_ms: how long the first request of a batch waits for others
+        stats_window: number of recent requests and batches the stats are computed over
+    """
+    def __init__(self, solve_fn, max_batch_size=64, max_wait_ms=2., stats_window=10000):
+        self.solve_fn = solve_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=stats_window)
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.queue_depths = deque(maxlen=stats_window)
+        self.n_requests = 0
+        self.n_batches = 0
+        self.lock = threading.Lock()
+        self.running = True
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, x):
+        """Queue one instance x, returns a concurrent.futures.Future of its result"""
+        future = Future()
+        self.requests.put((x, future, time.perf_counter()))
+        return future
+
+    def __call__(self, x, timeout=None):
+        """Solve one instance, blocking until its batch is done"""
+        return self.submit(x).result(timeout)
+
+    def _next_batch(self):
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self.requests.get(timeout=remaining))
+                else:
+                    # take whatever is already waiting, without blocking
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while self.running:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                continue
+            depth = self.requests.qsize()
+            xs, futures, starts = zip(*batch)
+            try:
+                results = self.solve_fn(list(xs))
+            except Exception as e:
+                for f in futures:
+                    f.set_exception(e)
+                continue
+            for f, r in zip(futures, results):
+                f.set_result(r)
+            done = time.perf_counter()
+            with self.lock:
+                self.latencies.extend([done - s for s in starts])
+                self.batch_sizes.append(len(batch))
+                self.queue_depths.append(depth)
+                self.n_requests += len(batch)
+                self.n_batches += 1
+
+    def stats(self):
+        """Request latency percentiles in ms, batch sizes and queue depth"""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            batch_sizes = np.array(self.batch_sizes)
+            queue_depths = np.array(self.queue_depths)
+            s = {'requests': self.n_requests, 'batches': self.n_batches,
+                 'queue_depth': self.requests.qsize()}
+        if len(latencies) > 0:
+            for p in [50, 90, 99]:
+                s['latency_p{}_ms'.format(p)] = float(np.percentile(latencies, p))
+            s['mean_batch_size'] = float(batch_sizes.mean())
+            s['mean_queue_depth'] = float(queue_depths.mean())
+            s['max_queue_depth'] = int(queue_depths.max())
+        return s
+
+    def close(self):
+        self.running = False
+        self.worker.join()
@@ -1,7 +1,10 @@
 from math import log10, floor
+import numpy as np
 import torch
 # from sklearn.utils.linear_assignment_ import linear_assignment
 from scipy.optimize import linear_sum_assignment as linear_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
 
 def str2bool(v):
       return v.lower() in ('true', '1')
@@ -17,6 +20,15 @@ def cudify(x, use_cuda):
     else:
         return x
 
+def autocast(precision, use_cuda=False):
+    """
+    Mixed-precision context for the actor and critic forward passes:
+    bfloat16 autocast for precision 'bf16', a no-op for 'fp32'. The
+    parameters stay in float32, and bfloat16 has the exponent range of
+    float32, so the gradients need no loss scaling
+    """
+    return torch.autocast('cuda' if use_cuda else 'cpu', dtype=torch.bfloat16, enabled=precision == 'bf16')
+
 def loss_dt_check(losses):
     """
     Compute an estimate of the rate 
@@ -73,21 +85,259 @@ def logsumexp(inputs, dim=None, keepdim=False):
         outputs = outputs.squeeze(dim)
     return outputs
 
+def length_mask(lengths, max_len):
+    """[batch_size, max_len] bool mask, True for the first lengths[i] entries of row i"""
+    return torch.arange(max_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+def pad_instances(instances, n_nodes, matching=False):
+    """
+    Zero-pad instances with up to n_nodes nodes into one batch
+
+    Args:
+        instances: list of [n_i, n_features] Tensors, or of [2 * n_i, n_features]
+            with the two graphs concatenated if matching
+        n_nodes: the padded number of nodes, at most the n_nodes of the actor.
+            Actors run on the padded size, so padding only to the largest
+            instance of the batch saves work
+        matching: pad each of the two graphs to n_nodes
+    Returns:
+        x: [batch_size, n_nodes, n_features] ([batch_size, 2 * n_nodes, n_features] if matching)
+        lengths: [batch_size] LongTensor, the n_i
+    """
+    n_features = instances[0].size(1)
+    n_inputs = 2 * n_nodes if matching else n_nodes
+    x = instances[0].new_zeros(len(instances), n_inputs, n_features)
+    lengths = torch.zeros(len(instances), dtype=torch.long)
+    for i, inst in enumerate(instances):
+        n = inst.size(0) // 2 if matching else inst.size(0)
+        if n > n_nodes or n == 0 or (matching and inst.size(0) % 2 != 0):
+            raise ValueError('cannot pad an instance of {} inputs to {} nodes'.format(inst.size(0), n_nodes))
+        if matching:
+            x[i, 0:n] = inst[0:n]
+            x[i, n_nodes:n_nodes + n] = inst[n:2 * n]
+        else:
+            x[i, 0:n] = inst
+        lengths[i] = n
+    return x, lengths
+
 def parallel_matching(batch):
     perms = []
     (m, n, n) = batch.shape
-    import pdb; pdb.set_trace()
     for i in range(m):
         perm = torch.zeros(n, n)
-        matching = linear_assignment(-batch[i])
-        perm[matching[:,0], matching[:,1]] = 1
+        row_idxs, col_idxs = linear_assignment(-batch[i])
+        perm[row_idxs, col_idxs] = 1
         perms.append(perm)
     return perms
 
+def round_to_permutations(batch, pool=None, num_workers=0):
+    """
+    Round a batch of doubly-stochastic matrices to the nearest
+    permutation matrices with the Hungarian method.
+
+    Args:
+        batch: numpy array of size [batch_size, N, N]
+        pool: a pathos pool to split the batch across, if num_workers > 0
+        num_workers: number of chunks to split the batch into
+    Returns:
+        FloatTensor of size [batch_size, N, N]
+    """
+    if num_workers > 0:
+        batches = np.array_split(batch, num_workers, 0)
+        perms = pool.map(parallel_matching, batches)
+        perms = [p for pp in perms for p in pp]
+    else:
+        perms = parallel_matching(batch)
+    return torch.stack(perms)
+
+def sample_gumbel(size, device=None, eps=1e-20):
+    """Standard Gumbel noise, -log(-log(U)) for U ~ Uniform(0, 1)"""
+    U = torch.rand(size, device=device)
+    return -torch.log(-torch.log(U + eps) + eps)
+
+def knn_support(row_coords, col_coords, k, largest=False):
+    """
+    Sparse support of the assignments between two point sets: each row
+    node may go to its k nearest col nodes, and each col node may take its
+    k nearest row nodes, or the k farthest ones if largest.
+
+    The kNN graph does not always have a perfect matching, e.g. when many
+    rows share the same few candidates. Then the rows and cols left
+    unmatched by a maximum matching of the support are paired up with one
+    extra entry each, which makes it feasible for both Sinkhorn and rounding.
+
+    Args:
+        row_coords: [batch_size, N, n_features]
+        col_coords: [batch_size, N, n_features]
+        largest: use the k farthest nodes, e.g. for maximum weight matching
+    Returns:
+        ids: [E] sorted LongTensor of the entries of the support in the
+            flattened [batch_size, N, N] matrix, b * N * N + i * N + j
+        rows: [E] the row of each entry, b * N + i
+        cols: [E] the col of each entry, b * N + j
+        n_patched: the number of instances whose kNN graph had no perfect matching
+    """
+    batch_size, N, _ = row_coords.size()
+    k = min(k, N)
+    dists = torch.cdist(row_coords, col_coords)
+    device = row_coords.device
+    b = torch.arange(batch_size, device=device).view(-1, 1, 1)
+    # the k nearest cols of each row, [batch_size, N, k]
+    near_cols = dists.topk(k, dim=2, largest=largest)[1]
+    row_ids = (b * N + torch.arange(N, device=device).view(1, -1, 1)) * N + near_cols
+    # the k nearest rows of each col, [batch_size, k, N]
+    near_rows = dists.topk(k, dim=1, largest=largest)[1]
+    col_ids = (b * N + near_rows) * N + torch.arange(N, device=device).view(1, 1, -1)
+    ids = torch.unique(torch.cat([row_ids.view(-1), col_ids.view(-1)]))
+    ids, n_patched = complete_support(ids, batch_size, N)
+    rows = ids // N
+    cols = (ids // (N * N)) * N + ids % N
+    return ids, rows, cols, n_patched
+
+def complete_support(ids, batch_size, N):
+    """Pair up the rows and cols a maximum matching of each support leaves unmatched, see knn_support"""
+    np_ids = ids.cpu().numpy()
+    bounds = np.searchsorted(np_ids // (N * N), np.arange(batch_size + 1))
+    extra = []
+    for i in range(batch_size):
+        local = np_ids[bounds[i]:bounds[i + 1]] % (N * N)
+        graph = csr_matrix((np.ones(len(local)), (local // N, local % N)), shape=(N, N))
+        match = maximum_bipartite_matching(graph, perm_type='column')
+        free_rows = np.where(match < 0)[0]
+        if len(free_rows) == 0:
+            continue
+        free_cols = np.setdiff1d(np.arange(N), match[match >= 0])
+        extra.append((i * N + free_rows) * N + free_cols)
+    if len(extra) == 0:
+        return ids, 0
+    n_patched = len(extra)
+    extra = torch.from_numpy(np.concatenate(extra)).to(ids.device)
+    return torch.unique(torch.cat([ids, extra])), n_patched
+
+def repeat_support(ids, N, n_samples):
+    """
+    The support ids of knn_support for each instance repeated n_samples
+    times along the batch, as for x.repeat_interleave(n_samples, 0), with
+    its rows and cols, without recomputing the kNN graphs
+    """
+    b = ids // (N * N)
+    local = ids % (N * N)
+    copies = torch.arange(n_samples, device=ids.device).view(-1, 1)
+    # ids are sorted by instance, so sorting keeps the copies of each instance together, in order
+    ids, _ = torch.sort(((b.view(1, -1) * n_samples + copies) * N * N + local.view(1, -1)).view(-1))
+    rows = ids // N
+    cols = (ids // (N * N)) * N + ids % N
+    return ids, rows, cols
+
+def sparse_to_dense(values, ids, batch_size, N):
+    """The [batch_size, N, N] matrix with values at the support ids of knn_support, zeros elsewhere"""
+    return values.new_zeros(batch_size * N * N).index_put((ids,), values).view(batch_size, N, N)
+
+def leftover_block(rows, cols, values, N, free_rows, free_cols):
+    """
+    The [len(free_rows), len(free_cols)] block of psi between the free rows
+    and cols, built from the support entries alone. Pairs outside the
+    support get a score below any sum of psi entries, so the Hungarian
+    method only uses them when the support leaves no other way
+    """
+    row_pos = np.full(N, -1, dtype=np.int64)
+    row_pos[free_rows] = np.arange(len(free_rows))
+    col_pos = np.full(N, -1, dtype=np.int64)
+    col_pos[free_cols] = np.arange(len(free_cols))
+    keep = (row_pos[rows] >= 0) & (col_pos[cols] >= 0)
+    # psi entries are at most 1, so one pair outside the support costs more
+    # than all the support pairs of the block together
+    block = np.full((len(free_rows), len(free_cols)), -(len(free_rows) + 1.), dtype=np.float64)
+    block[row_pos[rows[keep]], col_pos[cols[keep]]] = values[keep]
+    return block
+
+def sparse_matching(instances):
+    """
+    Round psi on sparse supports to permutations: greedily take the
+    largest entries whose row and col are both still free, then finish
+    the rows and cols left over with the Hungarian method on their (small)
+    block, see leftover_block. For the peaked psi of a converged Sinkhorn this agrees with the
+    dense Hungarian rounding almost always, at O(E log E) instead of O(N^3)
+
+    Args:
+        instances: list of (rows, cols, values, N) with the local rows and cols
+    Returns:
+        list of [N, N] permutation matrices, and the number of instances
+        that needed the Hungarian method for their leftovers
+    """
+    perms = []
+    n_fallbacks = 0
+    for rows, cols, values, N in instances:
+        # the col of each row, -1 while the row is free
+        match = np.full(N, -1, dtype=np.int64)
+        col_free = np.ones(N, dtype=bool)
+        order = np.argsort(-values, kind='stable')
+        for i, j in zip(rows[order].tolist(), cols[order].tolist()):
+            if match[i] < 0 and col_free[j]:
+                match[i] = j
+                col_free[j] = False
+        free_rows = np.where(match < 0)[0]
+        if len(free_rows) > 0:
+            free_cols = np.where(col_free)[0]
+            block = leftover_block(rows, cols, values, N, free_rows, free_cols)
+            row_idxs, col_idxs = linear_assignment(-block)
+            match[free_rows[row_idxs]] = free_cols[col_idxs]
+            n_fallbacks += 1
+        perm = torch.zeros(N, N)
+        perm[torch.arange(N), torch.from_numpy(match)] = 1
+        perms.append(perm)
+    return perms, n_fallbacks
+
+def round_sparse_to_permutations(values, ids, batch_size, N, pool=None, num_workers=0):
+    """
+    round_to_permutations for psi on a sparse support, see knn_support
+
+    Args:
+        values: numpy array of the [E] entries of psi on the support
+        ids: numpy array of the [E] sorted support ids from knn_support
+    Returns:
+        FloatTensor of size [batch_size, N, N], and the number of
+        instances that needed the Hungarian method, see sparse_matching
+    """
+    b = ids // (N * N)
+    bounds = np.searchsorted(b, np.arange(batch_size + 1))
+    instances = []
+    for i in range(batch_size):
+        local = ids[bounds[i]:bounds[i + 1]] % (N * N)
+        instances.append((local // N, local % N, values[bounds[i]:bounds[i + 1]], N))
+    if num_workers > 0:
+        chunks = [instances[i::num_workers] for i in range(num_workers)]
+        out = pool.map(sparse_matching, chunks)
+        # undo the striding across workers
+        perms = [None] * batch_size
+        for w, (chunk_perms, _) in enumerate(out):
+            perms[w::num_workers] = chunk_perms
+        n_fallbacks = sum([n for _, n in out])
+    else:
+        perms, n_fallbacks = sparse_matching(instances)
+    return torch.stack(perms), n_fallbacks
+
 
 def memory_usage():
     return ((int(open('/proc/self/statm').read().split()[1]) * 4096.) / 1000000.)
 
+def peak_memory_usage():
+    """Peak resident set size (VmHWM) of this process in MB"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return (int(line.split()[1]) * 1024.) / 1000000.
+    return memory_usage()
+
+def reset_peak_memory_usage():
+    """Reset VmHWM to the current resident set size, so peak_memory_usage measures from here"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
 if __name__ == '__main__': 
     torch.random.manual_seed(1)
     ones = torch.ones(3,1)
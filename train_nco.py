@@ -16,7 +16,10 @@ from tensorboard_logger import configure, log_value
 
 from neural_combinatorial_rl.neural_combinatorial_rl import NeuralCombOptRL
 from neural_combinatorial_rl.matching_nco import MatchingNeuralCombOptRL, MatchingNoDecoder
+from neural_combinatorial_rl import inference
+from neural_combinatorial_rl.baseline import RolloutBaseline
 from envs import dataset
+from spg import profiler
 
 def str2bool(v):
       return v.lower() in ('true', '1')
@@ -41,6 +44,8 @@ parser.add_argument('--tanh_exploration', type=int, default=10, help='Hyperparam
 parser.add_argument('--dropout', default=0., help='')
 parser.add_argument('--terminating_symbol', default='<0>', help='')
 parser.add_argument('--beam_size', default=1, help='Beam width for beam search')
+parser.add_argument('--eval_k', type=int, default=1, help='Decode eval_k solutions per validation instance and keep the best')
+parser.add_argument('--eval_multistart', type=str2bool, default=False, help='Give each of the eval_k solutions a distinct first node')
 # Training
 parser.add_argument('--use_decoder', type=str2bool, default=False)
 parser.add_argument('--actor_net_lr', default=1e-4, help="Set the learning rate for the actor network")
@@ -56,6 +61,10 @@ parser.add_argument('--random_seed', type=int, default=24601, help='')
 parser.add_argument('--max_grad_norm', default=1.0, help='Gradient clipping')
 parser.add_argument('--use_cuda', type=str2bool, default=True, help='')
 parser.add_argument('--critic_beta', type=float, default=0.9, help='Exp mvg average decay')
+parser.add_argument('--baseline', type=str, default='exponential', choices=['exponential', 'rollout'], help='REINFORCE baseline')
+parser.add_argument('--bl_alpha', type=float, default=0.05, help='Significance level for updating the rollout baseline')
+parser.add_argument('--bl_eval_size', type=int, default=1000, help='No. of held-out validation instances for updating the rollout baseline')
+parser.add_argument('--bl_update_step', type=int, default=0, help='Also check for a rollout baseline update every bl_update_step steps, 0 for end of epoch only')
 parser.add_argument('--use_KT', type=str2bool, default=True)
 # Misc
 parser.add_argument('--log_step', default=50, help='Log info every log_step steps')
@@ -74,8 +83,12 @@ parser.add_argument('--_id', type=str, default='1234567')
 parser.add_argument('--sl', type=str2bool, default=False)
 parser.add_argument('--use_graph', type=str2bool, default=False)
 parser.add_argument('--make_only', type=int, default=3)
+parser.add_argument('--synthetic', type=str2bool, default=False, help='Generate the datasets in memory instead of on disk')
+parser.add_argument('--max_steps', type=int, default=0, help='Stop training after max_steps steps, 0 for no limit')
 parser.add_argument('--num_workers', type=int, default=0)
 parser.add_argument('--cuda_device', type=int, default=0)
+parser.add_argument('--profile', type=str2bool, default=False, help='Time each phase of the training loop')
+parser.add_argument('--profile_step', type=int, default=100, help='Report phase timings every profile_step steps')
 
 args = vars(parser.parse_args())
 args['model'] = 'nco'
@@ -86,7 +99,8 @@ args['n_nodes'] = args['input_size']
 # Set the random seed
 torch.manual_seed(int(args['random_seed']))
 
-torch.cuda.set_device(args['cuda_device'])
+if args['use_cuda']:
+    torch.cuda.set_device(args['cuda_device'])
 
 # Optionally configure tensorboard
 args['run_name'] = args['_id'][-6:] + '-' + args['run_name']    
@@ -98,6 +112,7 @@ args['test_size'] = args['val_size']
 task = args['task'].split('_')
 args['COP'] = task[0]  # the combinatorial optimization problem
 args, env, training_dataloader, test_dataloader = dataset.build(args, args['epoch_start'])
+reward_fn = inference.make_reward_fn(args, env)
 if args['COP'] == 'mwm2D':
     mwm2D_opt = test_dataloader.dataset.get_average_optimal_weight()
 
@@ -189,6 +204,19 @@ if args['use_cuda']:
     model = model.cuda()
     #critic_mse = critic_mse.cuda()
     critic_exp_mvg_avg = critic_exp_mvg_avg.cuda()
+if args['baseline'] == 'rollout':
+    # held-out instances for the paired t-test, apart from the test set
+    bl_eval_batches = []
+    for obs in dataset.build_heldout(args, args['bl_eval_size']):
+        if args['use_cuda']:
+            obs = obs.cuda()
+        bl_eval_batches.append(torch.transpose(obs, 2, 1))
+    rollout_baseline = RolloutBaseline(model, reward_fn, bl_eval_batches, args['bl_alpha'])
+timer = profiler.timer
+timer.configure(args['profile'], sync_cuda=args['use_cuda'])
+profile_path = os.path.join(args['base_dir'], 'results', 'profile', args['model'], args['COP'], args['_id'], 'phases.json')
+log_fn = None if args['disable_tensorboard'] else log_value
+
 step = 0
 val_step = 0
 tot_R = []
@@ -198,9 +226,14 @@ if not args['is_train']:
 epoch = int(args['epoch_start'])
 
 def eval(val_step, final=False):
-    # Use (greedy) beam search decoding for validation
+    # Use greedy or beam search decoding for validation. The matching
+    # models only decode greedily. With eval_k > 1, best_of_k picks the
+    # decode type
     #model.actor_net.decoder.decode_type = "greedy"
-    model.decode_type("greedy")
+    if int(args['beam_size']) > 1 and args['COP'] != 'mwm2D':
+        model.decode_type("beam_search")
+    else:
+        model.decode_type("greedy")
     print('\nstarting eval\n')
     example_input = []
     example_output = []
@@ -215,17 +248,13 @@ def eval(val_step, final=False):
         if args['use_cuda']:
             obs = obs.cuda()
         obs = torch.transpose(obs, 2, 1)
-        probs, actions, action_idxs, _ = model(obs)
-        if args['COP'] == 'sort':
-            R = env(actions, args['use_KT'], args['use_cuda'])
-        elif args['COP'] == 'mwm2D':
-            # actions is list of len N of (batch_size, n_features)
-            x1 = obs[:, :, 0:args['input_size']]
-            x2 = torch.stack(actions, 2)
-            a = torch.cat([x1, x2], dim=2)
-            R = env(torch.transpose(a, 2, 1), args['use_cuda'])
+        if args['eval_k'] > 1:
+            R, actions, action_idxs = inference.best_of_k(model, obs, args['eval_k'],
+                    reward_fn, args['eval_multistart'])
         else:
-            R = env(actions, args['use_cuda'])
+            with torch.no_grad():
+                probs, actions, action_idxs, _ = model(obs)
+            R = reward_fn(obs, actions)
         eval_R.append(R.data.cpu().numpy())
         val_step += 1
         if val_step % int(args['log_step']) == 0:
@@ -239,7 +268,7 @@ def eval(val_step, final=False):
             #     example_input.append(bat[0, :, idx].data[0])
             #print('Example test input: {}'.format(example_input))
             #print('Example test output: {}'.format(example_output))
-            print('step: {}, example reward: {}'.format(val_step, R[0].data[0]))
+            print('step: {}, example reward: {}'.format(val_step, R[0].item()))
             # if args['plot_attention']:
             #     probs = torch.cat(probs, 0)
             #     plot_attention(example_input,
@@ -271,60 +300,62 @@ def eval(val_step, final=False):
 for i in range(epoch, epoch + int(args['n_epochs'])):
     if args['is_train']:
         # eval at 0 
-        val_step = eval(val_step)
+        with timer.phase('eval'):
+            val_step = eval(val_step)
         # put in train mode!
         model.train()
         # sample_batch is [batch_size x input_dim x sourceL]
-        for batch_id, obs in enumerate(tqdm(training_dataloader,
-                disable=args['disable_progress_bar'])):
+        for batch_id, obs in enumerate(timer.iterate(tqdm(training_dataloader,
+                disable=args['disable_progress_bar']), 'data')):
             obs = Variable(obs, requires_grad=False)
             if args['use_cuda']:
                 obs = obs.cuda()
             obs = torch.transpose(obs, 2, 1)
-            probs, actions, actions_idxs, _ = model(obs)
-            if args['COP'] == 'sort':
-                R = env(actions, args['use_KT'], args['use_cuda'])
-            elif args['COP'] == 'mwm2D':
-                # actions is list of len N of (batch_size, n_features)
-                x1 = obs[:, :, 0:args['input_size']]
-                x2 = torch.stack(actions, 2)
-                a = torch.cat([x1, x2], dim=2)
-                R = env(torch.transpose(a, 2, 1), args['use_cuda'])
-            else:
-                R = env(actions, args['use_cuda'])
+            with timer.phase('actor_forward'):
+                probs, actions, actions_idxs, _ = model(obs)
+            with timer.phase('reward'):
+                R = reward_fn(obs, actions)
             tot_R.append(R.data.cpu().numpy())            
-            if batch_id == 0:
-                critic_exp_mvg_avg = R.mean()
-            else:
-                critic_exp_mvg_avg = (critic_exp_mvg_avg * beta) + ((1. - beta) * R.mean())
-            advantage = R - critic_exp_mvg_avg
-            if not args['use_decoder']:
-                logprobs = torch.stack(probs).sum(dim=0)
-                nll = -logprobs.detach()
-            else:
-                logprobs = 0
-                nll = 0
-                for prob in probs: 
-                    # compute the sum of the log probs
-                    # for each tour in the batch
-                    logprob = torch.log(prob)
-                    nll += -logprob.detach()
-                    logprobs = logprobs + logprob
-                # guard against nan
-                #nll[nll != nll] = 0.
-                # clamp any -inf's to 0 to throw away this tour
-                #logprobs[logprobs < -1000] = 0.
-                # multiply each time step by the advanrate
-            reinforce = advantage.detach() * logprobs
-            actor_loss = reinforce.mean()
-            actor_optim.zero_grad()
-            actor_loss.backward()
-            # clip gradient norms
-            torch.nn.utils.clip_grad_norm(model.parameters(),
-                    float(args['max_grad_norm']), norm_type=2)
-            actor_optim.step()
-            actor_scheduler.step()
-            critic_exp_mvg_avg = critic_exp_mvg_avg.detach()
+            if args['baseline'] == 'rollout':
+                with timer.phase('baseline'):
+                    # cost of the frozen policy's greedy tours, [batch_size]
+                    bl_R = rollout_baseline.eval(obs)
+            with timer.phase('actor_update'):
+                if args['baseline'] == 'rollout':
+                    advantage = R - bl_R
+                else:
+                    if batch_id == 0:
+                        critic_exp_mvg_avg = R.mean()
+                    else:
+                        critic_exp_mvg_avg = (critic_exp_mvg_avg * beta) + ((1. - beta) * R.mean())
+                    advantage = R - critic_exp_mvg_avg
+                if not args['use_decoder']:
+                    logprobs = torch.stack(probs).sum(dim=0)
+                    nll = -logprobs.detach()
+                else:
+                    logprobs = 0
+                    nll = 0
+                    for prob in probs: 
+                        # compute the sum of the log probs
+                        # for each tour in the batch
+                        logprob = torch.log(prob)
+                        nll += -logprob.detach()
+                        logprobs = logprobs + logprob
+                    # guard against nan
+                    #nll[nll != nll] = 0.
+                    # clamp any -inf's to 0 to throw away this tour
+                    #logprobs[logprobs < -1000] = 0.
+                    # multiply each time step by the advanrate
+                reinforce = advantage.detach() * logprobs
+                actor_loss = reinforce.mean()
+                actor_optim.zero_grad()
+                actor_loss.backward()
+                # clip gradient norms
+                torch.nn.utils.clip_grad_norm(model.parameters(),
+                        float(args['max_grad_norm']), norm_type=2)
+                actor_optim.step()
+                actor_scheduler.step()
+                critic_exp_mvg_avg = critic_exp_mvg_avg.detach()
             #critic_scheduler.step()
             #R = R.detach()
             #critic_loss = critic_mse(v.squeeze(1), R)
@@ -334,31 +365,55 @@ for i in range(epoch, epoch + int(args['n_epochs'])):
             #        float(args['max_grad_norm']), norm_type=2)
             #critic_optim.step()
             step += 1
+            with timer.phase('logging'):
+                if not args['disable_tensorboard']:
+                    log_value('Running_avg_reward', -1 * R.mean().item(), step)
+                    log_value('actor_loss', actor_loss.item(), step)
+                    #log_value('critic_loss', critic_loss.data[0], step)
+                    if args['baseline'] == 'rollout':
+                        log_value('rollout_baseline', bl_R.mean().item(), step)
+                    else:
+                        log_value('critic_exp_mvg_avg', critic_exp_mvg_avg.item(), step)
+                    log_value('nll', nll.mean().item(), step)
+                if step % int(args['log_step']) == 0:
+                    print('epoch: {}, train_batch_id: {}, avg_reward: {}'.format(
+                        i, batch_id, R.mean().item()))
+                    example_output = []
+                    #example_input = []
+                    if args['COP'] == 'sort':
+                        for idx, action in enumerate(actions):
+                            example_output.append(round(action[0].item()))  # <-- ?? 
+                        #if task[0] == 'tsp':
+                        #    example_output.append(actions_idxs[idx][0].data[0])
+                        #else:
+                        #example_input.append(sample_batch[0, :, idx][0])
+                        #print('Example train input: {}'.format(example_input))
+                        print('Example train output: {}'.format(example_output))
+            if args['baseline'] == 'rollout' and args['bl_update_step'] > 0 \
+                    and step % args['bl_update_step'] == 0:
+                with timer.phase('baseline_update'):
+                    rollout_baseline.epoch_callback(model)
+            timer.step(args['parallel_envs'])
+            if timer.enabled and step % args['profile_step'] == 0:
+                timer.report(step, profile_path, log_fn)
+            if args['max_steps'] > 0 and step >= args['max_steps']:
+                break
+        # check for a baseline update at the end of the epoch, unless the check above just ran
+        if args['baseline'] == 'rollout' and (args['bl_update_step'] <= 0 or step % args['bl_update_step'] != 0):
+            with timer.phase('baseline_update'):
+                rollout_baseline.epoch_callback(model)
             if not args['disable_tensorboard']:
-                log_value('Running_avg_reward', -1 * R.mean().data[0], step)
-                log_value('actor_loss', actor_loss.data[0], step)
-                #log_value('critic_loss', critic_loss.data[0], step)
-                log_value('critic_exp_mvg_avg', critic_exp_mvg_avg.data[0], step)
-                log_value('nll', nll.mean().data[0], step)
-            if step % int(args['log_step']) == 0:
-                print('epoch: {}, train_batch_id: {}, avg_reward: {}'.format(
-                    i, batch_id, R.mean().data[0]))
-                example_output = []
-                #example_input = []
-                if args['COP'] == 'sort':
-                    for idx, action in enumerate(actions):
-                        example_output.append(round(action[0].data[0]))  # <-- ?? 
-                    #if task[0] == 'tsp':
-                    #    example_output.append(actions_idxs[idx][0].data[0])
-                    #else:
-                    #example_input.append(sample_batch[0, :, idx][0])
-                    #print('Example train input: {}'.format(example_input))
-                    print('Example train output: {}'.format(example_output))
+                log_value('rollout_baseline_updates', rollout_baseline.n_updates, step)
         if args['save_model']:
             print(' [*] saving model...')
             torch.save(model, os.path.join(args['save_dir'], 'nco-COP-{}-N-{}-epoch-{}.pt'.format(args['COP'], args['input_size'], i)))   
+    if args['max_steps'] > 0 and step >= args['max_steps']:
+        print(' [*] stopping after {} steps'.format(args['max_steps']))
+        break
 # Eval one last time
-val_step = eval(val_step, True)
+with timer.phase('eval'):
+    val_step = eval(val_step, True)
+timer.report(step, profile_path, log_fn)
 
 if args['save_stats']:
     # write training stats to file
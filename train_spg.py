@@ -10,8 +10,6 @@ import json
 import h5py 
 import copy
 import pickle
-# DEBUG
-import pdb
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -27,6 +25,9 @@ from spg.models import SPGSequentialActor, SPGMatchingActor
 from spg.models import SPGSequentialCritic, SPGMatchingCritic
 from spg.memory import Memory as ReplayBuffer
 import spg.util as util
+from spg import profiler
+from spg import distributed
+from spg.layers import sinkhorn_peak_bytes
 
 # tasks
 from envs import dataset
@@ -45,6 +46,8 @@ parser.add_argument('--n_nodes', type=int, default=10)
 parser.add_argument('--arch', type=str, default='sequential')
 parser.add_argument('--sinkhorn_iters', type=int, default=10)
 parser.add_argument('--sinkhorn_tau', type=float, default=0.05)
+parser.add_argument('--sinkhorn_memory_mb', type=float, default=0., help='Scratch memory budget of Sinkhorn in MB for eval, computed in chunks without gradients; 0 for dense')
+parser.add_argument('--sparse_k', type=int, default=0, help='Matching arch: Sinkhorn and rounding over k candidates per node (the farthest, as mwm2D maximizes weight), 0 for dense')
 parser.add_argument('--actor_lr', type=float, default=3e-4)
 parser.add_argument('--critic_lr', type=float, default=3e-4)
 parser.add_argument('--actor_lr_decay_rate', type=float, default=0.95)
@@ -53,6 +56,9 @@ parser.add_argument('--actor_lr_decay_step', type=int, default=50000)
 parser.add_argument('--critic_lr_decay_step', type=int, default=5000)
 parser.add_argument('--k_exchange', type=int, default=2)
 parser.add_argument('--epsilon', type=float, default=1.)
+parser.add_argument('--n_samples', type=int, default=1, help='Gumbel-Sinkhorn samples per instance in each rollout, 1 for the deterministic psi')
+parser.add_argument('--gumbel_noise', type=float, default=1., help='Scale of the Gumbel noise added to the scores when n_samples > 1')
+parser.add_argument('--sample_mode', type=str, default='best', choices=['best', 'all'], help='Keep the best of the n_samples solutions by reward, or add all of them to the replay buffer')
 parser.add_argument('--epsilon_decay_rate', type=float, default=0.97)
 parser.add_argument('--epsilon_decay_step', type=int, default=500000)
 parser.add_argument('--embedding_dim', type=int, default=128)
@@ -66,6 +72,14 @@ parser.add_argument('--buffer_size', type=int, default=1000000)
 parser.add_argument('--log_step', type=int, default=100, help='Log info every log_step steps')
 parser.add_argument('--disable_critic_aux_loss', type=util.str2bool, default=False)
 parser.add_argument('--actor_workers', type=int, default=4)
+parser.add_argument('--updates_per_step', type=int, default=1, help='Learner updates per learner phase')
+parser.add_argument('--world_size', type=int, default=1, help='Data-parallel training over this many local processes (CPU, gloo), each rolling out parallel_envs / world_size instances')
+parser.add_argument('--dist_port', type=int, default=29500, help='TCP port of rank 0 for --world_size > 1')
+parser.add_argument('--rollouts_per_update', type=int, default=1, help='Rollouts between learner phases')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='Run the actor and critic forward passes in training under bfloat16 autocast')
+parser.add_argument('--encoder_cache_staleness', type=int, default=-1, help='Reuse the rollout encodings of replayed states that are at most this many learner steps old in the actor update, -1 to always re-encode. '
+        'Replay is uniform over the buffer, so this only helps when --buffer_size is close to parallel_envs * (ceil(K * rollouts_per_update / updates_per_step) + 1); '
+        'at the default buffer_size almost no replayed state hits the cache')
 # CUDA
 parser.add_argument('--use_cuda', type=util.str2bool, default=True)
 parser.add_argument('--cuda_device', type=int, default=0)
@@ -84,6 +98,10 @@ parser.add_argument('--disable_progress_bar', type=util.str2bool, default=False)
 parser.add_argument('--_id', type=str, default='123456789', help='FGLab experiment ID')
 parser.add_argument('--num_workers', type=int, default=1)
 parser.add_argument('--make_only', type=int, default=3)
+parser.add_argument('--synthetic', type=util.str2bool, default=False, help='Generate the datasets in memory instead of on disk')
+parser.add_argument('--max_steps', type=int, default=0, help='Stop training after max_steps steps, 0 for no limit')
+parser.add_argument('--profile', type=util.str2bool, default=False, help='Time each phase of the training loop')
+parser.add_argument('--profile_step', type=int, default=100, help='Report phase timings every profile_step steps')
 
 Experience = namedtuple('Experience', ['state', 'action', 'reward'])
 
@@ -95,8 +113,13 @@ DEBUG = False
 ######################################### 
 
 def evaluate_model(args, count):
+    # with --world_size > 1, only rank 0 evaluates, logs and saves
+    is_main = args['rank'] == 0
+    # the instances this rank rolls out per step
+    rank_envs = args['parallel_envs'] // args['world_size']
     # Pretty print the run args
-    pp.pprint(args)
+    if is_main:
+        pp.pprint(args)
 
     if not args['disable_tensorboard'] and count == 0:
         # append last 6 digits of experiment id to run name
@@ -135,6 +158,16 @@ def evaluate_model(args, count):
                 args['actor_workers'], args['use_cuda'])
             critic = SPGMatchingCritic(args['n_features'], args['n_nodes'], args['embedding_dim'],
                 args['rnn_dim'], args['use_cuda'])
+    if args['sparse_k'] > 0:
+        if isinstance(actor, SPGMatchingActor):
+            actor.sparse_k = args['sparse_k']
+        else:
+            print(' [!] --sparse_k only applies to the matching arch, using dense Sinkhorn')
+    if args['sinkhorn_memory_mb'] > 0:
+        actor.sinkhorn.max_bytes = int(args['sinkhorn_memory_mb'] * 1e6)
+        print(' [*] chunked Sinkhorn for eval, peak allocation {:.2f} MB per batch of {}'.format(
+            sinkhorn_peak_bytes(args['parallel_envs'], args['n_nodes'], actor.sinkhorn.max_bytes) / 1e6,
+            args['parallel_envs']))
     args['save_dir'] = os.path.join(args['base_dir'], 'results', 'models', args['COP'], 'spg', args['arch'], args['_id'])    
     try:
         os.makedirs(args['save_dir'])
@@ -144,6 +177,14 @@ def evaluate_model(args, count):
     if args['use_cuda']:
         actor = actor.cuda()
         critic = critic.cuda()
+    if args['world_size'] > 1:
+        # start every rank from the weights of rank 0
+        distributed.broadcast_module(actor)
+        distributed.broadcast_module(critic)
+
+    timer = profiler.timer
+    timer.configure(args['profile'], sync_cuda=args['use_cuda'])
+    profile_path = os.path.join(args['base_dir'], 'results', 'profile', args['model'], args['COP'], args['_id'], 'phases.json')
 
     # Optimizers
     actor_optim = optim.Adam(actor.parameters(), lr=args['actor_lr'])
@@ -174,13 +215,39 @@ def evaluate_model(args, count):
     observation_shape = [args['n_nodes'], args['n_features']]
     if args['COP'] == 'mwm2D': 
         observation_shape[0] *= 2
+    encoding_shape, encoding_limit, max_hit_rate = None, 0, 0.
+    if args['encoder_cache_staleness'] >= 0:
+        # keep the encodings of the entries appended over the last
+        # encoder_cache_staleness learner steps, plus one rollout
+        encoding_shape = [args['n_nodes'], actor.gru.hidden_size * (2 if actor.gru.bidirectional else 1)]
+        rollouts = int(np.ceil(args['encoder_cache_staleness'] * args['rollouts_per_update'] /
+            float(args['updates_per_step']))) + 1
+        encoding_limit = rollouts * rank_envs
+        if args['n_samples'] > 1 and args['sample_mode'] == 'all':
+            encoding_limit *= args['n_samples']
+        print(' [*] caching the encodings of the latest {} replay buffer entries'.format(
+            min(encoding_limit, args['buffer_size'])))
+        # minibatches are drawn uniformly from the buffer, and older entries are
+        # too stale to reuse, so a larger cache would not raise the hit rate
+        max_hit_rate = min(1., encoding_limit / float(args['buffer_size']))
+        if max_hit_rate < 0.5:
+            print(' [!] once the replay buffer is full, at most {:.1%} of the replayed states are fresh enough ' \
+                    'to reuse their encodings; the cache pays off for --buffer_size close to {}'.format(
+                max_hit_rate, encoding_limit))
     replay_buffer = ReplayBuffer(args['buffer_size'], action_shape=[args['n_nodes'], args['n_nodes']], 
-            observation_shape=observation_shape, use_cuda=args['replay_buffer_gpu'])
+            observation_shape=observation_shape, use_cuda=args['replay_buffer_gpu'],
+            encoding_shape=encoding_shape, encoding_limit=encoding_limit)
     
     # Get dataloaders for train and test datasets
+    if args['world_size'] > 1 and not is_main:
+        # rank 0 writes the datasets first
+        distributed.barrier()
+    # only rank 0 builds the test set and its reference solutions
     args, env, training_dataloader, test_dataloader = dataset.build(args, args['epoch_start'])
-    if args['COP'] == 'mwm2D':
+    if args['COP'] == 'mwm2D' and is_main:
         mwm2D_opt = test_dataloader.dataset.get_average_optimal_weight()
+    if args['world_size'] > 1 and is_main:
+        distributed.barrier()
     # Open files for writing results
     if args['save_stats']:
         fglab_results_dir = os.path.join(args['base_dir'], 'results', 'fglab', args['model'], args['COP'], args['_id'])
@@ -197,6 +264,7 @@ def evaluate_model(args, count):
     # approx, since we throw away minibatches that aren't complete
     num_steps_per_epoch = np.ceil(args['train_size'] / float(args['parallel_envs']))
     train_step = int(epoch * num_steps_per_epoch)
+    start_step = train_step
     eval_step = int(epoch * (np.ceil(args['test_size'] / float(args['parallel_envs']))))
     epsilon = args['epsilon']
     epsilon_step = args['epsilon_decay_step']
@@ -204,8 +272,17 @@ def evaluate_model(args, count):
     
     running_avg_R = deque(maxlen=100)
     running_avg_bd = deque(maxlen=100)
+    # wall time (secs) of each rollout and each learner phase of updates_per_step updates
+    rollout_times = deque(maxlen=100)
+    update_times = deque(maxlen=100)
+    # fraction of each actor minibatch served from the encoder cache
+    cache_hits = deque(maxlen=100)
+    learner_steps = 0
     tot_R = []
     birkhoff_dist = []
+    # the losses of the last minibatch of each learner phase
+    actor_losses = []
+    critic_losses = []
     scores = {'_scores': {}}
     eval_means = []
     eval_stddevs = []
@@ -226,7 +303,8 @@ def evaluate_model(args, count):
             obs = Variable(obs, volatile=True)
             if args['use_cuda']:
                 obs = obs.cuda(non_blocking=True)
-            psi, action = actor(obs)
+            with torch.no_grad():
+                psi, action = actor(obs)
             action = Variable(action, volatile=True)
             dist = torch.sum(torch.sum(psi * action, dim=1), dim=1) / args['n_nodes']
             if args['COP'] == 'sort' or args['COP'] == 'tsp':
@@ -268,13 +346,94 @@ def evaluate_model(args, count):
             log_value('Eval dist to nearest vertex of Birkhoff poly', mean_eval_birkhoff_dist, eval_step)
         return eval_step
 
+    #
+    # helper function for the actor's encodings of a replayed minibatch, reusing
+    # the cached ones that are fresh enough and re-encoding the rest. The cached
+    # rows only update the actor's output layer
+    #
+    def cached_encoding(s_batch, enc_batch, enc_steps):
+        cached = (enc_steps >= 0) & (learner_steps - enc_steps <= args['encoder_cache_staleness'])
+        cache_hits.append(cached.float().mean().item())
+        fresh = torch.nonzero(~cached).view(-1)
+        if fresh.numel() == 0:
+            return enc_batch
+        with timer.phase('actor_encode'):
+            return enc_batch.index_copy(0, fresh, actor.encode(s_batch[fresh]).to(enc_batch.dtype))
+
+    #
+    # helper function for one critic and actor update on a replayed minibatch
+    #
+    def learner_step(s_batch, a_batch, psi_batch, targets, enc_batch=None, enc_steps=None):
+        # Compute Q(s_t, mu(s_t)=a_t)
+        # size is [batch_size, 1]
+        # N.B. We use the actions from the replay buffer to update the critic
+        # a_batch_t are the hard permutations
+        # the state is embedded once and shared by the hard and soft actions
+        # the losses are computed in float32 from the (possibly bf16) Q values
+        with timer.phase('critic_update'):
+            with util.autocast(args['precision'], args['use_cuda']):
+                # bn1 tracks the state once per action, as two critic() calls would
+                state = critic.embed_state(s_batch, n_scores=1 if args['disable_critic_aux_loss'] else 2)
+                hard_Q = critic.score(state, a_batch).squeeze(2).float()
+                soft_Q = None
+                if not args['disable_critic_aux_loss']:
+                    soft_Q = critic.score(state, psi_batch).squeeze(2).float()
+            critic_out = critic_loss(hard_Q, targets)
+            if soft_Q is not None:
+                critic_aux_out = critic_aux_loss(soft_Q, hard_Q.detach())
+                critic_optim.zero_grad()
+                (critic_out + critic_aux_out).backward()
+            else:
+                critic_optim.zero_grad()
+                critic_out.backward() 
+            if args['world_size'] > 1:
+                with timer.phase('all_reduce'):
+                    distributed.all_reduce_gradients(critic)
+            # clip gradient norms
+            torch.nn.utils.clip_grad_norm(critic.parameters(),
+                args['max_grad_norm'], norm_type=2)
+            critic_optim.step()
+            critic_scheduler.step()                 
+        
+        with timer.phase('actor_update'):
+            critic_optim.zero_grad()                
+            actor_optim.zero_grad()
+            with util.autocast(args['precision'], args['use_cuda']):
+                encoding = None
+                if enc_batch is not None:
+                    encoding = cached_encoding(s_batch, enc_batch, enc_steps)
+                soft_action, _ = actor(s_batch, do_round=False, encoding=encoding)
+                # N.B. we use the action just computed from the actor net here, which 
+                # will be used to compute the actor gradients
+                # compute gradient of critic network w.r.t. actions, grad Q_a(s,a)
+                soft_critic_out = critic(s_batch, soft_action).squeeze(2).float().mean()
+            actor_loss = -soft_critic_out
+            actor_loss.backward()
+            if args['world_size'] > 1:
+                with timer.phase('all_reduce'):
+                    distributed.all_reduce_gradients(actor)
+
+            # clip gradient norms
+            torch.nn.utils.clip_grad_norm(actor.parameters(),
+                args['max_grad_norm'], norm_type=2)
+
+            actor_optim.step()
+            actor_scheduler.step()
+        return actor_loss, critic_out, hard_Q, soft_Q
+
+    def reached_max_steps():
+        return args['max_steps'] > 0 and train_step - start_step >= args['max_steps']
+
     #
     # for each epoch
     #
     i = 0
     for i in range(epoch, epoch + args['n_epochs']):
-        pdb.set_trace()
-        eval_step = eval(eval_step)
+        if is_main:
+            with timer.phase('eval'):
+                eval_step = eval(eval_step)
+        if args['world_size'] > 1:
+            training_dataloader.sampler.set_epoch(i)
 
         if args['save_model']:
             print(' [*] saving actor and critic...')
@@ -286,162 +445,202 @@ def evaluate_model(args, count):
         #
         # for observation within epoch
         #
-        for obs in tqdm(training_dataloader, disable=args['disable_progress_bar']):
-            if args['use_cuda']: obs.pin_memory()
-            obs = Variable(obs, requires_grad=False)
-            if args['use_cuda']:
-                obs = obs.cuda(non_blocking=True)
+        for obs in timer.iterate(tqdm(training_dataloader, disable=args['disable_progress_bar']), 'data'):
+            with timer.phase('rollout', out=rollout_times):
+                if args['use_cuda']: obs.pin_memory()
+                obs = Variable(obs, requires_grad=False)
+                if args['use_cuda']:
+                    obs = obs.cuda(non_blocking=True)
 
-            psi, action = actor(obs) # TODO whats happening here?
-            action = Variable(action, requires_grad=False)
-            dist = torch.sum(torch.sum(psi * action, dim=1), dim=1) / args['n_nodes']
-            if action is None: # Nan'd out
-                if args['save_stats']:   
-                    scores['_scores']['eval_avg_reward_{}'.format(train_step * args['parallel_envs'])] = -1
-                    json.dump(scores, fglab_results)
-                    fglab_results.close()
-                return 0, 0
+                with timer.phase('actor_forward'), util.autocast(args['precision'], args['use_cuda']):
+                    encoding = None
+                    if replay_buffer.encodings is not None:
+                        # encode once, for the rollout and for the replay buffer
+                        encoding = actor.encode(obs)
+                    if args['n_samples'] > 1:
+                        # [batch_size, n_samples, N, N], one row of samples per instance
+                        psi, action = actor.sample(obs, args['n_samples'], args['gumbel_noise'], encoding=encoding)
+                    else:
+                        psi, action = actor(obs, encoding=encoding) # TODO whats happening here?
+                nan_out = action is None
+                if args['world_size'] > 1:
+                    # every rank stops if any of them NaN'd out, or the others would wait in the all-reduces
+                    nan_out = distributed.any_rank(nan_out)
+                if nan_out: # Nan'd out
+                    if args['save_stats']:   
+                        scores['_scores']['eval_avg_reward_{}'.format(train_step * args['parallel_envs'])] = -1
+                        json.dump(scores, fglab_results)
+                        fglab_results.close()
+                    return 0, 0
+                action = Variable(action, requires_grad=False)
+                if args['n_samples'] > 1:
+                    # solve the n_samples copies of each instance as one batch
+                    instances = obs
+                    obs = obs.repeat_interleave(args['n_samples'], 0)
+                    psi = psi.view(-1, args['n_nodes'], args['n_nodes'])
+                    action = action.view(psi.size())
+                dist = torch.sum(torch.sum(psi * action, dim=1), dim=1) / args['n_nodes']
             
-            # do epsilon greedy exploration
-            if np.random.rand() < epsilon:
-                # Add noise in the form of 2-exchange neighborhoods
-                for r in range(args['k_exchange']):
-                    # randomly choose two row idxs
-                    idxs = np.random.randint(0, args['n_nodes'], size=2)
-                    # swap the two rows
-                    tmp = action[:, idxs[0]].clone()
-                    tmp2 = action[:, idxs[1]].clone()
-                    tmp3 = psi[:, idxs[0]].clone()
-                    tmp4 = psi[:, idxs[1]].clone()
-                    action[:, idxs[0]] = tmp2
-                    action[:, idxs[1]] = tmp
-                    psi[:, idxs[0]] = tmp4
-                    psi[:, idxs[1]] = tmp3
-            if train_step > 0 and epsilon > 0.01:
-                epsilon += epsilon_decay
+                # do epsilon greedy exploration
+                if np.random.rand() < epsilon:
+                    # Add noise in the form of 2-exchange neighborhoods
+                    for r in range(args['k_exchange']):
+                        # randomly choose two row idxs
+                        idxs = np.random.randint(0, args['n_nodes'], size=2)
+                        # swap the two rows
+                        tmp = action[:, idxs[0]].clone()
+                        tmp2 = action[:, idxs[1]].clone()
+                        tmp3 = psi[:, idxs[0]].clone()
+                        tmp4 = psi[:, idxs[1]].clone()
+                        action[:, idxs[0]] = tmp2
+                        action[:, idxs[1]] = tmp
+                        psi[:, idxs[0]] = tmp4
+                        psi[:, idxs[1]] = tmp3
+                if train_step > 0 and epsilon > 0.01:
+                    epsilon += epsilon_decay
             
-            if args['COP'] == 'sort' or args['COP'] == 'tsp':
-                # apply the permutation to the input
-                solutions = torch.matmul(torch.transpose(obs, 1, 2), action)
-                if args['COP'] == 'tsp':
-                    solutions = torch.transpose(solutions, 1, 2)
-                R = env(solutions, args['use_cuda'])
-            elif args['COP'] == 'mwm2D':
-                matchings = torch.matmul(torch.transpose(obs[:,args['n_nodes']:2*args['n_nodes'],:], 1, 2), action)
-                matchings = torch.transpose(matchings, 1, 2)               
-                matchings = torch.cat([obs[:,0:args['n_nodes'],:], matchings], dim=1)
-                R = env(matchings, args['use_cuda'])
-            
-            running_avg_R.append(copy.copy(R.data.cpu().numpy()))
-            running_avg_bd.append(copy.copy(dist.data.cpu().numpy()))
-            if args['save_stats']: 
-                tot_R.append(R.data.cpu().numpy())
-                birkhoff_dist.append(dist.data.cpu().numpy())
-            if train_step % args['log_step'] == 0 and not DEBUG:
-                print('epoch: {}, step: {}, avg reward: {:.4f}, std dev: {:.4f}, min reward: {:.4f}, ' \
-                        'max reward: {:.4f}, epsilon: {:.4f}, bd: {:.4f}'.format(
-                    i+1, train_step, np.mean(running_avg_R), np.std(running_avg_R), np.min(running_avg_R),
-                        np.max(running_avg_R), epsilon, np.mean(running_avg_bd))) 
-                if args['COP'] == 'sort':
-                    inn = []
-                    out = []
-                    for n,m in zip(torch.t(obs[0]).data[0], solutions[0].data[0]):
-                        inn.append(n)
-                        out.append(m)
-                    print('step: {}, {}'.format(train_step, inn))                    
-                    print('step: {}, {}'.format(train_step, out))
-
-            if not args['disable_tensorboard']:
-                log_value('Running avg reward', np.mean(running_avg_R), train_step)
-                log_value('Running avg std dev', np.std(running_avg_R), train_step)
-                log_value('Closeness to nearest vertex of Birkhoff Poly', np.mean(running_avg_bd), train_step)
-                log_value('Exploration $\epsilon$', epsilon, train_step)
+                with timer.phase('reward'):
+                    if args['COP'] == 'sort' or args['COP'] == 'tsp':
+                        # apply the permutation to the input
+                        solutions = torch.matmul(torch.transpose(obs, 1, 2), action)
+                        if args['COP'] == 'tsp':
+                            solutions = torch.transpose(solutions, 1, 2)
+                        R = env(solutions, args['use_cuda'])
+                    elif args['COP'] == 'mwm2D':
+                        matchings = torch.matmul(torch.transpose(obs[:,args['n_nodes']:2*args['n_nodes'],:], 1, 2), action)
+                        matchings = torch.transpose(matchings, 1, 2)               
+                        matchings = torch.cat([obs[:,0:args['n_nodes'],:], matchings], dim=1)
+                        R = env(matchings, args['use_cuda'])
+                if args['n_samples'] > 1 and args['sample_mode'] == 'best':
+                    with timer.phase('select_samples'):
+                        # keep the best sample of each instance
+                        best = R.view(-1, args['n_samples']).argmax(1)
+                        idxs = torch.arange(best.size(0), device=best.device) * args['n_samples'] + best
+                        obs, action, psi, R, dist = instances, action[idxs], psi[idxs], R[idxs], dist[idxs]
+                        if args['COP'] == 'sort' or args['COP'] == 'tsp':
+                            solutions = solutions[idxs]
             
-            if args['replay_buffer_gpu']:
-                replay_buffer.append(obs.data, action.data.byte(), psi.data, R.data)
-            else:
-                replay_buffer.append(obs.data.cpu(), action.data.byte().cpu(), psi.data.cpu(), R.data.cpu())
-            # sample from replay buffer if possible
-            if replay_buffer.nb_entries > args['batch_size']:
-                s_batch, a_batch, psi_batch, r_batch = replay_buffer.sample(args['batch_size'])
-                #s_batch = torch.stack(s_batch)
-                #a_batch = torch.stack(a_batch).float()
-                a_batch = a_batch.float()
-                #psi_batch = torch.stack(psi_batch)
-                #targets = torch.stack(r_batch)
-                targets = r_batch
-                if not args['replay_buffer_gpu'] and args['use_cuda']:                
-                    s_batch.pin_memory()
-                    psi_batch.pin_memory()
-                    a_batch.pin_memory()
-                    targets.pin_memory()
-                    s_batch = Variable(s_batch.cuda(non_blocking=True))
-                    psi_batch = Variable(psi_batch.cuda(non_blocking=True))
-                    a_batch = Variable(a_batch.cuda(non_blocking=True))
-                    targets = Variable(targets.cuda(non_blocking=True))
-                else:
-                    s_batch = Variable(s_batch)
-                    psi_batch = Variable(psi_batch)
-                    a_batch = Variable(a_batch)
-                    targets = Variable(targets)
-                # Compute Q(s_t, mu(s_t)=a_t)
-                # size is [batch_size, 1]
-                # N.B. We use the actions from the replay buffer to update the critic
-                # a_batch_t are the hard permutations
-                hard_Q = critic(s_batch, a_batch).squeeze(2)
-                critic_out = critic_loss(hard_Q, targets)
-                if not args['disable_critic_aux_loss']:
-                    soft_Q = critic(s_batch, psi_batch).squeeze(2)
-                    critic_aux_out = critic_aux_loss(soft_Q, hard_Q.detach())
-                    critic_optim.zero_grad()
-                    (critic_out + critic_aux_out).backward()
-                else:
-                    critic_optim.zero_grad()
-                    critic_out.backward() 
-                # clip gradient norms
-                torch.nn.utils.clip_grad_norm(critic.parameters(),
-                    args['max_grad_norm'], norm_type=2)
-                critic_optim.step()
-                critic_scheduler.step()                 
-                
-                critic_optim.zero_grad()                
-                actor_optim.zero_grad()
-                soft_action, _ = actor(s_batch, do_round=False)
-                # N.B. we use the action just computed from the actor net here, which 
-                # will be used to compute the actor gradients
-                # compute gradient of critic network w.r.t. actions, grad Q_a(s,a)
-                soft_critic_out = critic(s_batch, soft_action).squeeze(2).mean()
-                actor_loss = -soft_critic_out
-                actor_loss.backward()
+            with timer.phase('logging'):
+                running_avg_R.append(copy.copy(R.data.cpu().numpy()))
+                running_avg_bd.append(copy.copy(dist.data.cpu().numpy()))
+                if args['save_stats']: 
+                    tot_R.append(R.data.cpu().numpy())
+                    birkhoff_dist.append(dist.data.cpu().numpy())
+                if train_step % args['log_step'] == 0 and is_main and not DEBUG:
+                    print('epoch: {}, step: {}, avg reward: {:.4f}, std dev: {:.4f}, min reward: {:.4f}, ' \
+                            'max reward: {:.4f}, epsilon: {:.4f}, bd: {:.4f}'.format(
+                        i+1, train_step, np.mean(running_avg_R), np.std(running_avg_R), np.min(running_avg_R),
+                            np.max(running_avg_R), epsilon, np.mean(running_avg_bd))) 
+                    if len(update_times) > 0:
+                        print('rollout: {:.2f} ms ({:.1f} instances/s per rank), learner update: {:.2f} ms, ' \
+                                'updates per rollout: {:.2f}'.format(1000 * np.mean(rollout_times),
+                            rank_envs / np.mean(rollout_times), 1000 * np.mean(update_times) / args['updates_per_step'],
+                            args['updates_per_step'] / float(args['rollouts_per_update'])))
+                    if len(cache_hits) > 0:
+                        print('encoder cache hit rate: {:.3f}'.format(np.mean(cache_hits)))
+                    if args['COP'] == 'sort':
+                        inn = []
+                        out = []
+                        for n,m in zip(torch.t(obs[0]).data[0], solutions[0].data[0]):
+                            inn.append(n)
+                            out.append(m)
+                        print('step: {}, {}'.format(train_step, inn))                    
+                        print('step: {}, {}'.format(train_step, out))
 
-                # clip gradient norms
-                torch.nn.utils.clip_grad_norm(actor.parameters(),
-                    args['max_grad_norm'], norm_type=2)
-
-                actor_optim.step()
-                actor_scheduler.step()
+                if not args['disable_tensorboard']:
+                    log_value('Running avg reward', np.mean(running_avg_R), train_step)
+                    log_value('Running avg std dev', np.std(running_avg_R), train_step)
+                    log_value('Closeness to nearest vertex of Birkhoff Poly', np.mean(running_avg_bd), train_step)
+                    log_value('Exploration $\epsilon$', epsilon, train_step)
+        
+            with timer.phase('buffer_append'):
+                if encoding is not None:
+                    encoding = encoding.data
+                    if encoding.size(0) != obs.size(0):
+                        # every sample of an instance shares its encoding
+                        encoding = encoding.repeat_interleave(args['n_samples'], 0)
+                if args['replay_buffer_gpu']:
+                    replay_buffer.append(obs.data, action.data.byte(), psi.data, R.data, encoding, learner_steps)
+                else:
+                    replay_buffer.append(obs.data.cpu(), action.data.byte().cpu(), psi.data.cpu(), R.data.cpu(),
+                            None if encoding is None else encoding.cpu(), learner_steps)
+            # sample from replay buffer if possible, once every rollouts_per_update rollouts
+            if (train_step + 1) % args['rollouts_per_update'] == 0 and \
+                    replay_buffer.nb_entries > args['batch_size']:
+                with timer.phase('learner', out=update_times):
+                    # pre-sample all minibatches for this learner phase in one go
+                    n_updates = args['updates_per_step']
+                    with timer.phase('buffer_sample'):
+                        if replay_buffer.encodings is not None:
+                            s_all, a_all, psi_all, r_all, enc_all, enc_steps_all = replay_buffer.sample(
+                                    args['batch_size'] * n_updates, with_encodings=True)
+                        else:
+                            s_all, a_all, psi_all, r_all = replay_buffer.sample(args['batch_size'] * n_updates)
+                        a_all = a_all.float()
+                        if not args['replay_buffer_gpu'] and args['use_cuda']:
+                            s_all = s_all.pin_memory().cuda(non_blocking=True)
+                            a_all = a_all.pin_memory().cuda(non_blocking=True)
+                            psi_all = psi_all.pin_memory().cuda(non_blocking=True)
+                            r_all = r_all.pin_memory().cuda(non_blocking=True)
+                            if replay_buffer.encodings is not None:
+                                enc_all = enc_all.pin_memory().cuda(non_blocking=True)
+                                enc_steps_all = enc_steps_all.cuda()
+                    minibatches = zip(torch.split(s_all, args['batch_size']), torch.split(a_all, args['batch_size']),
+                            torch.split(psi_all, args['batch_size']), torch.split(r_all, args['batch_size']))
+                    if replay_buffer.encodings is not None:
+                        encodings = zip(torch.split(enc_all, args['batch_size']), torch.split(enc_steps_all, args['batch_size']))
+                    else:
+                        encodings = [(None, None)] * n_updates
+                    for (s_batch, a_batch, psi_batch, targets), (enc_batch, enc_steps) in zip(minibatches, encodings):
+                        actor_loss, critic_out, hard_Q, soft_Q = learner_step(Variable(s_batch),
+                                Variable(a_batch), Variable(psi_batch), Variable(targets), enc_batch, enc_steps)
+                        learner_steps += 1
+                if args['save_stats']:
+                    actor_losses.append(actor_loss.item())
+                    critic_losses.append(critic_out.item())
 
                 if not args['disable_tensorboard']:
-                    log_value('actor loss', actor_loss.data[0], train_step)
-                    log_value('critic loss', critic_out.data[0], train_step)
-                    log_value('avg hard Q', hard_Q.mean().data[0], train_step)  
-                    if not args['disable_critic_aux_loss']:
-                        log_value('avg soft Q', soft_Q.mean().data[0], train_step)
+                    log_value('actor loss', actor_loss.item(), train_step)
+                    log_value('critic loss', critic_out.item(), train_step)
+                    log_value('avg hard Q', hard_Q.mean().item(), train_step)
+                    if soft_Q is not None:
+                        log_value('avg soft Q', soft_Q.mean().item(), train_step)
+                    log_value('Rollout time (ms)', 1000 * np.mean(rollout_times), train_step)
+                    log_value('Learner update time (ms)', 1000 * np.mean(update_times) / args['updates_per_step'], train_step)
+                    if len(cache_hits) > 0:
+                        log_value('Encoder cache hit rate', np.mean(cache_hits), train_step)
+            timer.step(rank_envs)
+            if timer.enabled and train_step % args['profile_step'] == 0:
+                timer.report(train_step, profile_path, None if args['disable_tensorboard'] else log_value)
             train_step += 1
+            if reached_max_steps():
+                break
+        if reached_max_steps():
+            print(' [*] stopping after {} steps'.format(args['max_steps']))
+            break
         
+    if not is_main:
+        return None, None
     # Eval one last time
-    eval_step = eval(eval_step)
+    with timer.phase('eval'):
+        eval_step = eval(eval_step)
+    timer.report(train_step, profile_path, None if args['disable_tensorboard'] else log_value)
     if args['save_model']:
         print(' [*] saving model...')
         torch.save(actor, os.path.join(args['save_dir'], 'actor-epoch-{}.pt'.format(i+1)))
         torch.save(critic, os.path.join(args['save_dir'], 'critic-epoch-{}.pt'.format(i+1)))  
     if args['save_stats']:
         # write training stats to file
+        if len(cache_hits) > 0:
+            scores['_scores']['encoder_cache_hit_rate'] = float(np.mean(cache_hits))
+            scores['_scores']['encoder_cache_max_hit_rate'] = max_hit_rate
         json.dump(scores, fglab_results)
         tot_R = np.array(tot_R).ravel()
         birkhoff_dist = np.array(birkhoff_dist).ravel()
         raw_results.create_dataset('training_rewards', data=tot_R)
         raw_results.create_dataset('birkhoff_distance', data=birkhoff_dist)
+        raw_results.create_dataset('actor_loss', data=np.array(actor_losses))
+        raw_results.create_dataset('critic_loss', data=np.array(critic_losses))
         #raw_results.create_dataset('eval_mean_rewards', data=eval_means)
         #raw_results.create_dataset('eval_stddev_rewards', data=eval_stddevs)
         # close files
@@ -452,12 +651,48 @@ def evaluate_model(args, count):
         
     return best_eval_mean, best_eval_stddev
 
+def distributed_worker(rank, args):
+    """One of the --world_size data-parallel training processes"""
+    args['rank'] = rank
+    if rank > 0:
+        # rank 0 logs and saves for all of them
+        args.update({'disable_tensorboard': True, 'disable_progress_bar': True, 'save_stats': False,
+            'save_model': False, 'profile': False})
+    if 'OMP_NUM_THREADS' not in os.environ:
+        # split the cores between the ranks
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args['world_size']))
+    distributed.init(rank, args['world_size'], args['dist_port'])
+    # the ranks explore differently, and the weights are broadcast from rank 0
+    torch.manual_seed(args['random_seed'] + rank)
+    np.random.seed(args['random_seed'] + rank)
+    score = evaluate_model(args, 0)
+    if rank == 0:
+        print("Score: {}".format(score))
+    distributed.cleanup()
+
 if __name__ == '__main__':
     
     args = vars(parser.parse_args())
     args['model'] = 'spg'
     args['sl'] = False
-    
+    args['rank'] = 0
+
+    if args['updates_per_step'] < 1 or args['rollouts_per_update'] < 1:
+        print("--updates_per_step and --rollouts_per_update must be at least 1")
+        exit(1)
+    if args['world_size'] > 1:
+        if args['use_cuda']:
+            print("Distributed training runs on the CPU, pass --use_cuda False")
+            exit(1)
+        if args['parallel_envs'] % args['world_size'] != 0 or args['batch_size'] % args['world_size'] != 0:
+            print("--parallel_envs and --batch_size must be multiples of --world_size")
+            exit(1)
+        # each rank keeps its own shard of the replay buffer and replays batch_size / world_size at a time
+        args['buffer_size'] //= args['world_size']
+        args['batch_size'] //= args['world_size']
+        torch.multiprocessing.spawn(distributed_worker, args=(args,), nprocs=args['world_size'])
+        exit(0)
+
     # Set random seeds
     torch.manual_seed(args['random_seed'])
     #torch.cuda.manual_seed(args['random_seed'])